@@ -0,0 +1,27 @@
+"""Set up shared by the database benchmarks: just enough of a server for a `server.db.Database`,
+and a new database to run against that's thrown away afterwards."""
+from __future__ import annotations
+
+import os
+import tempfile
+from configparser import ConfigParser
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Iterator
+
+from server.db import Database
+
+
+def fake_server(title: str) -> SimpleNamespace:
+    """Everything the database uses from the server: its config, its name and a log (that goes nowhere)."""
+    return SimpleNamespace(config=ConfigParser(), server_info={"title": title}, log=lambda message, level=2: None)
+
+@contextmanager
+def temp_database(title: str) -> Iterator[Database]:
+    """A new database for a server called `title`, in a temporary folder that's deleted once it's closed."""
+    with tempfile.TemporaryDirectory() as folder:
+        db = Database(fake_server(title), os.path.join(folder, f"{title.lower()}.db"))
+        try:
+            yield db
+        finally:
+            db.close()
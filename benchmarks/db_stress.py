@@ -0,0 +1,104 @@
+"""Lots of threads reading from and writing to one `server.db.Database` at once, checking that every read gets
+back what it asked for (and not another thread's results) and that every write ends up saved exactly once.
+
+    python -m benchmarks.db_stress
+
+Exits with 1 if anything was wrong.
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+import threading
+import time
+
+from benchmarks.common import temp_database
+from server.db import Database
+
+
+def stress(db: Database, readers: int, writers: int, messages: int) -> tuple[list[str], dict]:
+    server_id = db.get_server_by_name("Stress")[0]
+    channels = [db.create_channel_in_server(server_id, f"channel-{n}").result() for n in range(writers)]
+    for n in range(writers):
+        db.create_user(f"writer-{n}", f"uuid-{n}")
+    db.commit()
+
+    errors: list[str] = []
+    done = threading.Event()
+    reads = [0] * readers
+
+    def writer(n: int) -> None:
+        channel_id = channels[n]
+        for i in range(messages):
+            future = db.create_message_in_channel(channel_id, f"uuid-{n}", f"writer-{n}", f"{channel_id}:{i}")
+            if i % 10 == 0: # like a client waiting for the server to say it's sent every now and then
+                future.result()
+
+    def reader(n: int) -> None:
+        seen = {channel_id: 0 for channel_id in channels}
+        i = 0
+        while not done.is_set():
+            channel_id = channels[(n + i) % len(channels)]
+            i += 1
+
+            try:
+                rows = db.get_messages_in_channel(channel_id)
+                name = db.get_channel_name_by_id(channel_id)
+            except Exception as e:
+                errors.append(f"reader {n} failed reading channel {channel_id}: {e!r}")
+                continue
+            reads[n] += 1
+
+            if name != f"channel-{channels.index(channel_id)}":
+                errors.append(f"reader {n} asked for the name of channel {channel_id} and got {name}")
+            wrong = [row for row in rows if not row[1].startswith(f"{channel_id}:")]
+            if wrong:
+                errors.append(f"reader {n} got {len(wrong)} messages from the wrong channel reading channel {channel_id}")
+            if len({row[0] for row in rows}) != len(rows):
+                errors.append(f"reader {n} got the same message twice from channel {channel_id}")
+            # commits only ever add messages, so later reads can't see fewer
+            if len(rows) < seen[channel_id]:
+                errors.append(f"reader {n} saw channel {channel_id} go from {seen[channel_id]} to {len(rows)} messages")
+            seen[channel_id] = len(rows)
+
+    reader_threads = [threading.Thread(target=reader, args=(n,)) for n in range(readers)]
+    writer_threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    started = time.perf_counter()
+    for thread in reader_threads + writer_threads: thread.start()
+    for thread in writer_threads: thread.join()
+    db.commit()
+    done.set()
+    for thread in reader_threads: thread.join()
+    taken = time.perf_counter() - started
+
+    for n, channel_id in enumerate(channels):
+        contents = sorted(row[1] for row in db.get_messages_in_channel(channel_id))
+        expected = sorted(f"{channel_id}:{i}" for i in range(messages))
+        if contents != expected:
+            errors.append(f"channel {channel_id} has {len(contents)} messages saved, expected {messages}")
+
+    stats = {"seconds": taken, "reads": sum(reads), "writes": writers * messages, **db.writer.stats()}
+    return errors, stats
+
+
+def run(readers: int, writers: int, messages: int) -> bool:
+    with temp_database("Stress") as db:
+        errors, stats = stress(db, readers, writers, messages)
+
+    print(f"{readers} readers, {writers} writers: {stats['reads']} reads ({stats['reads'] / stats['seconds']:,.0f}/s) "
+          f"and {stats['writes']} writes ({stats['writes'] / stats['seconds']:,.0f}/s, {stats['jobs_per_batch']} per commit) in {stats['seconds']:.2f}s")
+    for error in errors[:20]:
+        print(f"    {error}")
+    if errors:
+        print(f"{len(errors)} problems found.")
+    return not errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read from and write to the database from lots of threads at once.")
+    parser.add_argument("--readers", type=int, default=16)
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=500, help="how many messages each writer sends")
+    args = parser.parse_args()
+
+    sys.exit(0 if run(args.readers, args.writers, args.messages) else 1)
@@ -0,0 +1,94 @@
+"""How many chat messages a second can be saved, with a commit (and an fsync) for every message like the database
+used to do, and with `server.db_writer` sharing commits between everyone sending at once.
+
+Every sender waits for its message to be saved before sending the next one, like clients waiting for the server to reply.
+
+    python -m benchmarks.db_writes
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from server.db_writer import DURABILITY, DatabaseWriter
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    content TEXT NOT NULL,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    user_uuid TEXT,
+    user_name TEXT,
+    channel_id INTEGER
+);
+"""
+
+def insert(cur: sqlite3.Cursor, i: int) -> int:
+    cur.execute("INSERT INTO messages (content, user_uuid, user_name, channel_id) VALUES (?, ?, ?, ?)", (f"see you at {i}", "6f1c3c5e-8d2a-4f4b-9a53-2a0f0f9b8c11", "someone", 1))
+    return cur.lastrowid
+
+
+def run_senders(senders: int, seconds: float, send) -> int:
+    sent = [0] * senders
+    stop = time.monotonic() + seconds
+
+    def sender(n: int) -> None:
+        while time.monotonic() < stop:
+            send(sent[n])
+            sent[n] += 1
+
+    threads = [threading.Thread(target=sender, args=(n,)) for n in range(senders)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    return sum(sent)
+
+def old(path: str, senders: int, seconds: float) -> float:
+    """One shared connection, rollback journal, committing after every message."""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute(SCHEMA)
+    lock = threading.Lock()
+
+    def send(i: int) -> None:
+        with lock:
+            insert(conn.cursor(), i)
+            conn.commit()
+
+    sent = run_senders(senders, seconds, send)
+    conn.close()
+    return sent / seconds
+
+def writer(path: str, senders: int, seconds: float, durability: str) -> tuple[float, dict]:
+    with sqlite3.connect(path) as conn:
+        conn.execute(SCHEMA)
+    db_writer = DatabaseWriter(path, durability)
+
+    sent = run_senders(senders, seconds, lambda i: db_writer.run(insert, i).result())
+    db_writer.close()
+    return sent / seconds, db_writer.stats()
+
+
+def run(senders: list[int], seconds: float) -> None:
+    print(f"{'senders':>8}{'old/s':>10}" + "".join(f"{durability + '/s':>12}" for durability in DURABILITY) + f"{'per commit':>12}")
+    for count in senders:
+        with tempfile.TemporaryDirectory() as folder:
+            rates = [old(os.path.join(folder, "old.db"), count, seconds)]
+            batch = 0.0
+            for durability in DURABILITY:
+                rate, stats = writer(os.path.join(folder, f"{durability}.db"), count, seconds, durability)
+                rates.append(rate)
+                if durability == "full":
+                    batch = stats["jobs_per_batch"]
+        print(f"{count:>8}" + "".join(f"{rate:>10,.0f}" if i == 0 else f"{rate:>12,.0f}" for i, rate in enumerate(rates)) + f"{batch:>12}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark saving messages to the database.")
+    parser.add_argument("--seconds", type=float, default=2.0, help="how long to send messages for with each setup")
+    parser.add_argument("--senders", type=int, nargs="+", default=[1, 8, 64], help="how many senders to try")
+    args = parser.parse_args()
+
+    run(args.senders, args.seconds)
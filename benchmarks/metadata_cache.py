@@ -0,0 +1,94 @@
+"""How long the lookups for sending a message take straight from the database and through `server.db_cache`,
+and a check that the cache never hands back something a committed write has changed, even with lots of threads
+filling it back up at the same time.
+
+    python -m benchmarks.metadata_cache
+
+Exits with 1 if the cache ever gave back an old value.
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+import threading
+import time
+
+from benchmarks.common import temp_database
+from server.db import Database
+
+UUID = "6f1c3c5e-8d2a-4f4b-9a53-2a0f0f9b8c11"
+
+
+def lookups(db: Database, messages: int) -> tuple[float, float]:
+    """Microseconds per message for what the message path looks up: the user, and the channel's name and server."""
+    started = time.perf_counter()
+    for _ in range(messages):
+        db.get_user(UUID)
+        db.get_channel_name_by_id(1)
+        db.get_server_from_channel(1)
+    uncached = (time.perf_counter() - started) / messages * 1e6
+
+    started = time.perf_counter()
+    for _ in range(messages):
+        db.cache.user(UUID)
+        db.cache.channel(1)
+    cached = (time.perf_counter() - started) / messages * 1e6
+    return uncached, cached
+
+def invalidation(db: Database, readers: int, renames: int) -> list[str]:
+    errors: list[str] = []
+    done = threading.Event()
+
+    def reader() -> None:
+        # keeps putting whatever it reads back into the cache, trying to sneak an old name in after an invalidation
+        while not done.is_set():
+            db.cache.user(UUID)
+            db.cache.channel(1)
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in threads: thread.start()
+
+    for i in range(renames):
+        name = f"renamed-{i}"
+        db.update_username(UUID, name).result()
+        # once the write's done, the cache has to know about it straight away
+        user = db.cache.user(UUID)
+        if user is None or user[1] != name:
+            errors.append(f"rename {i}: the cache still had {user} after renaming to {name}")
+
+        if i % 50 == 0:
+            channel_id = db.create_channel_in_server(1, f"channel-{i}").result()
+            if db.cache.channel_name(channel_id) != f"channel-{i}":
+                errors.append(f"channel {channel_id} wasn't found after it was created")
+
+    done.set()
+    for thread in threads: thread.join()
+    return errors
+
+
+def run(messages: int, readers: int, renames: int) -> bool:
+    with temp_database("Cache") as db:
+        db.create_user("someone", UUID).result()
+
+        uncached, cached = lookups(db, messages)
+        print(f"message lookups: {uncached:.1f}us from the database, {cached:.1f}us through the cache (x{uncached / cached:.0f})")
+
+        errors = invalidation(db, readers, renames)
+        stats = db.cache.stats()
+        print(f"{renames} renames with {readers} threads reading: {stats['hit_rate']}% hits, {stats['invalidations']} invalidations")
+
+    for error in errors[:20]:
+        print(f"    {error}")
+    if errors:
+        print(f"{len(errors)} problems found.")
+    return not errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark and check the metadata cache.")
+    parser.add_argument("--messages", type=int, default=20000, help="how many messages' worth of lookups to time")
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--renames", type=int, default=500)
+    args = parser.parse_args()
+
+    sys.exit(0 if run(args.messages, args.readers, args.renames) else 1)
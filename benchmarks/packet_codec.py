@@ -0,0 +1,115 @@
+"""Compare the packet codec in `server.packet` with the old dataclass + asdict one.
+
+    python -m benchmarks.packet_codec
+"""
+from __future__ import annotations
+
+import argparse
+import timeit
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from typing import Any
+
+import msgpack
+
+from server.packet import Packet, PacketType, to_bytes, to_packets
+
+
+# the codec as it was before, kept here so there's something to compare against
+@dataclass
+class OldPacket:
+    packet_type: PacketType
+    data: Any = None
+    tag: str = None
+
+def old_to_bytes(packet: OldPacket) -> bytes:
+    data = packet.data
+    if isinstance(data, dict) and isinstance(data.get("timestamp"), datetime):
+        data = {**data, "timestamp": datetime.strftime(data["timestamp"], "%Y-%m-%d %H:%M:%S")}
+    packet = OldPacket(packet.packet_type.value, data, packet.tag)
+    return msgpack.packb(asdict(packet))
+
+def old_to_packet(data: bytes) -> OldPacket:
+    packet = OldPacket(**msgpack.unpackb(data, raw=False))
+    packet.packet_type = PacketType(packet.packet_type)
+    return packet
+
+
+def message_times(packet, parse) -> None:
+    """Turn every timestamp in a packet into a datetime, like `ui.widgets.chat.Message` does before showing it."""
+    data = packet.data
+    if packet.packet_type == PacketType.MESSAGE_RECV:
+        parse(data["timestamp"])
+    elif isinstance(data, dict) and data.get("type") == "SERVER_MSGS":
+        for message in data["data"]["messages"]:
+            parse(message[2])
+
+def old_parse(value: str) -> datetime:
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+def new_parse(value) -> datetime:
+    return datetime.fromisoformat(value) if isinstance(value, str) else value.astimezone()
+
+
+def message_recv(i: int) -> dict:
+    return {
+        "message": f"hello there, this is message number {i}",
+        "sender_name": "someone",
+        "timestamp": datetime.now(),
+        "channel_id": 1,
+        "channel_name": "general",
+        "server_ip": "192.168.1.20"
+    }
+
+def history(count: int) -> dict:
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return {
+        "type": "SERVER_MSGS",
+        "data": {
+            "messages": [(i, f"hello there, this is message number {i}", now, "someone") for i in range(count)],
+            "channel_name": "general"
+        }
+    }
+
+WORKLOADS = {
+    "MESSAGE_RECV": (PacketType.MESSAGE_RECV, lambda: message_recv(1)),
+    "SERVER_MSGS (100 messages)": (PacketType.DATA, lambda: history(100)),
+    "SERVER_MSGS (1000 messages)": (PacketType.DATA, lambda: history(1000)),
+}
+
+
+def rate(function, seconds: float) -> float:
+    """How many times a second `function` can be called, using the best of a few runs so other things running don't skew it."""
+    timer = timeit.Timer(function)
+    number, taken = timer.autorange()
+    number = max(1, int(number * seconds / 5 / taken))
+    return number / min(timer.repeat(repeat=5, number=number))
+
+def run(seconds: float) -> None:
+    print(f"{'workload':<30}{'':>8}{'old/s':>12}{'new/s':>12}{'speedup':>10}")
+    for name, (packet_type, make_data) in WORKLOADS.items():
+        data = make_data()
+        old_packet = OldPacket(packet_type, data, "t1")
+        new_packet = Packet(packet_type, data, "t1")
+        old_encoded = old_to_bytes(old_packet)
+        new_encoded = to_bytes(new_packet, timestamps=True)
+
+        results = {
+            "encode": (rate(lambda: old_to_bytes(old_packet), seconds), rate(lambda: to_bytes(new_packet, timestamps=True), seconds)),
+            "decode": (rate(lambda: old_to_packet(old_encoded), seconds), rate(lambda: to_packets(new_encoded), seconds)),
+            # decoding plus getting the timestamps ready to show
+            "client": (
+                rate(lambda: message_times(old_to_packet(old_encoded), old_parse), seconds),
+                rate(lambda: message_times(to_packets(new_encoded)[0], new_parse), seconds)
+            ),
+        }
+        for step, (old, new) in results.items():
+            print(f"{name:<30}{step:>8}{old:>12,.0f}{new:>12,.0f}{new / old:>9.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark packet encoding and decoding.")
+    parser.add_argument("--seconds", type=float, default=1.0, help="how long to run each measurement for")
+    args = parser.parse_args()
+
+    run(args.seconds)
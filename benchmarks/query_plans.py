@@ -0,0 +1,106 @@
+"""Check that every query the server reads with is answered from an index, so none of them quietly go back to
+scanning whole tables (which is fine with a few messages and very much not with millions).
+
+Each read method of `server.db.Database` is run for real, the SQL it sent is recorded, and EXPLAIN QUERY PLAN
+is asked how sqlite would run it. Anything that scans a table (or a whole index) is a failure.
+
+    python -m benchmarks.query_plans [--messages 100000]
+
+Exits with 1 if any query scans.
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+
+from benchmarks.common import temp_database
+from server.db import Database
+
+SYSTEM_UUID = "00000000-0000-0000-0000-000000000000"
+
+# every read the server does, with arguments that find something
+READS = [
+    ("get_messages_in_channel", (1,)),
+    ("get_message_page", (1,)),
+    ("get_message_page", (1, 5000)),
+    ("get_message_page", (1, None, 5000)),
+    ("get_message_at", (1, "2000-01-01 00:00:00")),
+    ("get_channel_name_by_id", (1,)),
+    ("get_server_from_channel", (1,)),
+    ("get_channel_by_name", (1, "general")),
+    ("get_channel", (1, 1)),
+    ("get_channels_in_server", (1,)),
+    ("get_channels_by_server_name", ("Plans",)),
+    ("get_server_by_name", ("Plans",)),
+    ("get_user", (SYSTEM_UUID,)),
+    ("get_user_by_name", ("SYSTEM",)),
+    ("user_exists", (SYSTEM_UUID,)),
+    ("user_exists_by_name", ("SYSTEM",)),
+    ("server_exists", (1,)),
+    ("server_exists_by_name", ("Plans",)),
+    ("is_user_in_server", (SYSTEM_UUID, 1)),
+    ("users_in_server", ("Plans",)),
+    ("users_in_server_id", (1,)),
+    ("servers_with_user", ("SYSTEM",)),
+    ("get_role_by_name", ("DefaultPerms",)),
+    ("get_roles_for_user_in_server", (SYSTEM_UUID, 1)),
+    ("get_roles_with_users_in_server", (1,)),
+    ("can_user", (SYSTEM_UUID, 1, "send_messages")),
+]
+
+
+def fill(db: Database, messages: int) -> None:
+    """Lots of messages spread over a few channels, so a scan would actually cost something."""
+    server_id = db.get_server_by_name("Plans")[0]
+    channels = [1] + [db.create_channel_in_server(server_id, f"channel-{n}").result() for n in range(9)]
+
+    def insert(cur, start: int, count: int) -> None:
+        cur.executemany(
+            "INSERT INTO messages (content, user_uuid, user_name, channel_id) VALUES (?, ?, ?, ?)",
+            ((f"message {i}", SYSTEM_UUID, "SYSTEM", channels[i % len(channels)]) for i in range(start, start + count))
+        )
+
+    for start in range(0, messages, 50000):
+        db.writer.run(insert, start, min(50000, messages - start))
+    db.commit()
+
+def scans(plan: list[tuple]) -> list[str]:
+    """The steps of a query plan that go through a whole table or index instead of searching it."""
+    return [step[3] for step in plan if step[3].startswith("SCAN ")]
+
+def check(db: Database, messages: int) -> bool:
+    fill(db, messages)
+
+    statements: list[str] = []
+    db.cur.connection.set_trace_callback(statements.append)
+
+    ok = True
+    for name, args in READS:
+        statements.clear()
+        started = time.perf_counter()
+        getattr(db, name)(*args)
+        taken = (time.perf_counter() - started) * 1000
+        queries = [statement for statement in statements if statement.lstrip().upper().startswith("SELECT")]
+
+        problems = []
+        for query in queries:
+            problems += scans(db.cur.execute(f"EXPLAIN QUERY PLAN {query}").fetchall())
+
+        ok = ok and not problems
+        print(f"{'SCANS' if problems else 'ok':<6}{name:<34}{taken:>9.2f}ms")
+        for problem in problems:
+            print(f"          {problem}")
+
+    db.cur.connection.set_trace_callback(None)
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the database's queries use indexes.")
+    parser.add_argument("--messages", type=int, default=100000, help="how many messages to fill the database with first")
+    args = parser.parse_args()
+
+    with temp_database("Plans") as db:
+        ok = check(db, args.messages)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,75 @@
+"""How many bytes the busiest packets take up on the wire with each encoding.
+
+    python -m benchmarks.wire_size
+"""
+from __future__ import annotations
+
+from datetime import datetime
+
+from server.packet import COMPACT_VERSIONS, Packet, PacketType, compact_channel, to_bytes
+
+
+def message_recv(i: int) -> Packet:
+    return Packet(PacketType.MESSAGE_RECV, {
+        "message": f"see you at {i}",
+        "sender_name": "someone",
+        "timestamp": datetime.now(),
+        "channel_id": 1,
+        "channel_name": "general",
+        "server_id": 1,
+        "server_ip": "192.168.1.20"
+    })
+
+def message_send(i: int) -> Packet:
+    return Packet(PacketType.MESSAGE_SEND, {
+        "message": f"see you at {i}",
+        "channel_id": 1,
+        "username": "someone",
+        "uuid": "6f1c3c5e-8d2a-4f4b-9a53-2a0f0f9b8c11"
+    }, tag="r12")
+
+def server_msgs(count: int) -> Packet:
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return Packet(PacketType.DATA, {
+        "type": "SERVER_MSGS",
+        "data": {
+            "messages": [(i, f"see you at {i}", now, "someone") for i in range(count)],
+            "channel_name": "general"
+        }
+    }, tag="r13")
+
+ENCODINGS = {
+    "legacy": (False, 0),
+    "timestamps": (True, 0),
+    **{f"compact v{version}": (True, version) for version in COMPACT_VERSIONS}
+}
+
+
+def stream_size(packets: list[Packet], timestamps: bool, compact: int) -> int:
+    """Bytes for sending all of `packets` to one client, counting the DEFINEs the compact schema sends along the way."""
+    defined = {}
+    size = 0
+    for packet in packets:
+        channel = compact_channel(packet) if compact else None
+        if channel is not None and defined.get(channel[0]) != channel:
+            defined[channel[0]] = channel
+            size += len(to_bytes(Packet(PacketType.DEFINE, list(channel)), compact=compact))
+        size += len(to_bytes(packet, timestamps, compact))
+    return size
+
+def run() -> None:
+    workloads = {
+        "MESSAGE_RECV (first)": [message_recv(0)],
+        "MESSAGE_RECV (1000 sent)": [message_recv(i) for i in range(1000)],
+        "MESSAGE_SEND": [message_send(0)],
+        "SERVER_MSGS (100 messages)": [server_msgs(100)],
+    }
+
+    print(f"{'bytes per packet':<28}" + "".join(f"{name:>14}" for name in ENCODINGS))
+    for name, packets in workloads.items():
+        sizes = [stream_size(packets, *encoding) / len(packets) for encoding in ENCODINGS.values()]
+        print(f"{name:<28}" + "".join(f"{size:>14.1f}" for size in sizes))
+
+
+if __name__ == "__main__":
+    run()
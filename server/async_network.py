@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import itertools
+import os
+import queue
+import time
+import zlib
+
+from server.capabilities import Capabilities, local_limits, negotiate
+from server.framing import MAX_FRAME_SIZE, FrameDecoder, FrameTooLarge, UnframedDecoder, frame
+from server.packet import Packet, PacketType, to_bytes, to_packets
+from server.uploads import CHUNK_SIZE, file_sha256
+
+
+class ServerNotResponding(ConnectionResetError):
+    """The connection's still open, but the server stopped answering heartbeats."""
+
+
+class AsyncNetwork:
+    """An asyncio client, for the TUI and bots.
+
+    Every `request` gets its own tag, and the server sends the reply back with the same one, so lots of requests
+    can be waiting at once and each gets the right reply no matter what order they come back in.
+    Anything the server sends that isn't a reply (new messages, notifications, upload statuses) goes to `recv_push`."""
+    # how long to wait for a reply before giving up
+    timeout: float = 10
+    # how many pushes can be waiting to be handled before we stop reading from the server
+    max_pushes: int = 1024
+    # with servers that support heartbeats, ping them after this many seconds of hearing nothing (they may ask for it sooner).
+    # a ping that isn't answered within the same time means the server's gone. 0 turns heartbeats off
+    heartbeat_interval: int = 15
+
+    def __init__(self, server_ip: str, port: int = 5555):
+        self.server = server_ip
+        self.port = port
+        # what the server agreed to use, filled in when we connect
+        self.capabilities = Capabilities()
+        self.uploads: dict[str, str] = {}
+        # what the server's told us its channel refs mean, for the compact schema
+        self.channels: dict[int, tuple] = {}
+
+        self.__tags = itertools.count(1)
+        self.__pending: dict[str, asyncio.Future] = {}
+        self.__pushes: asyncio.Queue[Packet | Exception] = asyncio.Queue(self.max_pushes)
+        self.__reader_task: asyncio.Task = None
+        self.__heartbeat_task: asyncio.Task = None
+        # when we last heard anything from the server (time.monotonic)
+        self.__last_received = time.monotonic()
+        self.__started: asyncio.Future = None
+        self.__stream_reader: asyncio.StreamReader = None
+        self.__stream_writer: asyncio.StreamWriter = None
+        # the server's hello is never framed, the rest is if the hello says the server knows about frames (see `server.framing`)
+        self.__decoder: FrameDecoder | UnframedDecoder = UnframedDecoder()
+        self.__read_hello = False
+        self.__framed = False
+        self.closed = False
+
+    # the transport, `AsyncLoopbackNetwork` swaps these out
+    async def _open(self) -> None:
+        # "unix:///path/to/portal.sock" connects through the server's unix socket instead
+        if self.server.startswith("unix://"):
+            self.__stream_reader, self.__stream_writer = await asyncio.open_unix_connection(self.server[len("unix://"):])
+        else:
+            self.__stream_reader, self.__stream_writer = await asyncio.open_connection(self.server, self.port)
+
+    async def _read(self) -> list[Packet]:
+        while True:
+            # just the hello to start with, whatever comes after it might be framed
+            packets = [packet for body in self.__decoder.frames(None if self.__read_hello else 1) for packet in to_packets(body, self.channels)]
+            if packets:
+                break
+
+            data = await self.__stream_reader.read(64 * 1024)
+            if not data:
+                raise ConnectionResetError("The server closed the connection.")
+            self.__decoder.feed(data)
+
+        if not self.__read_hello:
+            self.__read_hello = True
+            # older servers send an empty CONNECTION_STARTED, they don't frame anything
+            if packets[0].packet_type == PacketType.CONNECTION_STARTED and negotiate(packets[0].data).version > 0:
+                self.__framed = True
+                self.__decoder = self.__decoder.to_framed()
+        return packets
+
+    async def _write(self, packet: Packet) -> None:
+        message = to_bytes(packet, self.capabilities.supports("timestamps"), self.capabilities.compact)
+        # the server would drop the connection over it, better to just fail this one packet
+        if len(message) > self.capabilities.limit("max-frame-size", MAX_FRAME_SIZE):
+            raise FrameTooLarge(f"Packet of {len(message)} bytes is bigger than the server's limit.")
+        self.__stream_writer.write(frame(message) if self.__framed else message)
+        await self.__stream_writer.drain()
+
+    def _close(self) -> None:
+        if self.__stream_writer is not None:
+            self.__stream_writer.close()
+
+    async def connect(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.__started = loop.create_future()
+        await self._open()
+        self.__reader_task = loop.create_task(self.__read_loop())
+
+        # the server starts by telling us what it supports, older servers don't send anything useful
+        try:
+            hello = await asyncio.wait_for(asyncio.shield(self.__started), self.timeout)
+        except asyncio.TimeoutError:
+            hello = None
+
+        self.capabilities = negotiate(hello)
+        if self.capabilities.version > 0:
+            self.__decoder.max_frame_size = self.capabilities.limit("max-frame-size", MAX_FRAME_SIZE)
+            limits = local_limits()
+            if self.capabilities.supports("heartbeat") and self.heartbeat_interval > 0:
+                limits["heartbeat-interval"] = self.capabilities.limits["heartbeat-interval"] = min(self.heartbeat_interval, self.capabilities.limits["heartbeat-interval"])
+            else:
+                # turned off on our side (or the server's), so don't let the server expect pings
+                limits.pop("heartbeat-interval", None)
+                self.capabilities.limits.pop("heartbeat-interval", None)
+                self.capabilities.features.discard("heartbeat")
+
+            await self.send(Packet(PacketType.CONNECTION_STARTED, {
+                "version": self.capabilities.version,
+                "features": sorted(self.capabilities.features),
+                "compression": self.capabilities.compression,
+                "limits": limits,
+                "compact": self.capabilities.compact
+            }))
+
+            if self.capabilities.supports("heartbeat"):
+                self.__heartbeat_task = loop.create_task(self.__heartbeat(self.capabilities.limits["heartbeat-interval"]))
+
+    async def __read_loop(self) -> None:
+        try:
+            while True:
+                packets = await self._read()
+                self.__last_received = time.monotonic()
+                for packet in packets:
+                    if packet.tag is not None:
+                        # a reply to one of our requests, if nobody's waiting for it any more it timed out
+                        future = self.__pending.pop(packet.tag, None)
+                        if future is not None and not future.done():
+                            future.set_result(packet)
+                    elif packet.packet_type == PacketType.CONNECTION_STARTED and not self.__started.done():
+                        self.__started.set_result(packet.data)
+                    else:
+                        # waits if nobody is handling pushes, which stops us reading until they catch up
+                        await self.__pushes.put(packet)
+        except Exception as e:
+            error = e if isinstance(e, (ConnectionError, OSError)) else ConnectionResetError(f"Lost the connection to the server: {e}")
+        else:
+            error = ConnectionResetError("The server closed the connection.")
+        self.__fail(error)
+
+    async def __heartbeat(self, interval: float) -> None:
+        """Ping the server whenever it's been quiet for `interval` seconds, and give up on it if it doesn't answer."""
+        while not self.closed:
+            quiet_for = time.monotonic() - self.__last_received
+            if quiet_for < interval:
+                await asyncio.sleep(interval - quiet_for)
+                continue
+
+            try:
+                await self.request(Packet(PacketType.PING), timeout=interval)
+            except asyncio.TimeoutError:
+                self.__reader_task.cancel()
+                self._close()
+                self.__fail(ServerNotResponding(f"The server hasn't answered for {interval * 2:.0f} seconds."))
+                return
+            except (ConnectionError, OSError): # the reader's already found out
+                return
+
+    def __fail(self, error: Exception) -> None:
+        """Let everyone waiting on the connection know it's gone."""
+        if self.__started is not None and not self.__started.done():
+            self.__started.set_result(None)
+        for future in self.__pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.__pending.clear()
+
+        # make room so recv_push always finds out
+        while self.__pushes.full():
+            self.__pushes.get_nowait()
+        self.__pushes.put_nowait(error)
+
+    async def request(self, packet: Packet, timeout: float = None) -> Packet:
+        """Send a packet and wait for the server's reply to it."""
+        if self.closed:
+            raise ConnectionResetError("The connection is closed.")
+
+        packet.tag = f"r{next(self.__tags)}"
+        future = asyncio.get_running_loop().create_future()
+        self.__pending[packet.tag] = future
+        try:
+            await self._write(packet)
+            return await asyncio.wait_for(future, timeout or self.timeout)
+        finally:
+            self.__pending.pop(packet.tag, None)
+
+    async def send(self, packet: Packet) -> None:
+        """Send a packet that doesn't get a reply (or whose reply should go to `recv_push`)."""
+        if self.closed:
+            raise ConnectionResetError("The connection is closed.")
+        await self._write(packet)
+
+    async def recv_push(self) -> Packet:
+        """Wait for the next packet the server sent that wasn't a reply. Raises ConnectionResetError once the connection is gone."""
+        packet = await self.__pushes.get()
+        if isinstance(packet, Exception):
+            self.__pushes.put_nowait(packet) # so anyone else waiting finds out too
+            raise packet
+        return packet
+
+    async def start_upload(self, path: str, user_uuid: str, kind: str = "icon") -> str:
+        """Ask the server to start receiving a file. It replies with an UPLOAD_STATUS (as a push) saying where to
+        start from, then send the file with `send_upload`. Starting the same file again resumes it."""
+        sha256 = await asyncio.to_thread(file_sha256, path)
+        upload_id = hashlib.sha256(f"{kind}:{sha256}".encode()).hexdigest()[:32]
+        self.uploads[upload_id] = path
+
+        await self.send(Packet(PacketType.UPLOAD, {
+            "type": "START",
+            "uuid": user_uuid,
+            "upload_id": upload_id,
+            "kind": kind,
+            "name": os.path.basename(path),
+            "size": os.path.getsize(path),
+            "sha256": sha256
+        }))
+        return upload_id
+
+    async def send_upload(self, upload_id: str, user_uuid: str, offset: int = 0) -> None:
+        """Send the rest of a file from `offset` onwards. Each chunk is its own packet, so requests can still go through in between."""
+        with open(self.uploads[upload_id], "rb") as f:
+            f.seek(offset)
+            while True:
+                chunk = await asyncio.to_thread(f.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                await self.send(Packet(PacketType.UPLOAD, {
+                    "type": "CHUNK",
+                    "uuid": user_uuid,
+                    "upload_id": upload_id,
+                    "offset": offset,
+                    "data": chunk,
+                    "crc32": zlib.crc32(chunk)
+                }))
+                offset += len(chunk)
+
+    async def close(self) -> None:
+        if self.closed: return
+        self.closed = True
+
+        if self.__reader_task is not None:
+            self.__reader_task.cancel()
+        if self.__heartbeat_task is not None:
+            self.__heartbeat_task.cancel()
+        self._close()
+        self.__fail(ConnectionResetError("The connection is closed."))
+
+
+class AsyncLoopbackNetwork(AsyncNetwork):
+    """Talks to a server running in this same process, through a `LoopbackConnection` instead of a socket.
+
+    Packets are passed straight across as objects, so nothing has to be encoded or decoded either way."""
+
+    def __init__(self, connection, server_ip: str):
+        super().__init__(server_ip)
+        self.connection = connection
+
+    async def _open(self) -> None:
+        pass
+
+    async def _read(self) -> list[Packet]:
+        # the server fills the outbox from its own thread, so wait for it off the event loop
+        packets = [await asyncio.to_thread(self.connection.outbox.get)]
+        while not self.connection.outbox.empty():
+            packets.append(self.connection.outbox.get_nowait())
+
+        if None in packets: # the server shut down
+            raise ConnectionResetError("The server closed the connection.")
+        return packets
+
+    async def _write(self, packet: Packet) -> None:
+        self.connection.deliver_to_server(packet)
+
+    def _close(self) -> None:
+        # wakes up the reader if it's still waiting on the outbox
+        try:
+            self.connection.outbox.put_nowait(None)
+        except queue.Full:
+            pass
+
+        if self.connection.closed: return
+        try:
+            self.connection.disconnect()
+        except RuntimeError: # the server's event loop has already stopped
+            pass
@@ -0,0 +1,306 @@
+"""Pub/sub backends, so one logical server can be spread over several processes or machines.
+
+Every broadcast a server makes (chat messages, announcements) is delivered to its own clients straight away and
+also published to its broker, which hands it to every other server on the same backend. Those then deliver it to
+their own clients. Each server also shares how many clients it has, so SERVER_INFO can show the total.
+
+    python -m server.broker --port 5560
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import socket
+import time
+import traceback
+import uuid
+from abc import ABC, abstractmethod
+from collections import deque
+from configparser import ConfigParser
+
+import msgpack
+
+from server.config import conf_get
+from server.framing import HEADER, frame
+
+
+class LatencyStats:
+    """How long broadcasts take to get from being published on one server to being delivered on another."""
+
+    def __init__(self, samples: int = 1024):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent: deque[float] = deque(maxlen=samples)
+
+    def add(self, seconds: float) -> None:
+        seconds = max(seconds, 0.0) # clocks on different machines don't always agree
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+    def as_dict(self) -> dict:
+        recent = sorted(self.recent)
+        percentile = lambda p: round(recent[min(len(recent) - 1, int(len(recent) * p))] * 1000, 3) if recent else 0.0
+        return {
+            "delivered": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": percentile(0.5),
+            "p99_ms": percentile(0.99),
+            "max_ms": round(self.max * 1000, 3)
+        }
+
+
+class Broker(ABC):
+    """Base class for the backends. Everything here runs on the NetworkFormatManager's event loop."""
+
+    def __init__(self):
+        self.node_id = uuid.uuid4().hex
+        self.manager = None
+        self.loop: asyncio.AbstractEventLoop = None
+        # how many clients each server (including this one) has
+        self.online_counts: dict[str, int] = {}
+        self.published = 0
+        self.latency = LatencyStats()
+
+    @property
+    def online(self) -> int:
+        return sum(self.online_counts.values())
+
+    async def start(self, manager) -> None:
+        self.manager = manager
+        self.loop = asyncio.get_running_loop()
+        # ask everyone else how many clients they've got
+        self.publish({"type": "hello"})
+
+    def publish(self, message: dict) -> None:
+        if message["type"] not in ("hello", "online", "gone"):
+            self.published += 1
+        self._send({**message, "node": self.node_id, "sent_at": time.time()})
+
+    def set_online(self, count: int) -> None:
+        self.online_counts[self.node_id] = count
+        self.publish({"type": "online", "count": count})
+
+    def receive(self, message: dict) -> None:
+        node = message.get("node")
+        if node == self.node_id: return
+
+        if message["type"] == "hello":
+            self.publish({"type": "online", "count": self.online_counts.get(self.node_id, 0)})
+        elif message["type"] == "online":
+            self.online_counts[node] = message["count"]
+        elif message["type"] == "gone":
+            self.online_counts.pop(node, None)
+        else:
+            self.manager.deliver_from_broker(message)
+            self.latency.add(time.time() - message["sent_at"])
+
+    def stats(self) -> dict:
+        return {"backend": type(self).__name__, "published": self.published, "nodes": len(self.online_counts), **self.latency.as_dict()}
+
+    @abstractmethod
+    def _send(self, message: dict) -> None:
+        """Send a message to every other server."""
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryHub:
+    """Connects every MemoryBroker made with it, for running several servers in one process (mostly for tests)."""
+
+    def __init__(self):
+        self.brokers: list[MemoryBroker] = []
+
+default_hub = MemoryHub()
+
+
+class MemoryBroker(Broker):
+    def __init__(self, hub: MemoryHub = default_hub):
+        super().__init__()
+        self.hub = hub
+
+    async def start(self, manager) -> None:
+        self.hub.brokers.append(self)
+        await super().start(manager)
+
+    def _send(self, message: dict) -> None:
+        for broker in list(self.hub.brokers):
+            if broker is not self and broker.loop is not None and not broker.loop.is_closed():
+                broker.loop.call_soon_threadsafe(broker.receive, message)
+
+    async def close(self) -> None:
+        if self in self.hub.brokers:
+            self.hub.brokers.remove(self)
+            # everyone else stops counting our clients
+            self._send({"type": "gone", "node": self.node_id, "sent_at": time.time()})
+
+
+class StreamBroker(Broker):
+    """A broker that talks to a relay (see `BrokerRelay`) over a stream, using the normal length prefixed framing."""
+    # how long to wait before trying to connect to the relay again, None to not bother
+    retry_delay: float = 1.0
+
+    def __init__(self):
+        super().__init__()
+        self.__writer: asyncio.StreamWriter = None
+        self.__reader_task: asyncio.Task = None
+        self.closed = False
+
+    @abstractmethod
+    async def connect(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """Open a stream to the relay."""
+        pass
+
+    async def start(self, manager) -> None:
+        reader, self.__writer = await self.connect()
+        self.__reader_task = asyncio.get_running_loop().create_task(self.__read_loop(reader))
+        await super().start(manager)
+
+    def _send(self, message: dict) -> None:
+        if self.__writer is None or self.__writer.is_closing(): return
+        self.__writer.write(frame(msgpack.packb(message)))
+
+    async def __read_loop(self, reader: asyncio.StreamReader) -> None:
+        while not self.closed:
+            try:
+                while True:
+                    header = await reader.readexactly(HEADER.size)
+                    self.__receive(await reader.readexactly(HEADER.unpack(header)[0]))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.manager.network_functions.log("broker", "Lost the connection to the broker.")
+
+            # everyone else's counts are out of date now
+            self.online_counts = {self.node_id: self.online_counts.get(self.node_id, 0)}
+            if self.retry_delay is None: return
+            reader = await self.__reconnect()
+
+    def __receive(self, data: bytes) -> None:
+        # one bad message (from a newer server, or that one of our clients can't be sent) shouldn't stop all the others
+        try:
+            self.receive(msgpack.unpackb(data, raw=False))
+        except Exception:
+            self.manager.network_functions.log("broker", f"Couldn't handle a message from the broker:\n{traceback.format_exc()}")
+
+    async def __reconnect(self) -> asyncio.StreamReader:
+        while not self.closed:
+            await asyncio.sleep(self.retry_delay)
+            try:
+                reader, self.__writer = await self.connect()
+            except OSError:
+                continue
+
+            self.manager.network_functions.log("broker", "Reconnected to the broker.")
+            self.publish({"type": "hello"})
+            self.set_online(self.online_counts.get(self.node_id, 0))
+            return reader
+
+    async def close(self) -> None:
+        self.closed = True
+        if self.__reader_task is not None:
+            self.__reader_task.cancel()
+        if self.__writer is not None:
+            self.__writer.close()
+
+
+class TcpBroker(StreamBroker):
+    """Connects to a broker process (`python -m server.broker`), which could be on another machine."""
+
+    def __init__(self, host: str, port: int):
+        super().__init__()
+        self.host = host
+        self.port = port
+
+    async def connect(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        return await asyncio.open_connection(self.host, self.port)
+
+
+class SocketBroker(StreamBroker):
+    """Uses an already connected socket, like the socketpairs between cluster workers and their parent.
+    There's nothing to reconnect to if it goes."""
+    retry_delay = None
+
+    def __init__(self, sock: socket.socket):
+        super().__init__()
+        self.sock = sock
+
+    async def connect(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        return await asyncio.open_connection(sock=self.sock)
+
+
+class BrokerRelay:
+    """Passes every message from one server on to all the others. This is all the broker process does."""
+    # a server that gets this far behind is dropped, rather than us buffering for it forever
+    max_buffer: int = 16 * 1024 * 1024
+
+    def __init__(self):
+        self.peers: set[asyncio.StreamWriter] = set()
+
+    async def handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.peers.add(writer)
+        node = None
+        try:
+            while True:
+                header = await reader.readexactly(HEADER.size)
+                body = await reader.readexactly(HEADER.unpack(header)[0])
+                if node is None:
+                    node = msgpack.unpackb(body, raw=False).get("node")
+
+                message = header + body
+                for peer in list(self.peers):
+                    if peer is writer: continue
+                    if peer.transport.get_write_buffer_size() > self.max_buffer:
+                        self.peers.discard(peer)
+                        peer.close()
+                        continue
+                    peer.write(message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.peers.discard(writer)
+            writer.close()
+            # it's gone, so nobody should count its clients any more
+            if node is not None:
+                goodbye = frame(msgpack.packb({"type": "gone", "node": node, "sent_at": time.time()}))
+                for peer in list(self.peers):
+                    peer.write(goodbye)
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.handle_peer, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def serve_sockets(self, socks: list[socket.socket]) -> None:
+        """Relay between some already connected sockets until they've all gone."""
+        peers = []
+        for sock in socks:
+            reader, writer = await asyncio.open_connection(sock=sock)
+            peers.append(self.handle_peer(reader, writer))
+        await asyncio.gather(*peers)
+
+
+def make_broker(config: ConfigParser) -> Broker:
+    """Create the broker the server's settings ask for, or None if it isn't sharing broadcasts with anyone."""
+    backend = conf_get(config, "Broker", "backend")
+    if backend == "memory":
+        return MemoryBroker()
+    if backend == "tcp":
+        host, _, port = conf_get(config, "Broker", "address").rpartition(":")
+        return TcpBroker(host, int(port))
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Relay broadcasts between Portal server nodes.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5560)
+    args = parser.parse_args()
+
+    print(f"Broker listening on {args.host}:{args.port}")
+    try:
+        asyncio.run(BrokerRelay().serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
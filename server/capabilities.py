@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+from configparser import ConfigParser
+
+from server.compression import available_codecs, choose_codec
+from server.config import DEFAULT_CONFIG, conf_get
+from server.framing import MAX_FRAME_SIZE
+from server.packet import COMPACT_VERSIONS
+
+
+# bump this whenever the meaning of an existing packet changes, new features go in FEATURES instead
+PROTOCOL_VERSION = 1
+
+# optional parts of the protocol, a connection only uses the ones both sides list
+FEATURES = ("compression", "batching", "subscriptions", "uploads", "timestamps", "compact", "heartbeat", "history")
+
+
+class Capabilities:
+    """What a single connection has agreed to use.
+
+    A peer that never answers the handshake (anything from before it existed) gets `Capabilities()`,
+    which is protocol version 0 with no features, so it keeps working exactly like it always has."""
+
+    def __init__(self, version: int = 0, features: set[str] = None, compression: str = None, limits: dict[str, int] = None, compact: int = 0):
+        self.version = version
+        self.features = features or set()
+        self.compression = compression
+        self.limits = limits or {}
+        # which version of the compact schema to use for the busiest packets, 0 for none
+        self.compact = compact
+
+    def supports(self, feature: str) -> bool:
+        return feature in self.features
+
+    def limit(self, name: str, default: int) -> int:
+        return self.limits.get(name, default)
+
+    def as_dict(self) -> dict:
+        return {
+            "version": self.version,
+            "features": sorted(self.features),
+            "compression": self.compression,
+            "limits": self.limits,
+            "compact": self.compact
+        }
+
+
+def local_limits(config: ConfigParser = None) -> dict[str, int]:
+    limits = {"max-frame-size": MAX_FRAME_SIZE}
+    if config is not None:
+        # frames can't be any bigger than MAX_FRAME_SIZE whatever the config says (see `server.framing`)
+        limits["max-frame-size"] = min(int(conf_get(config, "Network", "max-frame-size")), MAX_FRAME_SIZE)
+        limits["batch-window"] = int(conf_get(config, "Network", "batch-window"))
+        limits["batch-bytes"] = int(conf_get(config, "Network", "batch-bytes"))
+
+    heartbeat_interval = int(conf_get(config, "Network", "heartbeat-interval") if config is not None else DEFAULT_CONFIG["Network"]["heartbeat-interval"])
+    if heartbeat_interval > 0:
+        limits["heartbeat-interval"] = heartbeat_interval
+    return limits
+
+def hello(config: ConfigParser = None) -> dict:
+    """Everything we support, sent as the data of CONNECTION_STARTED."""
+    limits = local_limits(config)
+    return {
+        "version": PROTOCOL_VERSION,
+        # no point offering heartbeats if they're turned off
+        "features": [feature for feature in FEATURES if feature != "heartbeat" or "heartbeat-interval" in limits],
+        "compression": available_codecs(),
+        "limits": limits,
+        "compact": list(COMPACT_VERSIONS)
+    }
+
+def negotiate(offer: dict, config: ConfigParser = None) -> Capabilities:
+    """Work out the best mode both sides support from the other side's hello (or its answer to ours)."""
+    if not isinstance(offer, dict):
+        return Capabilities()
+
+    try:
+        version = min(int(offer.get("version", 0)), PROTOCOL_VERSION)
+    except (TypeError, ValueError):
+        version = 0
+
+    features = offer.get("features")
+    features = {feature for feature in features if feature in FEATURES} if isinstance(features, list) else set()
+
+    # the server offers a list of codecs, the client answers with the one it picked
+    compression = offer.get("compression")
+    compression = choose_codec(compression if isinstance(compression, list) else [compression])
+    if compression is None:
+        features.discard("compression")
+    elif "compression" not in features:
+        compression = None
+
+    # same as compression, the server offers the versions it knows and the client answers with one, older peers don't send any
+    compact = offer.get("compact")
+    compact = [version for version in (compact if isinstance(compact, list) else [compact]) if version in COMPACT_VERSIONS]
+    compact = max(compact) if compact and "compact" in features else 0
+
+    # each limit is the smaller of the two sides, except for the batch window which only the sender cares about
+    limits = local_limits(config)
+    remote_limits = offer.get("limits") if isinstance(offer.get("limits"), dict) else {}
+    for name, value in remote_limits.items():
+        if name in limits and name != "batch-window" and isinstance(value, int) and value > 0:
+            limits[name] = min(limits[name], value)
+
+    if not compact:
+        features.discard("compact")
+    if "heartbeat-interval" not in limits:
+        features.discard("heartbeat")
+
+    return Capabilities(version, features, compression, limits, compact)
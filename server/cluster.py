@@ -0,0 +1,103 @@
+"""Run a server as several worker processes on one machine.
+
+Every worker is a normal `Server` with its own event loop and database connection, and they all bind the
+same ports with SO_REUSEPORT so the OS spreads new clients out between them. Broadcasts (like a MESSAGE_RECV)
+are relayed through the parent process (see `server.broker`), so a message sent to one worker reaches clients on all of them.
+
+    python -m server.cluster "My Server" --workers 4
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import threading
+import time
+
+from server.broker import BrokerRelay, SocketBroker
+
+
+def cluster_supported() -> bool:
+    return hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT") and hasattr(socket, "AF_UNIX")
+
+
+def run_worker(worker_id: int, sock: socket.socket, title: str, description: str, log_level: int) -> None:
+    from server.server import Server
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    # ctrl+c goes to the whole process group, the parent tells us when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    server = Server(title, description, log_level=log_level)
+    server.network_format_manager.broker = SocketBroker(sock)
+    server.network_format_manager.worker_id = worker_id
+    server.start()
+    server.log(f"Worker {worker_id} is running (pid {os.getpid()}).")
+
+    stop.wait()
+    server.stop()
+
+
+def run_cluster(title: str, description: str = "", workers: int = None, log_level: int = 2) -> None:
+    from server.server import Server
+
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or not cluster_supported():
+        server = Server(title, description, log_level=log_level, interactive=True)
+        server.start()
+        while server.running:
+            time.sleep(0.5)
+        return
+
+    # create the folders, settings and database here, before forking, so the workers don't race to make them.
+    # the only thread it starts is the database writer, which has finished by the time close returns, so it's safe to fork afterwards
+    setup = Server(title, description, log_level=log_level)
+    setup.db.close()
+    setup.uploads.close()
+
+    worker_socks: list[socket.socket] = []
+    children: list[int] = []
+    for worker_id in range(workers):
+        parent_sock, worker_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            parent_sock.close()
+            for sock in worker_socks:
+                sock.close()
+            try:
+                run_worker(worker_id, worker_sock, title, description, log_level)
+            finally:
+                os._exit(0)
+
+        worker_sock.close()
+        worker_socks.append(parent_sock)
+        children.append(pid)
+
+    # the parent just passes broadcasts between the workers until it's told to stop
+    signal.signal(signal.SIGTERM, lambda signum, frame: signal.raise_signal(signal.SIGINT))
+    try:
+        asyncio.run(BrokerRelay().serve_sockets(worker_socks))
+    except KeyboardInterrupt:
+        pass
+
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a Portal server across several worker processes.")
+    parser.add_argument("title")
+    parser.add_argument("--description", default="")
+    parser.add_argument("--workers", type=int, default=None, help="how many worker processes to run (defaults to the number of cores)")
+    parser.add_argument("--log-level", type=int, default=2)
+    args = parser.parse_args()
+
+    run_cluster(args.title, args.description, args.workers, args.log_level)
@@ -0,0 +1,121 @@
+import threading
+import zlib
+from abc import ABC, abstractmethod
+
+import msgpack
+
+try:
+    import zstandard
+except ImportError: # zstd is optional, zlib is always there
+    zstandard = None
+
+from server.framing import MAX_FRAME_SIZE
+
+
+# compressed packets are sent as a msgpack ext object, so they look the same to every NetworkFormat
+COMPRESSED_EXT = 1
+
+
+class Codec(ABC):
+    name: str = None
+    # the first byte of a compressed payload, so the other side knows how to decompress it
+    id: int = None
+
+    @abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        pass
+
+    @abstractmethod
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        """Decompress a payload, raising ValueError if it would come out bigger than `max_size`."""
+        pass
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+    id = 1
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, 1)
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, max_size)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Compressed packet is too big.")
+        return result
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    id = 2
+
+    def __init__(self):
+        # zstandard's (de)compressors can't be shared between threads
+        self.local = threading.local()
+
+    def compress(self, data: bytes) -> bytes:
+        if not hasattr(self.local, "compressor"):
+            self.local.compressor = zstandard.ZstdCompressor(level=3)
+        return self.local.compressor.compress(data)
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        if not hasattr(self.local, "decompressor"):
+            self.local.decompressor = zstandard.ZstdDecompressor()
+        try:
+            return self.local.decompressor.decompress(data, max_output_size=max_size)
+        except zstandard.ZstdError as e:
+            raise ValueError(str(e))
+
+
+# in order of preference
+CODECS: dict[str, Codec] = {}
+if zstandard is not None:
+    CODECS[ZstdCodec.name] = ZstdCodec()
+CODECS[ZlibCodec.name] = ZlibCodec()
+
+CODECS_BY_ID: dict[int, Codec] = {codec.id: codec for codec in CODECS.values()}
+
+
+def available_codecs() -> list[str]:
+    return list(CODECS)
+
+def choose_codec(offered: list[str]) -> str:
+    """Pick the best codec both sides support, or None if there isn't one."""
+    for name in CODECS:
+        if name in offered:
+            return name
+    return None
+
+def compress_packet(data: bytes, codec: Codec) -> bytes:
+    """Wrap an encoded packet up as a compressed ext object."""
+    return msgpack.packb(msgpack.ExtType(COMPRESSED_EXT, bytes((codec.id,)) + codec.compress(data)))
+
+def decompress_packet(ext: msgpack.ExtType, max_size: int = MAX_FRAME_SIZE) -> bytes:
+    """Get the encoded packet back out of a compressed ext object."""
+    codec = CODECS_BY_ID.get(ext.data[0]) if ext.data else None
+    if codec is None:
+        raise ValueError("Packet was compressed with an unknown codec.")
+    return codec.decompress(memoryview(ext.data)[1:], max_size)
+
+
+class CompressionStats:
+    def __init__(self):
+        self.packets = 0
+        self.compressed_packets = 0
+        # bytes before and after compression, only counting packets that were compressed
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def ratio(self) -> float:
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+
+    def as_dict(self) -> dict:
+        return {
+            "packets": self.packets,
+            "compressed": self.compressed_packets,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "ratio": round(self.ratio, 3)
+        }
@@ -0,0 +1,114 @@
+import os
+from configparser import ConfigParser, NoOptionError, NoSectionError
+
+CONFIG_PATH = "portal_server/server_settings.ini"
+
+DEFAULT_CONFIG = {
+    "Network": {
+        # how many packets can be waiting to be sent to a single client
+        "max-queue": 1024,
+        # how many bytes can be waiting to be sent to a single client
+        "max-queue-bytes": 8 * 1024 * 1024,
+        # what to do with a client that can't keep up: drop-oldest or disconnect
+        "slow-consumer-policy": "drop-oldest",
+        # packets smaller than this (in bytes) are never compressed, it isn't worth it for normal chat messages
+        "compression-threshold": 1024,
+        # how long (in milliseconds) to hold on to a packet so others can be sent in the same write, for clients that support batches
+        "batch-window": 2,
+        # the most bytes of packets to put in a single write
+        "batch-bytes": 64 * 1024,
+        # how often (in seconds) clients that support heartbeats should ping when there's nothing else going on,
+        # ones that go quiet for 3 times this long are disconnected. 0 turns heartbeats off
+        "heartbeat-interval": 15,
+        # how many clients can be connected from the same address at once, 0 for no limit
+        "max-connections-per-ip": 0,
+        # the biggest packet (in bytes, before compression) either side can send on a connection, at most 16MiB.
+        # the smaller of ours and the client's is used, anything over it is answered with an ERROR instead
+        "max-frame-size": 16 * 1024 * 1024
+    },
+    "Websocket": {
+        # the biggest message a websocket client can send us
+        "max-message-size": 16 * 1024 * 1024,
+        # how many received messages can be waiting to be handled before we stop reading from a client
+        "max-queue": 16,
+        # how many bytes can be buffered for a client before sending waits for it to catch up
+        "write-limit": 64 * 1024
+    },
+    "Unix": {
+        # where to listen for clients on the same machine (bots, admin tools), connect with "unix://<path>"
+        "path": "portal_server/portal.sock"
+    },
+    "Broker": {
+        # share broadcasts with other servers running as the same server: none, memory (same process) or tcp
+        "backend": "none",
+        # where the broker process is (python -m server.broker), for the tcp backend
+        "address": "127.0.0.1:5560"
+    },
+    # "<per second>, <burst>" for each packet type, for every connection. "0" to not limit a packet type
+    "RateLimits": {
+        "message-send": "5, 10",
+        "get": "20, 40",
+        "subscribe": "10, 20",
+        "unsubscribe": "10, 20",
+        # each chunk is 64KiB
+        "upload": "200, 400"
+    },
+    # the same, but shared between all of a user's connections
+    "UserRateLimits": {
+        "message-send": "5, 10"
+    },
+    "Load": {
+        # start turning away non-essential requests once this many database jobs are waiting...
+        "high-queue": 64,
+        # ...or the oldest one has been waiting this long (in milliseconds)
+        "high-latency": 500,
+        # and go back to normal once it's down to this many, waiting no longer than this
+        "low-queue": 16,
+        "low-latency": 100,
+        # the GET types that get turned away, everything else (like sending messages) is always handled
+        "shed": "MESSAGES, HISTORY, MEMBERS, INFO"
+    },
+    "Database": {
+        # how sure to be that a write is on the disk before it counts as saved: full (sync every commit),
+        # interval (sync every sync-interval milliseconds) or os (leave it to the OS)
+        "durability": "full",
+        "sync-interval": 1000,
+        # how many threads handle requests that need the database, each reads through its own connection.
+        # python only runs one of them at a time, so more only helps when reads have to wait on the disk
+        # (a database too big to stay cached), otherwise they mostly slow each other (and sending messages) down
+        "read-threads": 1,
+        # channel names and users are kept in memory for this many seconds (0 turns that off), mostly so changes
+        # made by other cluster workers get noticed. changes made by this server are picked up straight away
+        "cache-ttl": 60,
+        # the most users to remember at once
+        "cache-users": 10000
+    },
+    "History": {
+        # how many messages are in a page of history when the client doesn't say, and the most it can ask for
+        "page-size": 50,
+        "max-page-size": 200
+    },
+    "Uploads": {
+        "max-icon-size": 4 * 1024 * 1024,
+        "max-attachment-size": 64 * 1024 * 1024
+    }
+}
+
+def conf_get(config: ConfigParser, section: str, option: str):
+    try: return config.get(section, option)
+    except (NoOptionError, NoSectionError): return DEFAULT_CONFIG[section][option]
+
+def conf_set(config: ConfigParser, section: str, option: str, value: str):
+    if not config.has_section(section):
+        config.add_section(section)
+    config.set(section, option, value)
+
+def load_config(path: str = CONFIG_PATH) -> ConfigParser:
+    """Read the server's settings, writing out the defaults first if there's no settings file yet."""
+    config = ConfigParser()
+    if not os.path.isfile(path):
+        config.read_dict(DEFAULT_CONFIG)
+        with open(path, "w") as config_file:
+            config.write(config_file)
+    config.read(path)
+    return config
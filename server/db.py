@@ -1,18 +1,95 @@
 import sqlite3
+import threading
+from concurrent.futures import Future
+
+from server.config import conf_get
+from server.db_cache import MetadataCache
+from server.db_writer import DatabaseWriter, connect
+
+# changes to the schema, in order. the database remembers how many it's had (PRAGMA user_version),
+# so each one only ever runs once. add new ones to the end, never change one that's already been released
+MIGRATIONS: list[list[str]] = [
+    # 1: indexes for everything that's looked up by something other than its primary key
+    [
+        # history for a channel, in the order it was sent
+        "CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel_id, message_id)",
+        "CREATE INDEX IF NOT EXISTS channels_server_name ON channels (server_id, name)",
+        "CREATE INDEX IF NOT EXISTS servers_name ON servers (name)",
+        "CREATE INDEX IF NOT EXISTS users_username ON users (username)",
+        "CREATE INDEX IF NOT EXISTS roles_name ON roles (name)",
+        # the primary keys start with the user, these are for listing everyone in a server
+        "CREATE INDEX IF NOT EXISTS user_roles_server ON user_roles (server_id, role_id)",
+        "CREATE INDEX IF NOT EXISTS memberships_server ON memberships (server_id, user_uuid)"
+    ],
+    # 2: jumping to a time in a channel's history
+    [
+        "CREATE INDEX IF NOT EXISTS messages_channel_time ON messages (channel_id, timestamp)"
+    ]
+]
 
 
 class Database:
+    """Reads happen straight away on the calling thread (one of the server's database threads).
+    Anything that writes is queued on the `DatabaseWriter` and returns a Future instead, with whatever the method
+    used to return as its result once it's been committed."""
+
     def __init__(self, server, db_path: str = "portal_db.db"):
         self.server = server
 
-        # ! Disabling check_same_thread fixes a lot of issues, but corruption could be a REALLY big problem, might need to check this.
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
-        self.cur = self.conn.cursor()
+        self.db_path = db_path
+        # every thread that reads gets its own read-only connection (see `cur`), so reads from lots of clients can run at once
+        self.__local = threading.local()
+        self.__readers: list[sqlite3.Connection] = []
+        self.__readers_lock = threading.Lock()
+        # channel names and users for the message path. writes that change them drop them from it once they've been
+        # committed (any earlier would let a read from before the commit put the old value back), see `after_commit`
+        self.cache = MetadataCache(
+            self,
+            float(conf_get(self.server.config, "Database", "cache-ttl")),
+            int(conf_get(self.server.config, "Database", "cache-users"))
+        )
+
+        self.writer = DatabaseWriter(
+            db_path,
+            conf_get(self.server.config, "Database", "durability"),
+            int(conf_get(self.server.config, "Database", "sync-interval")) / 1000,
+            self.server.log
+        )
+        self.writer.run(self.__create_tables).result()
+        self.writer.run(self.__migrate).result()
+
+        server_id = self.get_server_by_name(self.server.server_info["title"])
+        if not server_id:
+            server_id = self.create_server(self.server.server_info["title"]).result()
+        else:
+            server_id = server_id[0]
+
+        channel_id = self.get_channel_by_name(server_id, "general")
+        if not channel_id:
+            channel_id = self.create_channel_in_server(server_id, "general")
+
+        if not self.get_role_by_name("DefaultPerms"):
+            self.create_role("DefaultPerms", 0, {})
+
+        # create the system user, no one can have the same UUID
+        if not self.user_exists("00000000-0000-0000-0000-000000000000"):
+            self.create_user("SYSTEM", "00000000-0000-0000-0000-000000000000")
+
+        self.commit()
+
+    def __migrate(self, cur: sqlite3.Cursor) -> None:
+        version = cur.execute("PRAGMA user_version").fetchone()[0]
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            self.server.log(f"Updating the database to version {number}...", 1)
+            for statement in statements:
+                cur.execute(statement)
+            cur.execute(f"PRAGMA user_version = {number}")
 
+    def __create_tables(self, cur: sqlite3.Cursor) -> None:
         # Create a table for servers
         # each server has an ID whcih won't have a duplicate, and it is the key
         # each server has a string name, which can't be null
-        self.cur.execute('''
+        cur.execute('''
         CREATE TABLE IF NOT EXISTS servers (
             server_id INTEGER PRIMARY KEY,
             name TEXT NOT NULL
@@ -22,7 +99,7 @@ class Database:
         # create a table of users
         # each user has a non-duplicate ID which is used as the key
         # each user has a username which can't be null
-        self.cur.execute('''
+        cur.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_uuid TEXT PRIMARY KEY,
             username TEXT NOT NULL
@@ -31,7 +108,7 @@ class Database:
 
         # create a table of memberships for each server
         # each membership links a user id to a server id
-        self.cur.execute('''
+        cur.execute('''
         CREATE TABLE IF NOT EXISTS memberships (
             user_uuid TEXT,
             server_id INTEGER,
@@ -46,7 +123,7 @@ class Database:
         # each channel has a name which can't be null
         # each channel has a server id
         # each channel id references a server id
-        self.cur.execute('''
+        cur.execute('''
         CREATE TABLE IF NOT EXISTS channels (
             channel_id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -63,7 +140,7 @@ class Database:
         # each message has a channel id
         # each message links the user id
         # each message links the channel id
-        self.cur.execute('''
+        cur.execute('''
         CREATE TABLE IF NOT EXISTS messages (
             message_id INTEGER PRIMARY KEY AUTOINCREMENT,
             content TEXT NOT NULL,
@@ -81,7 +158,7 @@ class Database:
         # a name, which is text and can't be null
         # a rank, which tells the role if it is higher or lower than another role
         # and a list of permissions, either being 1 or 0 for True and False
-        self.cur.execute('''
+        cur.execute('''
         CREATE TABLE IF NOT EXISTS roles (
             role_id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -98,7 +175,7 @@ class Database:
         ''')
 
         # create a table of all the roles each user has
-        self.cur.execute('''
+        cur.execute('''
         CREATE TABLE IF NOT EXISTS user_roles (
             user_uuid TEXT,
             role_id INTEGER,
@@ -110,33 +187,34 @@ class Database:
         );
         ''')
 
-        server_id = self.get_server_by_name(self.server.server_info["title"])
-        if not server_id:
-            server_id = self.create_server(self.server.server_info["title"])
-        else:
-            server_id = server_id[0]
-
-        channel_id = self.get_channel_by_name(server_id, "general")
-        if not channel_id:
-            channel_id = self.create_channel_in_server(server_id, "general")
-
-        if not self.get_role_by_name("DefaultPerms"):
-            self.create_role("DefaultPerms", 0, {})
-
-        # create the system user, no one can have the same UUID
-        if not self.user_exists("00000000-0000-0000-0000-000000000000"):
-            self.create_user("SYSTEM", "00000000-0000-0000-0000-000000000000")
-            
-        self.commit()
-
     def commit(self) -> None:
-        self.conn.commit()
+        """Wait until every write queued so far has been committed."""
+        self.writer.flush().result()
 
     def close(self) -> None:
-        self.conn.close()
-
-    def create_role(self, name: str, rank: int, permissions: dict[str, bool]) -> int:
-        self.cur.execute('''
+        self.writer.close()
+        with self.__readers_lock:
+            for conn in self.__readers:
+                conn.close()
+            self.__readers.clear()
+
+    @property
+    def cur(self) -> sqlite3.Cursor:
+        """The calling thread's own read-only cursor. WAL lets these all read at once, even while the writer's committing."""
+        cur = getattr(self.__local, "cur", None)
+        if cur is None:
+            # only ever used by the thread that made it, but closed from whichever thread closes the database
+            conn = connect(self.db_path, read_only=True, check_same_thread=False)
+            with self.__readers_lock:
+                self.__readers.append(conn)
+            cur = self.__local.cur = conn.cursor()
+        return cur
+
+    def create_role(self, name: str, rank: int, permissions: dict[str, bool]) -> Future:
+        return self.writer.run(self.__create_role, name, rank, permissions)
+
+    def __create_role(self, cur: sqlite3.Cursor, name: str, rank: int, permissions: dict[str, bool]) -> int:
+        cur.execute('''
             INSERT INTO roles (name, rank,
                 send_messages, view_message_history, mute_members,
                 kick_members, ban_members, manage_channels, manage_server,
@@ -153,16 +231,17 @@ class Database:
             int(permissions.get("manage_server", 0)),
             int(permissions.get("super_admin", 0))
         ))
-        self.commit()
-        return self.cur.lastrowid
+        return cur.lastrowid
 
-    def assign_role_to_user(self, user_uuid: str, role_id: int, server_id: int) -> None:
-        self.cur.execute('''
+    def assign_role_to_user(self, user_uuid: str, role_id: int, server_id: int) -> Future:
+        return self.writer.run(self.__assign_role_to_user, user_uuid, role_id, server_id)
+
+    def __assign_role_to_user(self, cur: sqlite3.Cursor, user_uuid: str, role_id: int, server_id: int) -> None:
+        cur.execute('''
             INSERT OR IGNORE INTO user_roles (user_uuid, role_id, server_id)
             VALUES (?, ?, ?)
         ''', (user_uuid, role_id, server_id))
         self.server.log(f"Gave {user_uuid} role {role_id} in server {server_id}")
-        self.commit()
 
     def get_roles_for_user_in_server(self, user_uuid: str, server_id: int):
         self.cur.execute('''
@@ -223,8 +302,11 @@ class Database:
 
         return result and result[0] == 1
 
-    def update_username(self, uuid: id, new_username: str) -> None:
-        self.cur.execute("""
+    def update_username(self, uuid: id, new_username: str) -> Future:
+        return self.writer.run(self.__update_username, uuid, new_username, after_commit=lambda: self.cache.invalidate_user(uuid))
+
+    def __update_username(self, cur: sqlite3.Cursor, uuid: str, new_username: str) -> None:
+        cur.execute("""
             UPDATE users SET username = ?
             WHERE user_uuid = ?
         """, (new_username, uuid))
@@ -265,13 +347,14 @@ class Database:
         """, (uuid,))
         return self.cur.fetchone()
 
-    def get_server_by_name(self, server_name: str):
-        self.cur.execute("""
+    def get_server_by_name(self, server_name: str, cur: sqlite3.Cursor = None):
+        cur = cur or self.cur
+        cur.execute("""
             SELECT server_id, name FROM servers
             WHERE name = ?
             LIMIT 1
         """, (server_name,))
-        return self.cur.fetchone()
+        return cur.fetchone()
 
     def get_channels_in_server(self, server_id: int):
         self.cur.execute("""
@@ -295,17 +378,84 @@ class Database:
             FROM messages m
             LEFT JOIN users u ON m.user_uuid = u.user_uuid
             WHERE m.channel_id = ?
-            ORDER BY m.timestamp ASC
+            ORDER BY m.message_id ASC
         """, (channel_id,))
         return self.cur.fetchall()
     
-    def get_channel_by_name(self, server_id: int, channel_name: str):
+    def get_message_page(self, channel_id: int, before: int = None, after: int = None, limit: int = 50) -> tuple[list, int, int]:
+        """One page of a channel's history, oldest first: the `limit` messages just before the message id `before`,
+        just after `after`, or the latest ones if neither is given.
+
+        Also returns the cursors for the pages either side, the id to pass as `before` to get older messages and as
+        `after` to get newer ones, each None if there aren't any. Every page is found by seeking the
+        (channel_id, message_id) index, so it's just as quick at the start of a long history as at the end."""
+        if after is not None:
+            self.cur.execute("""
+                SELECT m.message_id, m.content, m.timestamp, u.username
+                FROM messages m
+                LEFT JOIN users u ON m.user_uuid = u.user_uuid
+                WHERE m.channel_id = ? AND m.message_id > ?
+                ORDER BY m.message_id ASC
+                LIMIT ?
+            """, (channel_id, after, limit + 1))
+            messages = self.cur.fetchall()
+            newer = messages[limit - 1][0] if len(messages) > limit else None
+            messages = messages[:limit]
+            older = messages[0][0] if messages and self.__has_message(channel_id, "<", messages[0][0]) else None
+            return messages, older, newer
+
+        if before is not None:
+            self.cur.execute("""
+                SELECT m.message_id, m.content, m.timestamp, u.username
+                FROM messages m
+                LEFT JOIN users u ON m.user_uuid = u.user_uuid
+                WHERE m.channel_id = ? AND m.message_id < ?
+                ORDER BY m.message_id DESC
+                LIMIT ?
+            """, (channel_id, before, limit + 1))
+        else:
+            self.cur.execute("""
+                SELECT m.message_id, m.content, m.timestamp, u.username
+                FROM messages m
+                LEFT JOIN users u ON m.user_uuid = u.user_uuid
+                WHERE m.channel_id = ?
+                ORDER BY m.message_id DESC
+                LIMIT ?
+            """, (channel_id, limit + 1))
+        messages = self.cur.fetchall()
+        older = messages[limit - 1][0] if len(messages) > limit else None
+        messages = messages[:limit][::-1]
+        newer = messages[-1][0] if messages and before is not None and self.__has_message(channel_id, ">", messages[-1][0]) else None
+        return messages, older, newer
+
+    def __has_message(self, channel_id: int, direction: str, message_id: int) -> bool:
+        """Whether the channel has any messages before ("<") or after (">") a message."""
+        self.cur.execute(f"""
+            SELECT 1 FROM messages
+            WHERE channel_id = ? AND message_id {'<' if direction == '<' else '>'} ?
+            LIMIT 1
+        """, (channel_id, message_id))
+        return self.cur.fetchone() is not None
+
+    def get_message_at(self, channel_id: int, timestamp: str):
+        """The id of the first message sent in a channel at or after a time ("YYYY-MM-DD HH:MM:SS" in UTC), None if there isn't one."""
         self.cur.execute("""
+            SELECT message_id FROM messages
+            WHERE channel_id = ? AND timestamp >= ?
+            ORDER BY timestamp ASC, message_id ASC
+            LIMIT 1
+        """, (channel_id, timestamp))
+        result = self.cur.fetchone()
+        return result[0] if result else None
+
+    def get_channel_by_name(self, server_id: int, channel_name: str, cur: sqlite3.Cursor = None):
+        cur = cur or self.cur
+        cur.execute("""
             SELECT * FROM channels
             WHERE server_id = ? AND name = ?
             LIMIT 1
         """, (server_id, channel_name))
-        return self.cur.fetchone()
+        return cur.fetchone()
     
     def get_channel(self, server_id: int, channel_id: int):
         self.cur.execute("""
@@ -315,79 +465,106 @@ class Database:
         """, (server_id, channel_id))
         return self.cur.fetchone()
     
-    def create_channel_in_server(self, server_id: int, channel_name: str):
-        if self.get_channel_by_name(server_id, channel_name):
+    def create_channel_in_server(self, server_id: int, channel_name: str) -> Future:
+        return self.writer.run(self.__create_channel_in_server, server_id, channel_name, after_commit=self.cache.invalidate_channel)
+
+    def __create_channel_in_server(self, cur: sqlite3.Cursor, server_id: int, channel_name: str):
+        if self.get_channel_by_name(server_id, channel_name, cur):
             return
 
         # Check if the server exists
-        self.cur.execute("SELECT 1 FROM servers WHERE server_id = ? LIMIT 1", (server_id,))
-        if self.cur.fetchone() is None:
+        cur.execute("SELECT 1 FROM servers WHERE server_id = ? LIMIT 1", (server_id,))
+        if cur.fetchone() is None:
             raise ValueError(f"Server ID {server_id} does not exist.")
 
         # Insert the new channel
-        self.cur.execute("""
+        cur.execute("""
             INSERT INTO channels (name, server_id)
             VALUES (?, ?)
         """, (channel_name, server_id))
-        self.commit()
 
-        return self.cur.lastrowid  # Return the new channel's ID
+        return cur.lastrowid  # Return the new channel's ID
     
-    def create_message_in_channel(self, channel_id: int, user_uuid: str, user_name: str, content: str):
-        # Check if the channel exists
-        self.cur.execute("SELECT 1 FROM channels WHERE channel_id = ? LIMIT 1", (channel_id,))
-        if self.cur.fetchone() is None:
-            raise ValueError(f"Channel ID {channel_id} does not exist.")
+    def create_message_in_channel(self, channel_id: int, user_uuid: str, user_name: str, content: str, checked: bool = False) -> Future:
+        """`checked` skips making sure the channel and user exist, for callers that already know they do (from the cache)."""
+        return self.writer.run(self.__create_message_in_channel, channel_id, user_uuid, user_name, content, checked)
+
+    def __create_message_in_channel(self, cur: sqlite3.Cursor, channel_id: int, user_uuid: str, user_name: str, content: str, checked: bool = False):
+        if not checked:
+            # Check if the channel exists
+            cur.execute("SELECT 1 FROM channels WHERE channel_id = ? LIMIT 1", (channel_id,))
+            if cur.fetchone() is None:
+                raise ValueError(f"Channel ID {channel_id} does not exist.")
 
-        # Optional: check if user exists (or let NULL be inserted)
-        self.cur.execute("SELECT 1 FROM users WHERE user_uuid = ? LIMIT 1", (user_uuid,))
-        if self.cur.fetchone() is None:
-            raise ValueError(f"User UUID {user_uuid} does not exist.")
+            # Optional: check if user exists (or let NULL be inserted)
+            if not self.user_exists(user_uuid, cur):
+                raise ValueError(f"User UUID {user_uuid} does not exist.")
 
         # Insert the message
-        self.cur.execute("""
+        cur.execute("""
             INSERT INTO messages (content, user_uuid, user_name, channel_id)
             VALUES (?, ?, ?, ?)
         """, (content, user_uuid, user_name, channel_id))
-        self.commit()
 
-        return self.cur.lastrowid  # Return the new message's ID
+        return cur.lastrowid  # Return the new message's ID
 
-    def create_server(self, server_name: str):
-        if self.get_server_by_name(server_name):
+    def create_server(self, server_name: str) -> Future:
+        return self.writer.run(self.__create_server, server_name)
+
+    def __create_server(self, cur: sqlite3.Cursor, server_name: str):
+        if self.get_server_by_name(server_name, cur):
             raise ValueError("Server with that name already exists!")
 
-        self.cur.execute("INSERT INTO servers (name) VALUES (?)", (server_name,))
-        server_id = self.cur.lastrowid
-        self.commit()
-        return server_id
+        cur.execute("INSERT INTO servers (name) VALUES (?)", (server_name,))
+        return cur.lastrowid
     
-    def create_user(self, user_name: str, uuid: str):
-        if self.user_exists(uuid):
+    def create_user(self, user_name: str, uuid: str) -> Future:
+        return self.writer.run(self.__create_user, user_name, uuid, after_commit=lambda: self.cache.invalidate_user(uuid))
+
+    def __create_user(self, cur: sqlite3.Cursor, user_name: str, uuid: str):
+        if self.user_exists(uuid, cur):
             raise ValueError(f"A user with the name \"{user_name}\" already exists!")
         self.server.log(f"Creating user \"{user_name}\" with UUID \"{uuid}\"", 1)
 
-        self.cur.execute("INSERT INTO users (user_uuid, username) VALUES (?, ?)", (uuid,user_name))
-        user_uuid = self.cur.lastrowid
-        self.commit()
-        self.add_user_to_server(uuid, 1)
+        cur.execute("INSERT INTO users (user_uuid, username) VALUES (?, ?)", (uuid,user_name))
+        user_uuid = cur.lastrowid
+        self.__add_user_to_server(cur, uuid, 1)
         return user_uuid
+
+    def ensure_user(self, user_name: str, uuid: str) -> Future:
+        """Create the user if they don't exist yet, or update their name if they've changed it.
+        Done as one write, so it's right even if the last message they sent hasn't been committed yet."""
+        return self.writer.run(self.__ensure_user, user_name, uuid, after_commit=lambda: self.cache.invalidate_user(uuid))
+
+    def __ensure_user(self, cur: sqlite3.Cursor, user_name: str, uuid: str) -> None:
+        cur.execute("SELECT username FROM users WHERE user_uuid = ? LIMIT 1", (uuid,))
+        user = cur.fetchone()
+        if user is None:
+            self.server.log(f"Creating user because doesn't exist: {uuid}")
+            self.__create_user(cur, user_name, uuid)
+        elif user[0] != user_name: # user has changed their username since their last msg
+            self.__update_username(cur, uuid, user_name)
+            self.server.log(f"Updated username for {uuid} from {user[0]} to {user_name}")
     
-    def add_user_to_server(self, user_uuid: str, server_id: int):
-        if self.is_user_in_server(user_uuid, server_id):
+    def add_user_to_server(self, user_uuid: str, server_id: int) -> Future:
+        return self.writer.run(self.__add_user_to_server, user_uuid, server_id)
+
+    def __add_user_to_server(self, cur: sqlite3.Cursor, user_uuid: str, server_id: int):
+        if self.is_user_in_server(user_uuid, server_id, cur):
             raise ValueError("User is already in that server!")
         self.server.log(f"Adding user {user_uuid} to server {server_id}.", 1)
 
         memberships = [
             (user_uuid, server_id)
         ]
-        result = self.cur.executemany("INSERT INTO memberships (user_uuid, server_id) VALUES (?, ?)", memberships)
-        self.assign_role_to_user(user_uuid, 1, server_id)
-        return result
+        result = cur.executemany("INSERT INTO memberships (user_uuid, server_id) VALUES (?, ?)", memberships)
+        self.__assign_role_to_user(cur, user_uuid, 1, server_id)
+        return result.rowcount
 
-    def user_exists(self, user_uuid: str):
-        self.cur.execute("SELECT 1 FROM users WHERE user_uuid = ? LIMIT 1", (user_uuid,))
-        return self.cur.fetchone() is not None
+    def user_exists(self, user_uuid: str, cur: sqlite3.Cursor = None):
+        cur = cur or self.cur
+        cur.execute("SELECT 1 FROM users WHERE user_uuid = ? LIMIT 1", (user_uuid,))
+        return cur.fetchone() is not None
 
     def user_exists_by_name(self, username: str):
         self.cur.execute("SELECT 1 FROM users WHERE username = ? LIMIT 1", (username,))
@@ -401,13 +578,14 @@ class Database:
         self.cur.execute("SELECT 1 FROM servers WHERE name = ? LIMIT 1", (name,))
         return self.cur.fetchone() is not None
 
-    def is_user_in_server(self, user_uuid: str, server_id: int):
-        self.cur.execute("""
+    def is_user_in_server(self, user_uuid: str, server_id: int, cur: sqlite3.Cursor = None):
+        cur = cur or self.cur
+        cur.execute("""
             SELECT 1 FROM memberships
             WHERE user_uuid = ? AND server_id = ?
             LIMIT 1
         """, (user_uuid, server_id))
-        return self.cur.fetchone() is not None
+        return cur.fetchone() is not None
 
     def users_in_server(self, server_name: str):
         self.cur.execute("""
@@ -0,0 +1,119 @@
+"""Channel and user details the server needs for every message (a channel's name and server, who a user is),
+kept in memory so sending a message doesn't have to look them all up in the database again.
+
+They hardly ever change, and the `Database` methods that change them drop them from the cache once the write has been
+committed. Entries also expire after a while, for changes the cache can't see (another worker process in a cluster).
+"""
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class MetadataCache:
+    def __init__(self, db, ttl: float = 60.0, max_users: int = 10000):
+        self.db = db
+        # how long entries are trusted for, in seconds. 0 turns the cache off
+        self.ttl = ttl
+        self.max_users = max_users
+
+        self.__lock = threading.Lock()
+        # channel_id -> (expires, name, server row)
+        self.__channels: dict[int, tuple[float, str, tuple]] = {}
+        # user_uuid -> (expires, user row), least recently used first
+        self.__users: OrderedDict[str, tuple[float, tuple]] = OrderedDict()
+        # goes up with every invalidation, so a lookup that read the database before a write was committed
+        # doesn't put the old value back after it's been invalidated
+        self.__generation = 0
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def channel(self, channel_id: int) -> tuple[str, tuple] | None:
+        """The channel's name and the row of the server it's in, or None if it doesn't exist."""
+        with self.__lock:
+            entry = self.__channels.get(channel_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+            generation = self.__generation
+
+        name = self.db.get_channel_name_by_id(channel_id)
+        server = self.db.get_server_from_channel(channel_id)
+        # channels that don't exist aren't remembered, they might be about to be created
+        if name is None or server is None:
+            return None
+
+        with self.__lock:
+            if self.ttl > 0 and generation == self.__generation:
+                self.__channels[channel_id] = (time.monotonic() + self.ttl, name, server)
+        return name, server
+
+    def channel_name(self, channel_id: int) -> str | None:
+        channel = self.channel(channel_id)
+        return channel[0] if channel else None
+
+    def channel_server(self, channel_id: int) -> tuple | None:
+        channel = self.channel(channel_id)
+        return channel[1] if channel else None
+
+    def user(self, user_uuid: str) -> tuple | None:
+        """The user's row (user_uuid, username), or None if they don't exist."""
+        with self.__lock:
+            entry = self.__users.get(user_uuid)
+            if entry is not None and entry[0] > time.monotonic():
+                self.__users.move_to_end(user_uuid)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.__generation
+
+        user = self.db.get_user(user_uuid)
+        if user is None:
+            return None
+
+        with self.__lock:
+            if self.ttl > 0 and generation == self.__generation:
+                self.__users[user_uuid] = (time.monotonic() + self.ttl, user)
+                self.__users.move_to_end(user_uuid)
+                while len(self.__users) > self.max_users:
+                    self.__users.popitem(last=False)
+        return user
+
+    def invalidate_channel(self, channel_id: int = None) -> None:
+        """Forget a channel, or every channel if no id is given."""
+        with self.__lock:
+            self.__generation += 1
+            self.invalidations += 1
+            if channel_id is None:
+                self.__channels.clear()
+            else:
+                self.__channels.pop(channel_id, None)
+
+    def invalidate_user(self, user_uuid: str) -> None:
+        with self.__lock:
+            self.__generation += 1
+            self.invalidations += 1
+            self.__users.pop(user_uuid, None)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__generation += 1
+            self.__channels.clear()
+            self.__users.clear()
+
+    def stats(self) -> dict:
+        with self.__lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups * 100, 1) if lookups else 0.0,
+                "channels": len(self.__channels),
+                "users": len(self.__users),
+                "invalidations": self.invalidations
+            }
@@ -0,0 +1,219 @@
+"""Every write to the database goes through one thread with its own connection, so writes from lots of clients
+can share a commit (and the fsync that comes with it) instead of each paying for their own.
+
+Writes are queued as jobs, functions that get the writer's cursor. Whatever's queued when the writer gets round to it
+goes into one transaction, with each job in its own savepoint so one failing doesn't undo the others.
+Every job gets a future that's finished once the transaction it was in has been committed.
+
+How hard the writer tries to make sure a commit has really hit the disk is the durability setting:
+    - full: fsync every commit. Nothing that's been acknowledged is lost, even if the machine loses power
+    - interval: commits aren't synced on their own, the database is synced every `sync-interval` milliseconds instead.
+      A crash of the server is fine, a power cut can lose the last moments of writes
+    - os: never sync, leave it to the OS. The fastest, but a power cut can lose a lot more
+"""
+from __future__ import annotations
+
+import pathlib
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable
+
+DURABILITY = {
+    # durability -> PRAGMA synchronous for the writer's connection (in WAL mode, NORMAL only syncs on checkpoints)
+    "full": "FULL",
+    "interval": "NORMAL",
+    "os": "OFF"
+}
+
+
+def connect(db_path: str, read_only: bool = False, **kwargs) -> sqlite3.Connection:
+    """Open the database in WAL mode, so reads can go on while the writer is committing.
+    The writer has to have opened it first for read only connections, they can't switch it to WAL themselves."""
+    if read_only:
+        conn = sqlite3.connect(f"{pathlib.Path(db_path).resolve().as_uri()}?mode=ro", uri=True, **kwargs)
+    else:
+        conn = sqlite3.connect(db_path, **kwargs)
+
+    # other processes (cluster workers) can be writing too, wait for them rather than failing straight away
+    conn.execute("PRAGMA busy_timeout = 5000")
+    if not read_only:
+        conn.execute("PRAGMA journal_mode = WAL")
+    return conn
+
+
+class DatabaseWriter:
+    # the most jobs to put in one transaction, so a flood of writes still gets committed every now and then
+    max_batch: int = 512
+
+    def __init__(self, db_path: str, durability: str = "full", sync_interval: float = 1.0, log: Callable[[str, int], None] = None):
+        if durability not in DURABILITY:
+            raise ValueError(f"Unknown durability \"{durability}\", it should be one of {', '.join(DURABILITY)}.")
+
+        self.db_path = db_path
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self.log = log
+        self.closed = False
+
+        self.__jobs: queue.SimpleQueue[tuple | None] = queue.SimpleQueue()
+        self.__thread = threading.Thread(target=self.__run, name="portal-db-writer", daemon=True)
+        self.__opened: Future = Future()
+
+        # stats
+        self.batches = 0
+        self.jobs = 0
+        self.failed = 0
+        self.biggest_batch = 0
+        self.commit_time = 0.0
+        self.syncs = 0
+
+        self.__thread.start()
+        # so a database that can't be opened fails here and not on the first write
+        self.__opened.result()
+
+    def run(self, function: Callable, *args, after_commit: Callable[[], None] = None) -> Future:
+        """Queue `function(cursor, *args)` to run on the writer. The future gets its result once it's been committed.
+        `after_commit` is called once the transaction's over (whether it worked or not), before anyone waiting on the future is woken up."""
+        if self.closed:
+            raise RuntimeError("The database writer is closed.")
+
+        future = Future()
+        self.__jobs.put((function, args, future, after_commit))
+        return future
+
+    def flush(self) -> Future:
+        """A future that's finished once everything queued before it has been committed."""
+        return self.run(lambda cur: None)
+
+    def close(self) -> None:
+        """Commit everything that's still queued, then stop."""
+        if self.closed: return
+
+        self.closed = True
+        self.__jobs.put(None)
+        self.__thread.join()
+
+    def __run(self) -> None:
+        try:
+            conn = connect(self.db_path, isolation_level=None) # transactions are started and committed by hand
+            conn.execute(f"PRAGMA synchronous = {DURABILITY[self.durability]}")
+        except Exception as e:
+            self.__opened.set_exception(e)
+            return
+        self.__opened.set_result(None)
+
+        cur = conn.cursor()
+        # with the interval durability, whether there's anything that hasn't been synced yet and when it was committed
+        unsynced_since = None
+        running = True
+        while running:
+            timeout = None
+            if unsynced_since is not None:
+                timeout = max(0.0, unsynced_since + self.sync_interval - time.monotonic())
+
+            try:
+                job = self.__jobs.get(timeout=timeout)
+            except queue.Empty:
+                self.__sync(cur)
+                unsynced_since = None
+                continue
+
+            # take everything else that's waiting too
+            batch = []
+            while job is not None:
+                batch.append(job)
+                if len(batch) >= self.max_batch:
+                    break
+                try:
+                    job = self.__jobs.get_nowait()
+                except queue.Empty:
+                    break
+            if job is None:
+                running = False
+
+            if batch:
+                self.__commit(cur, batch)
+                if self.durability == "interval" and unsynced_since is None:
+                    unsynced_since = time.monotonic()
+
+        if unsynced_since is not None:
+            self.__sync(cur)
+        # lets sqlite refresh whatever statistics the query planner is missing, it's recommended before closing
+        try:
+            cur.execute("PRAGMA optimize")
+        except sqlite3.Error:
+            pass
+        conn.close()
+
+    def __commit(self, cur: sqlite3.Cursor, batch: list[tuple]) -> None:
+        started = time.perf_counter()
+        results = []
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            for function, args, future, after_commit in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                cur.execute("SAVEPOINT job")
+                try:
+                    result = function(cur, *args)
+                except Exception as e:
+                    cur.execute("ROLLBACK TO job")
+                    results.append((future, None, e))
+                else:
+                    results.append((future, result, None))
+                cur.execute("RELEASE job")
+            cur.execute("COMMIT")
+        except sqlite3.Error as e:
+            # the whole transaction's gone, so everything in it failed
+            if cur.connection.in_transaction:
+                cur.execute("ROLLBACK")
+            if self.log is not None:
+                self.log(f"Failed to commit {len(batch)} writes to the database: {e}", 3)
+
+            results = [(future, None, e) for function, args, future, after_commit in batch if not future.done()]
+
+        self.batches += 1
+        self.jobs += len(batch)
+        self.biggest_batch = max(self.biggest_batch, len(batch))
+        self.commit_time += time.perf_counter() - started
+
+        for function, args, future, after_commit in batch:
+            if after_commit is None: continue
+            try:
+                after_commit()
+            except Exception as e:
+                if self.log is not None:
+                    self.log(f"Error after committing a write to the database: {e!r}", 3)
+
+        for future, result, error in results:
+            if error is not None:
+                self.failed += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def __sync(self, cur: sqlite3.Cursor) -> None:
+        """Get everything committed so far onto the disk, for the interval durability."""
+        try:
+            # a checkpoint syncs the WAL before copying it into the database
+            cur.execute("PRAGMA wal_checkpoint(PASSIVE)")
+            self.syncs += 1
+        except sqlite3.Error as e:
+            if self.log is not None:
+                self.log(f"Failed to sync the database: {e}", 3)
+
+    def stats(self) -> dict:
+        return {
+            "durability": self.durability,
+            "jobs": self.jobs,
+            "batches": self.batches,
+            "jobs_per_batch": round(self.jobs / self.batches, 1) if self.batches else 0.0,
+            "biggest_batch": self.biggest_batch,
+            "avg_commit_ms": round(self.commit_time / self.batches * 1000, 2) if self.batches else 0.0,
+            "failed": self.failed,
+            "syncs": self.syncs
+        }
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import queue
+from typing import Any
+
+import server.formats.network_format
+from server.packet import Packet, as_received, to_packets
+
+class LoopbackConnection(server.formats.network_format.NetworkConnection):
+    """A client running in the same process as the server (the host's own TUI).
+
+    Packets are handed over as objects through a pair of in-memory queues, so nothing is ever encoded,
+    framed or written to a socket. The other end is `server.async_network.AsyncLoopbackNetwork`."""
+    wants_bytes = False
+
+    # server -> client, these can be called from any thread like `send` can
+    def send_packet(self, packet: Packet, encoded: bytes = None) -> None:
+        if self.closed: return
+        self.__deliver(as_received(packet, self.capabilities.supports("timestamps")))
+
+    def send(self, message: bytes, channel: tuple = None, reply: bool = False) -> None:
+        # something already encoded the packet, so there's no getting out of decoding it
+        if self.closed: return
+        for packet in to_packets(message):
+            self.__deliver(packet)
+
+    def __deliver(self, packet: Packet) -> None:
+        self.__put(packet)
+        self.sent += 1
+        self.peak_queue_depth = max(self.peak_queue_depth, self.outbox.qsize())
+
+    def __put(self, item: Packet | None) -> None:
+        # same idea as the outbound queue for network clients, a client that stops reading can't use up all our memory
+        while True:
+            try:
+                self.outbox.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.outbox.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    async def write(self, message: bytes) -> None:
+        self.send(message)
+
+    # client -> server
+    def deliver_to_server(self, packet: Packet) -> None:
+        """Called from the client's thread."""
+        self.loop.call_soon_threadsafe(self.__inbox.put_nowait, as_received(packet, self.capabilities.supports("timestamps")))
+
+    def disconnect(self) -> None:
+        """Called from the client's thread when it goes away."""
+        self.loop.call_soon_threadsafe(self.__inbox.put_nowait, EOFError("The client closed the connection."))
+
+    async def recv(self) -> Packet:
+        packet = await self.__inbox.get()
+        if isinstance(packet, Exception):
+            raise packet
+        return packet
+
+    async def close(self) -> None:
+        if self.closed: return
+        await super().close()
+
+        # tells the client the server has gone
+        self.__put(None)
+
+    @property
+    def queue_depth(self) -> int:
+        return self.outbox.qsize()
+
+    def getsockname(self) -> Any:
+        return self.addr
+
+    def __init__(self, loopback: Loopback, number: int):
+        self.addr = ("loopback", number)
+        self.__inbox: asyncio.Queue[Packet | Exception] = asyncio.Queue()
+        super().__init__(loopback)
+        # the client reads this from its own thread, so it's a normal thread safe queue
+        self.outbox: queue.Queue[Packet | None] = queue.Queue(self.max_queue)
+
+class Loopback(server.formats.network_format.NetworkFormat):
+    """Lets a client in the same process connect without going through the network stack."""
+    __numbers = itertools.count(1)
+
+    def connect(self) -> LoopbackConnection:
+        """Start a new session with the server. Can be called from any thread."""
+        if not self.running:
+            raise ConnectionRefusedError("The server isn't running.")
+
+        self.network_functions.log("Loopback", "Accepting connection...")
+        connection = LoopbackConnection(self, next(self.__numbers))
+        asyncio.run_coroutine_threadsafe(self.serve_connection(connection), self.loop)
+        return connection
+
+    async def open(self) -> None:
+        if self.running: return
+        await super().open()
+        self.running = True
+
+    async def close(self) -> None:
+        if not self.running: return
+
+        self.running = False
+        await super().close()
+
+    def __init__(self):
+        super().__init__()
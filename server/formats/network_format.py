@@ -1,28 +1,321 @@
+from __future__ import annotations
+
+import asyncio
+import time
 from abc import abstractmethod
-from typing import Callable, Any
+from collections import deque
+from configparser import ConfigParser
+from enum import Enum
+from typing import Callable, Any, Awaitable
+
+from server.capabilities import Capabilities, local_limits
+from server.config import conf_get
+from server.compression import CODECS, Codec, CompressionStats, compress_packet
+from server.packet import Packet, PacketType, compact_channel, pack_batch, to_bytes
+
+
+def on_loop_thread(loop: asyncio.AbstractEventLoop) -> bool:
+    """Returns True if the caller is running inside `loop`."""
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+class SlowConsumerPolicy(Enum):
+    """What to do when a client's outbound queue is full."""
+    # throw away the oldest queued push to make room, replies to a request (ones with a tag) are never thrown away
+    DROP_OLDEST = "drop-oldest"
+    # the client is too slow to be worth keeping, so kick it
+    DISCONNECT = "disconnect"
 
 
 class NetworkConnection:
+    """A single client connection.
+
+    Everything except `send`/`sendall`/`send_packet` must be awaited on the event loop owned by the NetworkFormatManager.
+    `send` can be called from any thread (the database threads, command handlers, etc.) and never blocks:
+    messages go into a bounded outbound queue which is drained by the connection's own writer task,
+    so one slow client can't hold up anyone else."""
     addr: Any = None
+    loop: asyncio.AbstractEventLoop = None
+    closed: bool = False
+    # the channels this client is watching, None if it has never subscribed (older clients get everything)
+    subscriptions: set[int] = None
+    user_name: str = None
+    user_uuid: str = None
+    # False for connections that are handed Packet objects directly, so broadcasts don't have to encode anything for them
+    wants_bytes: bool = True
 
-    @abstractmethod
-    def sendall(self, message: bytes):
-        pass
+    def __init__(self, network_format: NetworkFormat):
+        self.network_format = network_format
+        self.loop = network_format.loop
+        self.closed = False
+        self.subscriptions = None
+
+        config = network_format.config
+        self.max_queue = int(conf_get(config, "Network", "max-queue"))
+        self.max_queue_bytes = int(conf_get(config, "Network", "max-queue-bytes"))
+        self.slow_consumer_policy = SlowConsumerPolicy(conf_get(config, "Network", "slow-consumer-policy"))
+        self.compression_threshold = int(conf_get(config, "Network", "compression-threshold"))
+        # set once the client has said which codec it wants, until then nothing is compressed
+        self.compression: Codec = None
+        self.compression_stats = CompressionStats()
+        self.batch_window = int(conf_get(config, "Network", "batch-window")) / 1000
+        self.batch_bytes = int(conf_get(config, "Network", "batch-bytes"))
+        # set once the client says it can unpack batch frames
+        self.batching = False
+        # what the client agreed to in the handshake, older clients never answer it
+        self.capabilities = Capabilities()
+        # the biggest packet we'll take from the client or send to it, lowered to the client's own limit in the handshake
+        self.max_frame_size = local_limits(config)["max-frame-size"]
+        # when we last got a packet from the client (time.monotonic), to spot ones that have gone without saying
+        self.last_received = time.monotonic()
+
+        # each entry is (message, channel, reply). channel is the channel ref the message uses if it's in the
+        # compact schema (see `compact_channel`), reply is True if a client is waiting on it so it mustn't be dropped
+        self.outbound: deque[tuple] = deque()
+        self.queued_bytes = 0
+        self.__ready = asyncio.Event()
+        self.__writer: asyncio.Task = None
+        self.__kick: asyncio.Task = None
+        # whether the last write had more than one packet in it, which means more are probably on the way
+        self.__bursting = False
+        # the channel refs this client has been told about
+        # what each channel ref was last defined as on this connection, a rename means defining it again
+        self.__defined_channels: dict[int, tuple] = {}
+
+        # stats
+        self.peak_queue_depth = 0
+        self.sent = 0
+        self.writes = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+        # packets the server refused to handle because the client was sending too many
+        self.throttled = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.outbound)
+
+    def queue_stats(self) -> dict:
+        return {
+            "addr": self.addr,
+            "depth": self.queue_depth,
+            "bytes": self.queued_bytes,
+            "peak": self.peak_queue_depth,
+            "sent": self.sent,
+            "writes": self.writes,
+            "packets_per_write": round(self.sent / self.writes, 2) if self.writes else 0.0,
+            "bytes_per_packet": round(self.bytes_sent / self.sent, 1) if self.sent else 0.0,
+            "compact": self.capabilities.compact,
+            "dropped": self.dropped,
+            "throttled": self.throttled,
+            "policy": self.slow_consumer_policy.value,
+            "protocol": self.capabilities.version,
+            "compression": self.compression.name if self.compression else None,
+            **{f"compression_{key}": value for key, value in self.compression_stats.as_dict().items()}
+        }
+
+    def set_compression(self, codec_name: str) -> bool:
+        """Start compressing big packets with a codec the client asked for. Returns False if we don't have it."""
+        codec = CODECS.get(codec_name)
+        if codec is None:
+            return False
+        self.compression = codec
+        return True
+
+    def use_capabilities(self, capabilities: Capabilities) -> None:
+        """Switch the connection over to whatever was agreed in the handshake."""
+        self.capabilities = capabilities
+        if capabilities.compression:
+            self.set_compression(capabilities.compression)
+        self.batching = capabilities.supports("batching")
+        self.batch_bytes = capabilities.limit("batch-bytes", self.batch_bytes)
+        self.max_frame_size = capabilities.limit("max-frame-size", self.max_frame_size)
+
+    async def __compress(self, message: bytes) -> bytes:
+        stats = self.compression_stats
+        stats.packets += 1
+        if self.compression is None or len(message) < self.compression_threshold:
+            return message
+
+        # really big packets (whole message histories) get compressed off the event loop, zlib and zstd let go of the GIL
+        if len(message) > 256 * 1024:
+            compressed = await self.loop.run_in_executor(None, compress_packet, message, self.compression)
+        else:
+            compressed = compress_packet(message, self.compression)
+
+        if len(compressed) >= len(message): # it didn't help, so don't make the client decompress it
+            return message
+
+        stats.compressed_packets += 1
+        stats.bytes_in += len(message)
+        stats.bytes_out += len(compressed)
+        return compressed
+
+    def send(self, message: bytes, channel: tuple = None, reply: bool = False) -> None:
+        """Queue a message to be written to the client.
+
+        :parameter channel: The (ref, server_ip, channel_id, channel_name) a compact message uses,
+            the client is told what it means just before the first message that needs it goes out.
+        :parameter reply: The message answers a request the client is waiting on, so it's never dropped to make room."""
+        if self.closed: return
+
+        if on_loop_thread(self.loop):
+            self.__enqueue(message, channel, reply)
+        else:
+            self.loop.call_soon_threadsafe(self.__enqueue, message, channel, reply)
+
+    def sendall(self, message: bytes) -> None:
+        self.send(message)
+
+    def send_packet(self, packet: Packet, encoded: bytes = None) -> None:
+        """Queue a packet to be written to the client, encoding it unless `encoded` already has its bytes."""
+        compact = self.capabilities.compact
+        if encoded is None:
+            encoded = to_bytes(packet, self.capabilities.supports("timestamps"), compact)
+
+        # the client would throw it away (and the connection with it), so tell them what happened instead
+        if len(encoded) > self.max_frame_size:
+            self.network_format.network_functions.log(type(self.network_format).__name__, f"Not sending a {packet.packet_type.name} of {len(encoded)} bytes to {self.addr}, it's over their limit of {self.max_frame_size} bytes.")
+            packet = Packet(PacketType.ERROR, "The reply was too big to send.", tag=packet.tag)
+            encoded = to_bytes(packet, compact=compact)
+
+        self.send(encoded, compact_channel(packet) if compact else None, packet.tag is not None)
+
+    def send_greeting(self, packet: Packet) -> None:
+        """Send the server's CONNECTION_STARTED, the first thing a client gets. Formats that frame packets
+        send it unframed, so clients from before framing can read it too (see `server.framing`)."""
+        self.send_packet(packet)
+
+    def __pop(self) -> tuple:
+        entry = self.outbound.popleft()
+        self.queued_bytes -= len(entry[0])
+        return entry
+
+    def __drop_oldest_push(self) -> bool:
+        """Throw away the oldest queued message that isn't a reply. Returns False if they're all replies."""
+        for i, (message, _, reply) in enumerate(self.outbound):
+            if not reply:
+                del self.outbound[i]
+                self.queued_bytes -= len(message)
+                self.dropped += 1
+                return True
+        return False
+
+    def __enqueue(self, message: bytes, channel: tuple = None, reply: bool = False) -> None:
+        if self.closed: return
+
+        # always let at least one message through, even if it's bigger than the byte limit on its own
+        while self.outbound and (len(self.outbound) >= self.max_queue or self.queued_bytes + len(message) > self.max_queue_bytes):
+            if self.slow_consumer_policy == SlowConsumerPolicy.DISCONNECT:
+                if self.__kick is None:
+                    self.network_format.network_functions.log(type(self.network_format).__name__, f"Disconnecting {self.addr}, it can't keep up.")
+                    self.__kick = self.loop.create_task(self.close())
+                return
+
+            # nothing left that can be dropped. there can only be as many replies queued as requests the client
+            # has made (and requests are throttled), so going over the limit here is fine
+            if not self.__drop_oldest_push():
+                if not reply:
+                    self.dropped += 1
+                    return
+                break
+
+        self.outbound.append((message, channel, reply))
+        self.queued_bytes += len(message)
+        self.peak_queue_depth = max(self.peak_queue_depth, len(self.outbound))
+
+        self.__ready.set()
+        if self.__writer is None:
+            self.__writer = self.loop.create_task(self.__write_loop())
+
+    async def __wait_for_batch(self) -> None:
+        """Give other packets a moment to be queued so they can go out in the same write."""
+        deadline = self.loop.time() + self.batch_window
+        while self.queued_bytes < self.batch_bytes and not self.closed:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+
+            self.__ready.clear()
+            try:
+                await asyncio.wait_for(self.__ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+
+    def __take(self, messages: list[bytes]) -> None:
+        """Move the next queued message onto the end of `messages`, after the DEFINE for its channel if the client needs one.
+        Defines are only added here, as messages are actually written, so it doesn't matter which messages get dropped."""
+        message, channel, _ = self.__pop()
+        if channel is not None and self.__defined_channels.get(channel[0]) != channel:
+            self.__defined_channels[channel[0]] = channel
+            messages.append(to_bytes(Packet(PacketType.DEFINE, list(channel)), compact=self.capabilities.compact))
+        messages.append(message)
+
+    async def __write_loop(self) -> None:
+        try:
+            while not self.closed:
+                if not self.outbound:
+                    self.__ready.clear()
+                    await self.__ready.wait()
+                    continue
+
+                # only hold packets back in the middle of a burst, so normal request/reply traffic isn't slowed down
+                if self.batching and self.batch_window > 0 and self.__bursting:
+                    await self.__wait_for_batch()
+                    if not self.outbound: continue
+
+                # take as much as fits in one write (but always at least one packet)
+                messages = []
+                self.__take(messages)
+                size = len(messages[-1])
+                while self.outbound and size + len(self.outbound[0][0]) <= self.batch_bytes:
+                    self.__take(messages)
+                    size += len(messages[-1])
+
+                if self.batching and len(messages) > 1:
+                    written = [await self.__compress(pack_batch(messages))]
+                    await self.write(written[0])
+                else:
+                    # older clients still get them all in one write, just as separate frames
+                    written = [await self.__compress(message) for message in messages]
+                    await self.write_many(written)
+
+                self.sent += len(messages)
+                self.bytes_sent += sum(len(message) for message in written)
+                self.__bursting = len(messages) > 1
+                self.writes += 1
+        except (ConnectionError, OSError, EOFError):
+            await self.close()
 
     @abstractmethod
-    def send(self, message: bytes):
+    async def write(self, message: bytes) -> None:
+        """Write a message to the client, waiting until the transport has room for it."""
         pass
 
+    async def write_many(self, messages: list[bytes]) -> None:
+        """Write several messages to the client. Derived classes should override this if they can do it in a single write."""
+        for message in messages:
+            await self.write(message)
+
     @abstractmethod
-    def recv(self) -> bytes:
+    async def recv(self) -> Any:
+        """Wait for the next packet from the client. Raises EOFError when the client has gone away,
+        and whatever error decoding raised if the client sent something that isn't a packet."""
         pass
 
     @abstractmethod
-    def close(self) -> None:
-        pass
+    async def close(self) -> None:
+        """Closes the connection. Derived classes must call this so the writer task stops."""
+        self.closed = True
+        self.outbound.clear()
+        self.queued_bytes = 0
+        self.__ready.set()
 
 class NetworkFormatFunctions:
-    on_client_open: Callable[[NetworkConnection], bool] = None
+    on_client_open: Callable[[NetworkConnection], Awaitable[bool]] = None
     log: Callable[[str, str], None]
 
 class NetworkFormat:
@@ -31,18 +324,28 @@ class NetworkFormat:
 
     :parameter network_functions: The NetworkFormatFunctions instance.
     :parameter network_connections: The NetworkConnections instances that are being managed by this NetworkFormat instance.
-    :parameter running: The state of the server."""
+    :parameter running: The state of the server.
+    :parameter loop: The event loop the server runs on, set by the NetworkFormatManager before `open` is called.
+    :parameter config: The server's settings, set by the NetworkFormatManager before `open` is called."""
     network_functions: NetworkFormatFunctions = None
-    network_connections: list[NetworkConnection] = []
+    network_connections: set[NetworkConnection] = None
     running: bool = False
+    loop: asyncio.AbstractEventLoop = None
+    config: ConfigParser = ConfigParser()
+    # formats that can share their port with other processes (SO_REUSEPORT), for running a cluster of workers
+    can_reuse_port: bool = False
+    reuse_port: bool = False
+
+    def __init__(self):
+        # every format keeps track of its own clients
+        self.network_connections = set()
 
     @abstractmethod
-    def open(self) -> None:
+    async def open(self) -> None:
         """Opens a NetworkFormat server.
         The state of the server by the derived class.
         The functions set in network_functions are to be called by the derived class on the conditions described.
         """
-        if self.running: return
         if (self.network_functions is None
          or self.network_functions.on_client_open is None
          or self.network_functions.log is None):
@@ -50,12 +353,17 @@ class NetworkFormat:
         pass
 
     @abstractmethod
-    def close(self) -> None:
+    async def close(self) -> None:
         """Closes a NetworkFormat server.
         On close, all clients are to immediately close as soon as possible."""
-        if not self.running: return
-
-        for network_connection in self.network_connections:
-            network_connection.close()
+        # all at once, so one client that's slow to say goodbye doesn't hold up the rest
+        await asyncio.gather(*(network_connection.close() for network_connection in list(self.network_connections)), return_exceptions=True)
 
-        pass
\ No newline at end of file
+    async def serve_connection(self, network_connection: NetworkConnection) -> None:
+        """Hand a newly accepted connection to the server, keeping it registered until the client's session ends."""
+        self.network_connections.add(network_connection)
+        try:
+            await self.network_functions.on_client_open(network_connection)
+        finally:
+            self.network_connections.discard(network_connection)
+            await network_connection.close()
@@ -1,31 +1,229 @@
+import asyncio
+import threading
+import time
+from configparser import ConfigParser
+
 import server.formats.network_format
+from server.config import conf_get
+from server.packet import Packet, to_bytes, to_packet
+from server.sessions import SessionRegistry
+from server.formats.loopback import Loopback, LoopbackConnection
 from server.formats.raw_tcp import RawTcp
+from server.formats.unix_socket import UnixSocket
 from server.formats.websockets_nf import Websocket
 
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
+def raise_open_file_limit() -> None:
+    """Every client is a file descriptor, so bump the soft limit up to the hard limit where the OS lets us."""
+    if resource is None: return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft >= hard: return
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+
+class LazyEncoding:
+    """Encodes a packet being sent to lots of clients at most once for each way of encoding it
+    (string or native timestamps, normal or compact schema), and only if one of them actually needs the bytes.
+
+    Without a client (for the broker), it's encoded with native timestamps and the normal schema, since every server supports those."""
+
+    def __init__(self, packet: Packet, encoded: bytes = None):
+        self.packet = packet
+        # (timestamps, compact) -> bytes
+        self.encoded: dict[tuple[bool, int], bytes] = {(True, 0): encoded} if encoded is not None else {}
+
+    def get(self, client: server.formats.network_format.NetworkConnection = None) -> bytes:
+        if client is not None and not client.wants_bytes:
+            return None
+
+        encoding = (True, 0) if client is None else (client.capabilities.supports("timestamps"), client.capabilities.compact)
+        encoded = self.encoded.get(encoding)
+        if encoded is None:
+            encoded = self.encoded[encoding] = to_bytes(self.packet, *encoding)
+        return encoded
+
+
 class NetworkFormatManager:
-    network_formats: list[server.formats.network_format.NetworkFormat] = [RawTcp(), Websocket()]
-    network_functions: server.formats.network_format.NetworkFormatFunctions = server.formats.network_format.NetworkFormatFunctions()
+    """Owns the event loop that every NetworkFormat runs on.
+
+    The loop lives on its own thread, so `open` and `close` can still be called from normal (non async) code."""
+    network_formats: list[server.formats.network_format.NetworkFormat] = None
+    network_functions: server.formats.network_format.NetworkFormatFunctions = None
     running: bool = False
+    loop: asyncio.AbstractEventLoop = None
+    config: ConfigParser = ConfigParser()
+    __loop_thread: threading.Thread = None
+    # shares broadcasts with other servers (see `server.broker`), None if this server is on its own
+    broker = None
+    # which worker this is when running as a cluster (see `server.cluster`)
+    worker_id: int = None
+
+    def __init__(self):
+        # each manager gets its own, so more than one server can run in the same process
+        self.network_formats = [RawTcp(), UnixSocket(), Websocket(), Loopback()]
+        self.network_functions = server.formats.network_format.NetworkFormatFunctions()
+
+        # who's connected, shared with the server (see `server.sessions`)
+        self.sessions = SessionRegistry()
+
+    def send_to_all_clients(self, packet: Packet) -> None:
+        if server.formats.network_format.on_loop_thread(self.loop):
+            self.__send_to_all_clients(packet)
+        else:
+            self.loop.call_soon_threadsafe(self.__send_to_all_clients, packet)
+
+    def __send_to_all_clients(self, packet: Packet, encoded: bytes = None, from_broker: bool = False) -> None:
+        encoded = LazyEncoding(packet, encoded)
+        for client in self.sessions.connections():
+            client.send_packet(packet, encoded=encoded.get(client))
+
+        if self.broker is not None and not from_broker:
+            self.broker.publish({"type": "all", "packet": encoded.get()})
+
+    def track(self, connection: server.formats.network_format.NetworkConnection) -> int:
+        """Start routing broadcasts to a new client, returning how many are connected now."""
+        return self.sessions.add(connection)
+
+    def forget(self, connection: server.formats.network_format.NetworkConnection) -> int:
+        """Stop routing anything to a client that has gone away, returning how many are still connected."""
+        return self.sessions.remove(connection)
+
+    def subscribe(self, connection: server.formats.network_format.NetworkConnection, channel_id: int, user_name: str = None, user_uuid: str = None) -> None:
+        self.sessions.subscribe(connection, channel_id, user_name, user_uuid)
+
+    def unsubscribe(self, connection: server.formats.network_format.NetworkConnection, channel_id: int) -> None:
+        self.sessions.unsubscribe(connection, channel_id)
+
+    def send_to_channel(self, channel_id: int, packet: Packet, mentions: list[str] = ()) -> None:
+        """Send a packet to everyone watching a channel, plus anyone mentioned in it so they can be notified."""
+        if server.formats.network_format.on_loop_thread(self.loop):
+            self.__send_to_channel(channel_id, packet, mentions)
+        else:
+            self.loop.call_soon_threadsafe(self.__send_to_channel, channel_id, packet, mentions)
+
+    def __send_to_channel(self, channel_id: int, packet: Packet, mentions: list[str], encoded: bytes = None, from_broker: bool = False) -> None:
+        receivers = self.sessions.channel_receivers(channel_id, mentions)
+        encoded = LazyEncoding(packet, encoded)
+        for client in receivers:
+            client.send_packet(packet, encoded=encoded.get(client))
 
-    def send_to_all_clients(self, packet: bytes) -> None:
+        if self.broker is not None and not from_broker:
+            self.broker.publish({"type": "channel", "channel_id": channel_id, "mentions": list(mentions), "packet": encoded.get()})
+
+    def deliver_from_broker(self, message: dict) -> None:
+        """Send a broadcast that came from another server to our own clients. Must be called on the event loop."""
+        packet = to_packet(message["packet"])
+        if message["type"] == "channel":
+            self.__send_to_channel(message["channel_id"], packet, message["mentions"], message["packet"], from_broker=True)
+        elif message["type"] == "all":
+            self.__send_to_all_clients(packet, message["packet"], from_broker=True)
+
+    def report_online(self, count: int) -> None:
+        """Tell the other servers how many clients are connected to this one. Must be called on the event loop."""
+        if self.broker is not None:
+            self.broker.set_online(count)
+
+    def connection_stats(self) -> list[dict]:
+        """Get the outbound queue stats of every connected client. Must be called from another thread (the terminal):
+        they're collected on the event loop, which is what adds and removes connections and changes their queues."""
+        return self.run_coroutine(self.__connection_stats(), timeout=5)
+
+    async def __connection_stats(self) -> list[dict]:
+        return [
+            {"format": type(network_format).__name__, **client.queue_stats()}
+            for network_format in self.network_formats
+            for client in network_format.network_connections
+        ]
+
+    def connect_loopback(self) -> LoopbackConnection:
+        """Connect a client running in this process (see `server.async_network.AsyncLoopbackNetwork`)."""
         for network_format in self.network_formats:
-            for client in network_format.network_connections:
-                client.send(packet)
+            if isinstance(network_format, Loopback):
+                return network_format.connect()
+        raise ConnectionRefusedError("Loopback connections aren't enabled.")
+
+    def run_coroutine(self, coroutine, timeout: float = None):
+        """Run a coroutine on the event loop from another thread and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
 
     def open(self):
+        if self.running: return
+
         self.running = True
-        self.network_functions.log("manager", "...")
+        raise_open_file_limit()
+
+        self.loop = asyncio.new_event_loop()
+        self.__loop_thread = threading.Thread(target=self.loop.run_forever, name="portal-network", daemon=True)
+        self.__loop_thread.start()
+
+        if self.broker is not None:
+            self.run_coroutine(self.broker.start(self))
+
         for network_format in self.network_formats:
+            if self.worker_id is not None:
+                # every worker listens on the same ports, anything that can't be shared is left to the first one
+                if not network_format.can_reuse_port and self.worker_id != 0:
+                    continue
+                network_format.reuse_port = network_format.can_reuse_port
+
             try:
-                self.network_functions.log("manager", "test")
                 network_format.network_functions = self.network_functions
-                self.network_functions.log("manager", "set nf...")
-                network_format.open()
-                self.network_functions.log("manager", "nf open completed...")
+                network_format.loop = self.loop
+                network_format.config = self.config
+                self.run_coroutine(network_format.open())
+            except Exception as e:
+                self.network_functions.log("manager", f"Failed to open {type(network_format).__name__}: {e}")
+
+        heartbeat_interval = int(conf_get(self.config, "Network", "heartbeat-interval"))
+        if heartbeat_interval > 0:
+            self.loop.call_soon_threadsafe(self.loop.create_task, self.__close_silent_connections(heartbeat_interval))
+
+    async def __close_silent_connections(self, interval: int) -> None:
+        """Disconnect clients that agreed to send heartbeats but have gone quiet, their end is probably gone without telling us."""
+        while self.running:
+            await asyncio.sleep(interval)
+
+            now = time.monotonic()
+            for network_format in self.network_formats:
+                for client in list(network_format.network_connections):
+                    if client.closed or not client.capabilities.supports("heartbeat"): continue
+
+                    silent_for = now - client.last_received
+                    if silent_for > client.capabilities.limit("heartbeat-interval", interval) * 3:
+                        self.network_functions.log(type(network_format).__name__, f"Disconnecting {client.addr}, nothing heard from it for {silent_for:.0f} seconds.")
+                        self.loop.create_task(client.close())
+
+    async def __shutdown(self):
+        for network_format in self.network_formats:
+            try:
+                await network_format.close()
             except Exception as e:
-                self.network_functions.log("manager", str(e))
+                self.network_functions.log("manager", f"Failed to close {type(network_format).__name__}: {e}")
+
+        if self.broker is not None:
+            await self.broker.close()
+
+        # anything still running (half finished writes, clients mid request) gets cancelled
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
     def close(self):
+        if not self.running: return
+
         self.running = False
-        for network_format in self.network_formats:
-            network_format.close()
+        self.run_coroutine(self.__shutdown())
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.__loop_thread.join()
+        self.loop.close()
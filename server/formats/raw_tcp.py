@@ -1,83 +1,159 @@
 from __future__ import annotations
 
-import socket
-import threading
+import asyncio
 from typing import Any
 
 import server.formats.network_format
+from server.framing import HEADER, FrameDecoder, UnframedDecoder, is_unframed
+from server.packet import Packet, to_bytes, to_packets
 
-class RawTcpConnection(server.formats.network_format.NetworkConnection):
-    __socket: socket.socket = None
-    __host: RawTcp = None
-
-    def sendall(self, message: bytes):
-        self.__socket.sendall(message)
-        pass
-
-    def send(self, message: bytes):
-        self.__socket.send(message)
-        pass
-
-    def recv(self) -> bytes:
-        return self.__socket.recv(2048)
-
-    def close(self) -> None:
-        if self.__socket.fileno() == -1:
-            self.__socket.close()
+class RawTcpConnection(server.formats.network_format.NetworkConnection, asyncio.BufferedProtocol):
+    """A raw TCP client. Packets are sent as length prefixed frames (see `server.framing`), or back to back
+    for clients from before framing, which is worked out from the first thing the client sends.
 
-        self.__host.server_sockets.remove(self)
-
-    def __init__(self, raw_tcp: RawTcp, conn: socket.socket, addr: Any):
+    The event loop reads straight into the connection's FrameDecoder buffer, and every complete frame
+    is decoded as soon as it arrives, so pipelined packets all get handled in order."""
+    __transport: asyncio.Transport = None
+    __host: RawTcp = None
+    # stop reading from the socket when this many packets are waiting to be handled
+    max_pending_packets: int = 64
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.__transport = transport
+        self.addr = transport.get_extra_info("peername")
+        self.__session = self.loop.create_task(self.__host.serve_connection(self))
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.__decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.__decoder.buffer_updated(nbytes)
+
+        if self.framed is None:
+            self.framed = not is_unframed(self.__decoder.buffer[self.__decoder.start])
+            if not self.framed:
+                unframed = UnframedDecoder(max_frame_size=self.max_frame_size)
+                unframed.feed(self.__decoder.unread())
+                self.__decoder = unframed
+            self.__framing_known.set()
+
+        try:
+            for body in self.__decoder.frames():
+                for packet in to_packets(body):
+                    self.__packets.put_nowait(packet)
+        except Exception as e: # the client sent something that isn't a packet, recv will raise it
+            self.__packets.put_nowait(e)
+            self.__transport.pause_reading()
+            return
+
+        if self.__packets.qsize() >= self.max_pending_packets and not self.__reading_paused:
+            self.__reading_paused = True
+            self.__transport.pause_reading()
+
+    def eof_received(self) -> bool:
+        self.__packets.put_nowait(EOFError("The client closed the connection."))
+        return False
+
+    def connection_lost(self, exc: Exception) -> None:
+        self.__packets.put_nowait(EOFError("The connection was lost."))
+        # wake up anything waiting to write so it can see the connection is gone
+        self.__can_write.set()
+        self.__framing_known.set()
+
+    def pause_writing(self) -> None:
+        self.__can_write.clear()
+
+    def resume_writing(self) -> None:
+        self.__can_write.set()
+
+    def send_greeting(self, packet: Packet) -> None:
+        # straight onto the wire and unframed, so it's the first thing the client gets whatever else is queued
+        if not self.__transport.is_closing():
+            self.__transport.write(to_bytes(packet))
+
+    async def write(self, message: bytes) -> None:
+        await self.write_many([message])
+
+    async def write_many(self, messages: list[bytes]) -> None:
+        # nothing else can go out until we know whether the client wants frames
+        await self.__framing_known.wait()
+        if self.__transport.is_closing():
+            raise ConnectionResetError("The connection is closed.")
+
+        # every frame goes to the transport at once, so they all go out in as few syscalls as possible
+        if self.framed:
+            self.__transport.writelines([part for message in messages for part in (HEADER.pack(len(message)), message)])
+        else:
+            self.__transport.writelines(messages)
+        await self.__can_write.wait()
+
+    async def recv(self) -> Packet:
+        packet = await self.__packets.get()
+
+        if self.__reading_paused and self.__packets.qsize() < self.max_pending_packets // 2:
+            self.__reading_paused = False
+            self.__transport.resume_reading()
+
+        if isinstance(packet, Exception):
+            raise packet
+        return packet
+
+    async def close(self) -> None:
+        if self.closed: return
+        await super().close()
+
+        if self.__transport is not None:
+            self.__transport.close()
+
+    def getsockname(self) -> Any:
+        return self.__transport.get_extra_info("sockname")
+
+    def __init__(self, raw_tcp: RawTcp):
         self.__host = raw_tcp
-        self.__socket = conn
-        self.addr = addr
-        super().__init__()
+        self.__decoder: FrameDecoder | UnframedDecoder = FrameDecoder()
+        # whether the client frames its packets, None until it's sent something
+        self.framed: bool = None
+        self.__framing_known = asyncio.Event()
+        self.__packets: asyncio.Queue[Packet | Exception] = asyncio.Queue()
+        self.__reading_paused = False
+        self.__can_write = asyncio.Event()
+        self.__can_write.set()
+        super().__init__(raw_tcp)
+        self.__decoder.max_frame_size = self.max_frame_size
+
+    def use_capabilities(self, capabilities) -> None:
+        super().use_capabilities(capabilities)
+        self.__decoder.max_frame_size = self.max_frame_size
 
 
 class RawTcp(server.formats.network_format.NetworkFormat):
-    __server_thread: threading.Thread = None
-    __server_server: socket.socket = None
-    server_sockets: list[RawTcpConnection] = []
-
-    def server(self):
-        while self.running:
-            if self.__server_server.fileno() == -1:  # the socket is closed
-                self.running = False
-                break
-
-            try:
-                self.network_functions.log("Raw TCP", "Waiting for connection...")
-                conn, addr = self.__server_server.accept()
-                self.network_functions.log("Raw TCP", "Accepting connection...")
-            except (ConnectionAbortedError, OSError, KeyboardInterrupt):  # socket was closed by server owner
-                break
-
-            new_raw_tcp_connection = RawTcpConnection(self, conn, addr)
-
-            if self.network_functions.on_client_open(new_raw_tcp_connection):
-                self.network_functions.log("Raw TCP", "Connection authorised!")
-                self.server_sockets.append(new_raw_tcp_connection)
-            else:
-                self.network_functions.log("Raw TCP", "Server rejected connection.")
-
-    def open(self) -> None:
+    __server: asyncio.Server = None
+    host: str = ""
+    port: int = 5555
+    # how many not yet accepted connections the OS will queue up for us
+    backlog: int = 1024
+    can_reuse_port = True
+
+    def create_connection(self) -> RawTcpConnection:
+        self.network_functions.log("Raw TCP", "Accepting connection...")
+        return RawTcpConnection(self)
+
+    async def open(self) -> None:
         if self.running: return
+        await super().open()
 
+        self.__server = await self.loop.create_server(self.create_connection, self.host or None, self.port, backlog=self.backlog, reuse_port=self.reuse_port or None)
         self.running = True
-        self.__server_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.__server_server.bind(("", 5555))
-        self.__server_server.listen()
-        self.__server_thread = threading.Thread(target=self.server)
-        self.__server_thread.start()
-        pass
-
-    def close(self) -> None:
+        self.network_functions.log("Raw TCP", f"Listening on port {self.port}.")
+
+    async def close(self) -> None:
         if not self.running: return
 
         self.running = False
-        self.__server_server.close()
-        self.__server_thread.join()
-        pass
+        # stop accepting new clients before kicking the current ones
+        self.__server.close()
+        await super().close()
+        await self.__server.wait_closed()
 
     def __init__(self):
-        super().__init__()
\ No newline at end of file
+        super().__init__()
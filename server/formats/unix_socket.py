@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import socket
+
+import server.formats.network_format
+import server.formats.raw_tcp
+from server.config import conf_get
+
+class UnixSocketConnection(server.formats.raw_tcp.RawTcpConnection):
+    """A client on the same machine. Same framing as raw TCP, it just skips the TCP stack."""
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        super().connection_made(transport)
+        # unix socket clients don't have an address of their own, so make one up that still looks like (host, port)
+        self.addr = ("unix", transport.get_extra_info("sockname"))
+
+class UnixSocket(server.formats.network_format.NetworkFormat):
+    __server: asyncio.Server = None
+    path: str = None
+    backlog: int = 1024
+
+    def create_connection(self) -> UnixSocketConnection:
+        self.network_functions.log("Unix Socket", "Accepting connection...")
+        return UnixSocketConnection(self)
+
+    async def open(self) -> None:
+        if self.running: return
+        if not hasattr(socket, "AF_UNIX"):
+            self.network_functions.log("Unix Socket", "Unix sockets aren't supported on this platform.")
+            return
+        await super().open()
+
+        self.path = conf_get(self.config, "Unix", "path")
+        # a socket file left behind by a server that crashed is replaced
+        self.__server = await self.loop.create_unix_server(self.create_connection, self.path, backlog=self.backlog)
+        self.running = True
+        self.network_functions.log("Unix Socket", f"Listening on {self.path}.")
+
+    async def close(self) -> None:
+        if not self.running: return
+
+        self.running = False
+        self.__server.close()
+        await super().close()
+        await self.__server.wait_closed()
+
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def __init__(self):
+        super().__init__()
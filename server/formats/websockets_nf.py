@@ -1,85 +1,95 @@
 from __future__ import annotations
 
-import threading
-import websockets.sync.server
+from collections import deque
+from typing import Any
+
+import websockets.asyncio.server
+import websockets.exceptions
 import server.formats.network_format
+from server.config import conf_get
+from server.packet import Packet, to_packets
 
 class WebsocketConnection(server.formats.network_format.NetworkConnection):
-    __socket: websockets.sync.server.ServerConnection
+    """A websocket client. Every websocket message is a whole packet (or a batch of them), so there's no framing to do."""
+    __socket: websockets.asyncio.server.ServerConnection
     __host: Websocket
-    websocketSemaphore = threading.BoundedSemaphore()
 
-    def sendall(self, message: bytes):
-        self.send(message)
-        pass
+    async def write(self, message: bytes) -> None:
+        # send waits for the socket to drain below the write limit, so a slow client can't make us buffer forever
+        try:
+            await self.__socket.send(message)
+        except websockets.exceptions.ConnectionClosed:
+            raise EOFError("The client closed the connection.")
+
+    async def recv(self) -> Packet:
+        if not self.__pending:
+            try:
+                message = await self.__socket.recv()
+            except websockets.exceptions.ConnectionClosed:
+                raise EOFError("The client closed the connection.")
+
+            self.__pending.extend(to_packets(message))
 
-    def send(self, message: bytes):
-        self.__socket.send(message)
-        pass
+        return self.__pending.popleft()
 
-    def recv(self) -> bytes:
-        return self.__socket.recv()
+    async def close(self) -> None:
+        if self.closed: return
+        await super().close()
 
-    def close(self) -> None:
-        if self.__socket.close_code is not None:
-            self.__socket.close()
+        await self.__socket.close()
 
-        self.__host.network_connections.remove(self)
-        self.websocketSemaphore.release()
-        pass
+    def getsockname(self) -> Any:
+        return self.__socket.local_address
 
-    def __init__(self, host: Websocket, connection: websockets.sync.server.ServerConnection):
+    def __init__(self, host: Websocket, connection: websockets.asyncio.server.ServerConnection):
         self.__host = host
         self.__socket = connection
-        self.addr = connection.local_address
-        super().__init__()
-        pass
+        self.addr = connection.remote_address
+        self.__pending: deque[Packet] = deque()
+        super().__init__(host)
 
 class Websocket(server.formats.network_format.NetworkFormat):
-    __server_thread: threading.Thread = None
-    __server_socket: websockets.sync.server.Server = None
-
-    def server(self):
-        def handler(server_connection: websockets.sync.server.ServerConnection) -> None:
-            try:
-                self.network_functions.log("Websocket", str(server_connection))
-                self.network_functions.log("Websocket", "New connection - checking...")
-                new_network_connection = WebsocketConnection(self, server_connection)
-
-                if self.network_functions.on_client_open(new_network_connection):
-                    self.network_functions.log("Websocket", "Connection authorised!")
-                    self.network_connections.append(new_network_connection)
-
-                    new_network_connection.websocketSemaphore.acquire()
-                    new_network_connection.websocketSemaphore.acquire()
-                    self.network_functions.log("Websocket", "Ended.")
-                else:
-                    self.network_functions.log("Websocket", "Server rejected connection.")
-            except Exception as e:
-                self.network_functions.log("Websocket", "[yellow]Exception on handling...[/yellow]")
-                self.network_functions.log("Websocket", str(e))
-
-        try:
-            self.__server_socket = websockets.sync.server.serve(handler, host="", port=5551)
-            self.network_functions.log("Websocket", "Handing off control to websocket server...")
-            self.__server_socket.serve_forever()
-            self.network_functions.log("Websocket", "Houston?")
-        except Exception as e:
-            self.network_functions.log("Websocket", str(e))
-
-    def open(self) -> None:
-        super().open()
-        self.__server_thread = threading.Thread(target=self.server)
-        self.network_functions.log("Websocket", "Starting websocket server thread...")
-        self.__server_thread.start()
-        pass
-
-    def close(self) -> None:
-        super().close()
-
-        self.__server_socket.shutdown()
-
-        pass
+    """Websocket clients (browsers and the like), served on the same event loop as everything else."""
+    __server: websockets.asyncio.server.Server = None
+    host: str = ""
+    port: int = 5551
+    backlog: int = 1024
+    # how long to wait for a client to finish the closing handshake
+    close_timeout: float = 2
+    can_reuse_port = True
+
+    async def handler(self, server_connection: websockets.asyncio.server.ServerConnection) -> None:
+        self.network_functions.log("Websocket", f"Accepting connection from {server_connection.remote_address}...")
+        # websockets closes the connection once this returns
+        await self.serve_connection(WebsocketConnection(self, server_connection))
+
+    async def open(self) -> None:
+        if self.running: return
+        await super().open()
+
+        self.__server = await websockets.asyncio.server.serve(
+            self.handler, self.host or None, self.port,
+            # these bound how much memory each client can make us hold on to
+            max_size=int(conf_get(self.config, "Websocket", "max-message-size")),
+            max_queue=int(conf_get(self.config, "Websocket", "max-queue")),
+            write_limit=int(conf_get(self.config, "Websocket", "write-limit")),
+            # big packets are already compressed by us, and permessage-deflate costs a lot of memory per client
+            compression=None,
+            close_timeout=self.close_timeout,
+            backlog=self.backlog,
+            reuse_port=self.reuse_port or None
+        )
+        self.running = True
+        self.network_functions.log("Websocket", f"Listening on port {self.port}.")
+
+    async def close(self) -> None:
+        if not self.running: return
+
+        self.running = False
+        # stop accepting new clients before kicking the current ones
+        self.__server.close(close_connections=False)
+        await super().close()
+        await self.__server.wait_closed()
 
     def __init__(self):
-        super().__init__()
\ No newline at end of file
+        super().__init__()
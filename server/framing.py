@@ -0,0 +1,182 @@
+"""Length prefixed framing for stream transports (raw TCP, unix sockets, the cluster broker).
+
+Clients and servers from before framing send packets back to back with nothing in between, so to keep talking to them:
+    - the server's first packet (its CONNECTION_STARTED) is always sent unframed, which every client can read.
+      Servers that know about framing put their protocol version in it, older ones send it empty
+    - after that the client frames everything if the server's hello had a version, and stays unframed if it didn't
+    - the server looks at the first byte the client sends. Unframed packets start with a msgpack map header,
+      which a frame header never does (see `is_unframed`), and those clients are served unframed from then on
+"""
+from __future__ import annotations
+
+import socket
+import struct
+
+import msgpack
+
+
+# every frame starts with the length of its body as a 4 byte big-endian unsigned int
+HEADER = struct.Struct(">I")
+# anything bigger than this is either a broken client or someone trying to make us run out of memory
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def is_unframed(first_byte: int) -> bool:
+    """Whether the first byte from a peer is the start of an unframed packet (a msgpack map) rather than a frame header.
+    A frame's length is at most MAX_FRAME_SIZE, so its first byte is always 0 or 1."""
+    return 0x80 <= first_byte <= 0x8f or first_byte in (0xde, 0xdf)
+
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+def frame(data: bytes) -> bytes:
+    """Add a length prefix to some data so it can be sent over a stream."""
+    return HEADER.pack(len(data)) + data
+
+
+class FrameDecoder:
+    """Splits a stream of bytes back up into the frames it was made of.
+
+    Data is read straight into one preallocated buffer which is reused for the whole connection:
+    ask for somewhere to write with `get_buffer`, read into it (`socket.recv_into`, or let an
+    `asyncio.BufferedProtocol` do it), then report how much was written with `buffer_updated`.
+    Every complete frame can then be taken out with `frames`."""
+
+    def __init__(self, buffer_size: int = 64 * 1024, max_frame_size: int = MAX_FRAME_SIZE):
+        self.buffer = bytearray(buffer_size)
+        self.buffer_size = buffer_size
+        self.max_frame_size = max_frame_size
+        # the unread data lives in buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+    def __pending_frame_size(self) -> int:
+        """How many bytes the frame at the start of the buffer needs in total (header included), or just the header size if we don't know yet."""
+        if self.end - self.start < HEADER.size:
+            return HEADER.size
+
+        (length,) = HEADER.unpack_from(self.buffer, self.start)
+        if length > self.max_frame_size:
+            raise FrameTooLarge(f"Frame of {length} bytes is bigger than the limit of {self.max_frame_size} bytes.")
+        return HEADER.size + length
+
+    def __make_room(self, needed: int) -> None:
+        """Make sure the buffer can hold `needed` bytes from the start of the unread data."""
+        unread = self.end - self.start
+        if not unread:
+            self.start = self.end = 0
+
+        # only grow when a single frame is too big to fit, and then just big enough for it. once the big frame's
+        # gone, go back to the normal size rather than holding on to all that memory for the rest of the connection
+        size = max(self.buffer_size, needed)
+        if len(self.buffer) < needed or (len(self.buffer) > size and unread <= size):
+            # a new buffer rather than resizing this one, there may still be views of it around
+            buffer = bytearray(size)
+            buffer[:unread] = self.buffer[self.start:self.end]
+            self.buffer, self.start, self.end = buffer, 0, unread
+        elif self.start and (len(self.buffer) - self.end < 4096 or len(self.buffer) - self.start < needed):
+            # move the unread data back to the start of the buffer if we're running out of room at the end
+            self.buffer[:unread] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, unread
+
+    def get_buffer(self, size_hint: int = -1) -> memoryview:
+        """Get the free part of the buffer to read into."""
+        self.__make_room(self.__pending_frame_size())
+        return memoryview(self.buffer)[self.end:]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.end += nbytes
+
+    def feed(self, data: bytes) -> None:
+        """Add data that was read some other way than into `get_buffer`."""
+        self.__make_room(self.end - self.start + len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def unread(self) -> bytes:
+        """Everything that's been received but not taken out as a frame yet."""
+        return bytes(self.buffer[self.start:self.end])
+
+    def frames(self, limit: int = None):
+        """Yield every complete frame body that has been received (or just the first `limit` of them).
+
+        The bodies are views into the receive buffer, so they have to be decoded before `get_buffer` is called again."""
+        view = memoryview(self.buffer)
+        count = 0
+        while self.end - self.start >= HEADER.size and (limit is None or count < limit):
+            needed = self.__pending_frame_size()
+            if self.end - self.start < needed:
+                break
+
+            body = view[self.start + HEADER.size:self.start + needed]
+            self.start += needed
+            count += 1
+            yield body
+
+
+class UnframedDecoder:
+    """Splits up a stream of packets from a peer that doesn't frame them (see the top of this file).
+    Works just like a `FrameDecoder`, except there's no length to go by, so each packet is found by parsing it."""
+
+    def __init__(self, buffer_size: int = 64 * 1024, max_frame_size: int = MAX_FRAME_SIZE):
+        # only somewhere to read into, everything read is handed to the unpacker straight away
+        self.buffer = bytearray(buffer_size)
+        self.max_frame_size = max_frame_size
+        self.__unpacker = msgpack.Unpacker(max_buffer_size=max_frame_size)
+        # what's been fed to the unpacker but not handed out as a packet yet, which starts at `__offset` in the stream
+        self.__data = bytearray()
+        self.__offset = 0
+
+    def get_buffer(self, size_hint: int = -1) -> memoryview:
+        return memoryview(self.buffer)
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.feed(self.buffer[:nbytes])
+
+    def feed(self, data: bytes) -> None:
+        try:
+            self.__unpacker.feed(data)
+        except msgpack.BufferFull:
+            raise FrameTooLarge(f"Packet is bigger than the limit of {self.max_frame_size} bytes.")
+        self.__data += data
+
+    def unread(self) -> bytes:
+        return bytes(self.__data)
+
+    def frames(self, limit: int = None):
+        """Yield every complete packet that has been received (or just the first `limit` of them), still encoded."""
+        count = 0
+        while limit is None or count < limit:
+            try:
+                self.__unpacker.skip()
+            except msgpack.OutOfData:
+                return
+
+            size = self.__unpacker.tell() - self.__offset
+            body = bytes(self.__data[:size])
+            del self.__data[:size]
+            self.__offset += size
+            count += 1
+            yield body
+
+    def to_framed(self) -> FrameDecoder:
+        """The decoder to carry on with once the peer has switched to frames, with whatever's been read after the last packet."""
+        decoder = FrameDecoder(len(self.buffer), self.max_frame_size)
+        decoder.feed(self.unread())
+        return decoder
+
+
+def recv_frames(sock: socket.socket, decoder: FrameDecoder | UnframedDecoder, limit: int = None) -> list[bytes]:
+    """Block until at least one whole frame has arrived on a socket and return the bodies of every complete frame
+    (just the first one with `limit=1`, for reading the hello before knowing whether the rest is framed)."""
+    while True:
+        frames = [bytes(body) for body in decoder.frames(limit)]
+        if frames:
+            return frames
+
+        nbytes = sock.recv_into(decoder.get_buffer())
+        if nbytes == 0:
+            raise ConnectionResetError("The connection was closed.")
+        decoder.buffer_updated(nbytes)
@@ -0,0 +1,151 @@
+"""Keeps the server usable when it's getting more requests than the database threads can keep up with.
+
+Everything that touches the database goes through a `LoadShedder`, which hands jobs to the database threads
+with critical ones (MESSAGE_SEND) ahead of everything else. Once too many jobs are waiting,
+or the oldest has been waiting too long, it starts turning away the requests that can just be retried later
+(history fetches, INFO scans) until things calm down.
+"""
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor
+from configparser import ConfigParser
+from typing import Callable, Any
+
+from server.config import conf_get
+from server.packet import Packet, PacketType
+
+
+class LoadShedder:
+    """Used from the event loop, apart from `__work` which runs on the executor."""
+
+    def __init__(self, executor: Executor, config: ConfigParser):
+        self.executor = executor
+        self.high_queue = int(conf_get(config, "Load", "high-queue"))
+        self.low_queue = int(conf_get(config, "Load", "low-queue"))
+        self.high_latency = int(conf_get(config, "Load", "high-latency")) / 1000
+        self.low_latency = int(conf_get(config, "Load", "low-latency")) / 1000
+        # the GET types that get turned away while shedding
+        self.sheddable = {name.strip().upper() for name in conf_get(config, "Load", "shed").split(",") if name.strip()}
+
+        # each entry is (function, args, future, when it was queued). the executor's threads take from these, so they're behind a lock
+        self.critical: deque[tuple] = deque()
+        self.bulk: deque[tuple] = deque()
+        self.__lock = threading.Lock()
+        self.running = 0
+        self.shedding = False
+        # called with the new state whenever shedding starts or stops
+        self.on_change: Callable[[bool], None] = None
+
+        # stats
+        self.shed = 0
+        self.completed = 0
+        self.peak_depth = 0
+        # smoothed time from being queued to finishing, for critical jobs and everything else
+        self.latency = {True: 0.0, False: 0.0}
+
+    @property
+    def depth(self) -> int:
+        return len(self.critical) + len(self.bulk) + self.running
+
+    def oldest_wait(self, now: float = None) -> float:
+        """How long the job that's been waiting longest has been waiting for, in seconds."""
+        now = now or time.monotonic()
+        with self.__lock:
+            queued = [queue[0][3] for queue in (self.critical, self.bulk) if queue]
+        return max((now - queued_at for queued_at in queued), default=0.0)
+
+    def is_critical(self, packet: Packet) -> bool:
+        return packet.packet_type == PacketType.MESSAGE_SEND
+
+    def is_sheddable(self, packet: Packet) -> bool:
+        return packet.packet_type == PacketType.GET and isinstance(packet.data, dict) and str(packet.data.get("type")).upper() in self.sheddable
+
+    def __update(self) -> None:
+        depth = self.depth
+        waited = self.oldest_wait()
+        if not self.shedding and (depth >= self.high_queue or waited >= self.high_latency):
+            self.shedding = True
+        elif self.shedding and depth <= self.low_queue and waited <= self.low_latency:
+            self.shedding = False
+        else:
+            return
+
+        if self.on_change is not None:
+            self.on_change(self.shedding)
+
+    def should_shed(self, packet: Packet) -> bool:
+        """Whether to turn the packet away (with a WAIT) instead of handling it."""
+        self.__update()
+        if self.shedding and self.is_sheddable(packet):
+            self.shed += 1
+            return True
+        return False
+
+    def retry_after(self) -> float:
+        """Roughly how long the queue will take to go down, as a hint for clients that got turned away."""
+        return round(max(1.0, self.oldest_wait() * 2), 3)
+
+    async def run(self, function: Callable, *args, critical: bool = False) -> Any:
+        """Run a blocking function on the executor, after any critical jobs that are waiting."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.__lock:
+            (self.critical if critical else self.bulk).append((function, args, future, time.monotonic()))
+        self.peak_depth = max(self.peak_depth, self.depth)
+
+        # every job gets a turn on the executor, but which job runs is only decided once its turn comes up.
+        # that way the executor never sits waiting for the (possibly busy) event loop to tell it what's next
+        self.executor.submit(self.__work, loop)
+        return await future
+
+    def __work(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Runs on the executor: take the most important job that's waiting and run it."""
+        with self.__lock:
+            while True:
+                if self.critical:
+                    critical = True
+                    function, args, future, queued_at = self.critical.popleft()
+                elif self.bulk:
+                    critical = False
+                    function, args, future, queued_at = self.bulk.popleft()
+                else: # an earlier turn already ran it
+                    return
+
+                if not future.cancelled(): # otherwise whoever wanted it has gone (the client disconnected)
+                    break
+            self.running += 1
+
+        try:
+            result, error = function(*args), None
+        except BaseException as e:
+            result, error = None, e
+        loop.call_soon_threadsafe(self.__finished, future, result, error, queued_at, critical)
+
+    def __finished(self, future: asyncio.Future, result: Any, error: BaseException, queued_at: float, critical: bool) -> None:
+        with self.__lock:
+            self.running -= 1
+        self.completed += 1
+        self.latency[critical] = self.latency[critical] * 0.9 + (time.monotonic() - queued_at) * 0.1
+
+        if not future.done():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        self.__update()
+
+    def stats(self) -> dict:
+        return {
+            "state": "shedding" if self.shedding else "normal",
+            "depth": self.depth,
+            "peak_depth": self.peak_depth,
+            "oldest_wait_ms": round(self.oldest_wait() * 1000, 1),
+            "critical_latency_ms": round(self.latency[True] * 1000, 1),
+            "latency_ms": round(self.latency[False] * 1000, 1),
+            "completed": self.completed,
+            "shed": self.shed
+        }
@@ -1,33 +1,73 @@
-import socket, struct
-from server.packet import Packet, PacketType, to_packet, to_bytes
+import socket, threading, hashlib, zlib, os
+from server.packet import Packet, PacketType, to_packet, to_packets, to_bytes
+from server.framing import MAX_FRAME_SIZE, FrameDecoder, FrameTooLarge, UnframedDecoder, frame, recv_frames
+from server.uploads import CHUNK_SIZE, file_sha256
+from server.capabilities import Capabilities, local_limits, negotiate
 
 
 class Network:
     def __init__(self, server_ip: str):
-        self.buffer_size = 2048 * 4
+        # the server's hello is never framed, it's swapped for a FrameDecoder once we know the server frames everything else
+        self.decoder: FrameDecoder | UnframedDecoder = UnframedDecoder()
+        # uploads and normal packets can be sent from different threads, this stops their frames getting mixed up
+        self.send_lock = threading.Lock()
+        self.uploads: dict[str, str] = {}
+        # what the server agreed to use, filled in by start_connection
+        self.capabilities = Capabilities()
+        # what the server's told us its channel refs mean, for the compact schema
+        self.channels: dict[int, tuple] = {}
         self.port = 5555
 
         self.TIMEOUT = 1 # if a socket exceeds 1 second latency on a GOD DAMN LAN CONNECTION, then the packet must not have been received lol
 
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.client: socket.socket = None
         self.server = server_ip
-        self.addr = (self.server, self.port)
+        # "unix:///path/to/portal.sock" connects to a server on this machine through its unix socket instead
+        if server_ip.startswith("unix://"):
+            self.family = socket.AF_UNIX
+            self.addr = server_ip[len("unix://"):]
+        else:
+            self.family = socket.AF_INET
+            self.addr = (self.server, self.port)
         self.connect()
 
-    def send_image(self, image_path: str):
-        """Send an image over the socket. The image is **required** to be in `.png` format."""
-        # read image data
-        with open(image_path, "rb") as f:
-            image_data = f.read()
+    def start_upload(self, path: str, user_uuid: str, kind: str = "icon") -> str:
+        """Ask the server to start receiving a file. Once it replies with an UPLOAD_STATUS saying where to
+        start from, send the file with `send_upload`. Starting the same file again resumes it."""
+        sha256 = file_sha256(path)
+        upload_id = hashlib.sha256(f"{kind}:{sha256}".encode()).hexdigest()[:32]
+        self.uploads[upload_id] = path
 
-        self.client.setblocking(True)
+        self.send(Packet(PacketType.UPLOAD, {
+            "type": "START",
+            "uuid": user_uuid,
+            "upload_id": upload_id,
+            "kind": kind,
+            "name": os.path.basename(path),
+            "size": os.path.getsize(path),
+            "sha256": sha256
+        }), expect_reply=False)
+        return upload_id
 
-        # Send length of data (4 bytes, big-endian unsigned int)
-        self.client.sendall(struct.pack('>I', len(image_data)))
+    def send_upload(self, upload_id: str, user_uuid: str, offset: int = 0) -> None:
+        """Send the rest of a file from `offset` onwards. Each chunk is its own packet, so other packets can still be sent in between."""
+        with open(self.uploads[upload_id], "rb") as f:
+            f.seek(offset)
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                self.send(Packet(PacketType.UPLOAD, {
+                    "type": "CHUNK",
+                    "uuid": user_uuid,
+                    "upload_id": upload_id,
+                    "offset": offset,
+                    "data": chunk,
+                    "crc32": zlib.crc32(chunk)
+                }), expect_reply=False)
+                offset += len(chunk)
 
-        # Send image data
-        self.client.sendall(image_data)
-    
     def close(self):
         self.client.close()
 
@@ -37,17 +77,65 @@ class Network:
         if blocking:
             self.client.settimeout(self.TIMEOUT)
 
+        packets = []
         try:
-            response = self.client.recv(self.buffer_size)
-        except (BlockingIOError, socket.error):
-            return [Packet(PacketType.NONE, None)]
+            while not packets:
+                nbytes = self.client.recv_into(self.decoder.get_buffer())
+                if nbytes == 0:
+                    raise ConnectionResetError("The server closed the connection.")
+                self.decoder.buffer_updated(nbytes)
+
+                # one read can hold several packets (or only part of one)
+                packets = [packet for body in self.decoder.frames() for packet in to_packets(body, self.channels)]
+                if not blocking:
+                    break
+        except (BlockingIOError, socket.timeout):
+            if not packets:
+                return [Packet(PacketType.NONE, None)]
 
-        return to_packet(response)
+        return packets
 
     def connect(self):
+        self.client = socket.socket(self.family, socket.SOCK_STREAM)
         self.client.connect(self.addr)
-        
-    def send(self, data, blocking: bool = True) -> Packet:
+        self.start_connection()
+
+    def start_connection(self):
+        """Read the server's CONNECTION_STARTED and tell it which of its features we want to use."""
+        self.client.settimeout(self.TIMEOUT)
+        try:
+            # only the hello, whatever comes after it might be framed
+            packet = to_packet(recv_frames(self.client, self.decoder, limit=1)[0])
+        except socket.timeout:
+            return
+
+        # older servers send an empty CONNECTION_STARTED, so we stay on the original (unframed) protocol
+        if packet.packet_type == PacketType.CONNECTION_STARTED:
+            self.capabilities = negotiate(packet.data)
+        if self.capabilities.version > 0:
+            self.decoder = self.decoder.to_framed()
+            self.decoder.max_frame_size = self.capabilities.limit("max-frame-size", MAX_FRAME_SIZE)
+            # nothing here would send the pings, so don't let the server expect them (AsyncNetwork does heartbeats)
+            self.capabilities.features.discard("heartbeat")
+
+            self.send(Packet(PacketType.CONNECTION_STARTED, {
+                "version": self.capabilities.version,
+                "features": sorted(self.capabilities.features),
+                "compression": self.capabilities.compression,
+                "limits": local_limits(),
+                "compact": self.capabilities.compact
+            }), expect_reply=False)
+
+    def send(self, data, blocking: bool = True, expect_reply: bool = True) -> list[Packet]:
+
+        message = to_bytes(data, self.capabilities.supports("timestamps"), self.capabilities.compact)
+        if len(message) > self.capabilities.limit("max-frame-size", MAX_FRAME_SIZE):
+            raise FrameTooLarge(f"Packet of {len(message)} bytes is bigger than the server's limit.")
+        if self.capabilities.version > 0: # servers from before the handshake don't know about frames either
+            message = frame(message)
+        with self.send_lock:
+            self.client.sendall(message)
+        if not expect_reply:
+            return []
+        return self.recv(blocking)
 
-        self.client.send(to_bytes(data))
-        return self.recv(blocking)
\ No newline at end of file
@@ -1,12 +1,15 @@
-from dataclasses import dataclass, asdict
+import threading
 from typing import Any
 from enum import Enum
 from datetime import datetime
 
 import msgpack
 
+from server.compression import COMPRESSED_EXT, decompress_packet
 
-unpacker = msgpack.Unpacker()
+
+# several packets sent together as one frame, see `pack_batch`
+BATCH_EXT = 2
 
 
 class PacketType(Enum):
@@ -22,38 +25,267 @@ class PacketType(Enum):
     WAIT = 10
     NOTIFICATION = 11
     STOP = 12
+    SUBSCRIBE = 13
+    UNSUBSCRIBE = 14
+    UPLOAD = 15
+    # tells a client using the compact schema what a channel ref stands for, see `compact_channel`
+    DEFINE = 16
+    # heartbeats, for noticing a connection that's gone quiet because the other end is gone
+    PING = 17
+    PONG = 18
 
 
-@dataclass
 class Packet:
-    packet_type: PacketType
-    data: Any = None
-    tag: str = None
+    # packets are made (and thrown away) for every single thing sent, so keep them small
+    __slots__ = ("packet_type", "data", "tag")
+
+    def __init__(self, packet_type: PacketType, data: Any = None, tag: str = None):
+        self.packet_type = packet_type
+        self.data = data
+        self.tag = tag
+
+    def __repr__(self) -> str:
+        return f"Packet(packet_type={self.packet_type!r}, data={self.data!r}, tag={self.tag!r})"
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Packet):
+            return NotImplemented
+        return (self.packet_type, self.data, self.tag) == (other.packet_type, other.data, other.tag)
+
+def timestamp_string(value: datetime) -> str:
+    """How timestamps are sent to peers that don't support the "timestamps" feature."""
+    if value.tzinfo is not None: # from another server, they always arrive in UTC
+        value = value.astimezone().replace(tzinfo=None)
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+def _string_timestamps(obj):
+    if isinstance(obj, datetime):
+        return timestamp_string(obj)
+    raise TypeError(f"Can't send {type(obj).__name__} in a packet.")
+
+def _native_timestamps(obj):
+    # sent as msgpack's own timestamp type, which the other side decodes straight back into a datetime
+    if isinstance(obj, datetime):
+        return msgpack.Timestamp.from_datetime(obj if obj.tzinfo is not None else obj.astimezone())
+    raise TypeError(f"Can't send {type(obj).__name__} in a packet.")
+
+# a Packer can't be used by two threads at once, so each thread gets its own (one for each way of sending timestamps)
+_packers = threading.local()
+
+def _packer(timestamps: bool) -> msgpack.Packer:
+    try:
+        return _packers.packers[timestamps]
+    except AttributeError:
+        _packers.packers = (msgpack.Packer(default=_string_timestamps), msgpack.Packer(default=_native_timestamps))
+        return _packers.packers[timestamps]
+
+# versions of the compact schema we know, negotiated like compression codecs are (see `server.capabilities`).
+# bump it (and keep the old one working) whenever the fields below change
+COMPACT_VERSIONS = (1,)
+
+# the packets sent often enough to be worth a compact encoding have their data sent as a list of these fields, in this order.
+# MESSAGE_RECV's channel_id, channel_name and server_ip are swapped for a single "channel" ref, which the client
+# is told the meaning of (with a DEFINE packet) the first time it comes up on that connection.
+# fields the packet doesn't have are left off the end of the list, so they're still missing once it's expanded
+COMPACT_FIELDS = {
+    PacketType.MESSAGE_RECV: ("message", "sender_name", "timestamp", "channel", "server_id"),
+    PacketType.MESSAGE_SEND: ("message", "channel_id", "username", "uuid")
+}
+COMPACT_KEYS = {
+    PacketType.MESSAGE_RECV: {"message", "sender_name", "timestamp", "channel_id", "channel_name", "server_ip", "server_id"},
+    PacketType.MESSAGE_SEND: {"message", "channel_id", "username", "uuid"}
+}
+# the keys a MESSAGE_RECV needs for its "channel" ref
+CHANNEL_KEYS = {"server_ip", "channel_id", "channel_name"}
+# same idea for DATA packets, sent as [type, *fields]
+COMPACT_DATA_FIELDS = {
+    "SERVER_MSGS": ("messages", "channel_name")
+}
+
+class ChannelRefs:
+    """Gives every channel (a server_ip and channel_id) a small number, the same one for every connection
+    so a broadcast can still be encoded once for all of them.
+    The name isn't part of it, so renaming a channel keeps its ref (and connections just get sent a new DEFINE for it)."""
+
+    def __init__(self):
+        self.refs: dict[tuple, int] = {}
+        self.lock = threading.Lock()
+
+    def get(self, channel: tuple) -> int:
+        key = channel[:2]
+        ref = self.refs.get(key)
+        if ref is None:
+            with self.lock:
+                ref = self.refs.setdefault(key, len(self.refs))
+        return ref
+
+channel_refs = ChannelRefs()
+
+def _channel(data: dict) -> tuple:
+    return data["server_ip"], data["channel_id"], data["channel_name"]
+
+def _compact_length(packet_type: PacketType, data: Any) -> int | None:
+    """How many of the packet's COMPACT_FIELDS get sent, or None if it has to be sent normally."""
+    # anything with fields the schema doesn't know about is sent normally, so nothing gets lost
+    if not isinstance(data, dict) or not data.keys() <= COMPACT_KEYS[packet_type]:
+        return None
+    if packet_type == PacketType.MESSAGE_RECV:
+        if not data.keys() >= CHANNEL_KEYS:
+            return None
+        data = {**data, "channel": None}
+
+    fields = COMPACT_FIELDS[packet_type]
+    length = len(fields)
+    while length and fields[length - 1] not in data:
+        length -= 1
+    # only missing fields at the end can be left off, one missing from the middle would come out as None
+    if any(field not in data for field in fields[:length]):
+        return None
+    return length
+
+def compact_channel(packet: Packet) -> tuple | None:
+    """The (ref, server_ip, channel_id, channel_name) a compact packet refers to, or None if it doesn't refer to one."""
+    if packet.packet_type != PacketType.MESSAGE_RECV or _compact_length(PacketType.MESSAGE_RECV, packet.data) is None:
+        return None
+
+    channel = _channel(packet.data)
+    return (channel_refs.get(channel), *channel)
 
-def to_bytes(packet: Packet):
-    # convert the packet to a dict, and then convert it to be bytes
-    # so it can be sent over the socket
-    if isinstance(packet.packet_type, PacketType):
-        packet.packet_type = packet.packet_type.value
+def _compact_data(packet_type: PacketType, data: Any) -> Any:
+    if packet_type in COMPACT_FIELDS:
+        length = _compact_length(packet_type, data)
+        if length is None:
+            return data
+        if packet_type == PacketType.MESSAGE_RECV:
+            data = {**data, "channel": channel_refs.get(_channel(data))}
+        return [data[field] for field in COMPACT_FIELDS[packet_type][:length]]
 
+    if packet_type == PacketType.DATA and isinstance(data, dict) and data.keys() == {"type", "data"}:
+        fields = COMPACT_DATA_FIELDS.get(data["type"])
+        if fields is not None and isinstance(data["data"], dict) and data["data"].keys() <= set(fields):
+            return [data["type"], *(data["data"].get(field) for field in fields)]
+    return data
+
+def _expand_data(packet_type: PacketType, data: list, channels: dict[int, tuple]) -> Any:
+    if packet_type in COMPACT_FIELDS:
+        fields = COMPACT_FIELDS[packet_type]
+        if len(data) > len(fields):
+            raise ValueError(f"Compact {packet_type.name} should have at most {len(fields)} fields, not {len(data)}.")
+        data = dict(zip(fields, data))
+
+        if packet_type == PacketType.MESSAGE_RECV:
+            if "channel" not in data:
+                raise ValueError("Compact MESSAGE_RECV is missing its channel ref.")
+            ref = data.pop("channel")
+            if channels is None or ref not in channels:
+                raise ValueError(f"Unknown channel ref {ref!r}.")
+            data["server_ip"], data["channel_id"], data["channel_name"] = channels[ref]
+        return data
+
+    if packet_type == PacketType.DATA and data and data[0] in COMPACT_DATA_FIELDS:
+        fields = COMPACT_DATA_FIELDS[data[0]]
+        if len(data) != len(fields) + 1:
+            raise ValueError(f"Compact {data[0]} should have {len(fields)} fields, not {len(data) - 1}.")
+        return {"type": data[0], "data": dict(zip(fields, data[1:]))}
+    return data
+
+def wire_data(data: Any) -> Any:
+    """Get packet data the way the other side will see it once it's been sent."""
     # ensure timestamps are converted to strings to avoid issues
-    if packet.data and packet.data.get("timestamp") and isinstance(packet.data["timestamp"], datetime):
-        packet.data["timestamp"] = datetime.strftime(packet.data["timestamp"], "%Y-%m-%d %H:%M:%S")
+    if isinstance(data, dict) and isinstance(data.get("timestamp"), datetime):
+        data = {**data, "timestamp": timestamp_string(data["timestamp"])}
+    return data
 
-    # return the bytes of the packet
-    return msgpack.packb(asdict(packet))
+def as_received(packet: Packet, timestamps: bool = False) -> Packet:
+    """Get a copy of a packet that looks like it went over the network and back, without actually encoding it.
 
-def to_packet(data):
-    packets = []
-    unpacker.feed(data)
-    #unpacked = msgpack.unpackb(data, raw=False) # convert the bytes to a dict
+    :parameter timestamps: Whether the other side supports the "timestamps" feature, if it does they're left as datetimes."""
+    return Packet(PacketType(packet.packet_type), packet.data if timestamps else wire_data(packet.data), packet.tag)
+
+def to_bytes(packet: Packet, timestamps: bool = False, compact: int = 0) -> bytes:
+    """Encode a packet so it can be sent over the socket. The packet itself isn't changed, since it might be sent to other clients too.
+
+    :parameter timestamps: Whether the other side supports the "timestamps" feature, otherwise datetimes are sent as strings.
+    :parameter compact: The compact schema version the other side agreed to, 0 for the normal one. Packets with a channel ref
+        (see `compact_channel`) need a DEFINE sent before them, NetworkConnection takes care of that."""
+    packet_type = packet.packet_type
+    if compact:
+        # [packet_type, data, tag], without the tag if there isn't one
+        packet_type = PacketType(packet_type)
+        data = _compact_data(packet_type, packet.data)
+        return _packer(timestamps).pack([packet_type.value, data] if packet.tag is None else [packet_type.value, data, packet.tag])
+
+    return _packer(timestamps).pack({
+        "packet_type": packet_type.value if isinstance(packet_type, PacketType) else packet_type,
+        "data": packet.data,
+        "tag": packet.tag
+    })
+
+def pack_batch(packets: list[bytes]) -> bytes:
+    """Join some already encoded packets together so they can be sent as one frame."""
+    return msgpack.packb(msgpack.ExtType(BATCH_EXT, b"".join(packets)))
+
+def _load_packet(unpacked, channels: dict[int, tuple] = None) -> Packet:
+    if isinstance(unpacked, list): # the compact schema
+        if len(unpacked) not in (2, 3):
+            raise ValueError("Compact packets must have 2 or 3 items.")
+        packet_type = PacketType(unpacked[0])
+        data = unpacked[1]
+        if isinstance(data, list):
+            data = _expand_data(packet_type, data, channels)
+        return Packet(packet_type, data, unpacked[2] if len(unpacked) == 3 else None)
 
-    for unpacked in unpacker:
-        packet = Packet(**unpacked) # load that dict into the Packet dataclass
+    if not isinstance(unpacked, dict):
+        raise ValueError("Packet data must be a map.")
+    if "packet_type" not in unpacked:
+        raise ValueError("Packet is missing its packet_type.")
 
-        # convert the packet_type from an int to an Enum
-        packet.packet_type = PacketType(packet.packet_type)
+    # convert the packet_type from an int to an Enum
+    return Packet(PacketType(unpacked["packet_type"]), unpacked.get("data"), unpacked.get("tag"))
+
+def _load_packets(items, channels: dict[int, tuple]) -> list[Packet]:
+    packets = []
+    for item in items:
+        if isinstance(item, msgpack.ExtType) and item.code == BATCH_EXT: # a batch that was batched again
+            unpacker = msgpack.Unpacker(raw=False, timestamp=3)
+            unpacker.feed(item.data)
+            packets.extend(_load_packets(unpacker, channels))
+            continue
+
+        packet = _load_packet(item, channels)
+        if packet.packet_type == PacketType.DEFINE and channels is not None:
+            # only there so later packets make sense, so it isn't handed on
+            ref, server_ip, channel_id, channel_name = packet.data
+            channels[ref] = (server_ip, channel_id, channel_name)
+            continue
         packets.append(packet)
+    return packets
+
+def to_packets(data, channels: dict[int, tuple] = None) -> list[Packet]:
+    """Decode a frame (or websocket message), which can hold one packet or a whole batch of them.
+
+    :parameter channels: The channel refs the other side has defined, for connections using the compact schema.
+        It's kept up to date with any DEFINE packets in the frame, so pass the same dict in every time."""
+    # convert the bytes to a dict, timestamps come out as (UTC) datetimes
+    unpacked = msgpack.unpackb(data, raw=False, timestamp=3)
+
+    # big packets (or batches) may have been compressed
+    if isinstance(unpacked, msgpack.ExtType) and unpacked.code == COMPRESSED_EXT:
+        unpacked = msgpack.unpackb(decompress_packet(unpacked), raw=False, timestamp=3)
+
+    if isinstance(unpacked, msgpack.ExtType) and unpacked.code == BATCH_EXT:
+        unpacker = msgpack.Unpacker(raw=False, timestamp=3)
+        unpacker.feed(unpacked.data)
+        # the packets come out in the same order they were sent in
+        return _load_packets(unpacker, channels)
+
+    return _load_packets((unpacked,), channels)
+
+def to_packet(data) -> Packet:
+    """Decode a frame that holds exactly one packet."""
+    packets = to_packets(data)
+    if len(packets) != 1:
+        raise ValueError("Expected a single packet, got a batch.")
 
-    # return the packets
-    return packets
\ No newline at end of file
+    # return the packet
+    return packets[0]
@@ -0,0 +1,157 @@
+"""Token buckets, so one client can't keep the server busy by sending packets as fast as its socket allows.
+
+Every packet type can have a limit for each connection and another for each user (shared between all of their
+connections), set in the RateLimits and UserRateLimits sections of the server's settings as "<per second>, <burst>".
+A packet over either limit isn't handled at all, the client gets a WAIT saying how long until it can try again.
+
+Users are told apart by the uuid their connection identified with (see `SessionRegistry.identify`), not whatever
+uuid is in the packet, otherwise anyone could use up someone else's limit or dodge their own.
+"""
+from __future__ import annotations
+
+import time
+import weakref
+from collections import OrderedDict
+from configparser import ConfigParser
+
+from server.config import conf_get
+from server.packet import Packet, PacketType
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, now: float, cost: float = 1) -> float:
+        """How many seconds until `cost` tokens are available, 0 if they are now."""
+        self.refill(now)
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def take(self, cost: float = 1) -> None:
+        self.tokens -= cost
+
+    @property
+    def full(self) -> bool:
+        return self.tokens >= self.burst
+
+
+def option_name(packet_type: PacketType) -> str:
+    """MESSAGE_SEND -> message-send, how packet types are named in the settings."""
+    return packet_type.name.lower().replace("_", "-")
+
+def parse_limit(value: str) -> tuple[float, float] | None:
+    """Turn "<per second>, <burst>" into (rate, burst), None if the packet type isn't limited."""
+    if value is None: return None
+
+    rate, _, burst = str(value).partition(",")
+    rate = float(rate)
+    burst = float(burst) if burst.strip() else max(rate, 1)
+    if rate <= 0: return None
+    return rate, max(burst, 1)
+
+def read_limits(config: ConfigParser, section: str) -> dict[PacketType, tuple[float, float]]:
+    limits = {}
+    for packet_type in PacketType:
+        try:
+            limit = parse_limit(conf_get(config, section, option_name(packet_type)))
+        except KeyError: # not in the settings or the defaults, so it isn't limited
+            continue
+        except ValueError:
+            raise ValueError(f"Invalid rate limit for {option_name(packet_type)} in [{section}], it should look like \"5, 10\".")
+
+        if limit is not None:
+            limits[packet_type] = limit
+    return limits
+
+
+class RateLimiter:
+    """Per connection and per user token buckets. Only ever used from the event loop, so there's no locking."""
+    # once we're tracking this many users, forget the ones whose buckets are full (they haven't sent anything for a while),
+    # and if that isn't enough the ones we've heard from least recently
+    max_users: int = 10000
+
+    def __init__(self, config: ConfigParser):
+        self.connection_limits = read_limits(config, "RateLimits")
+        self.user_limits = read_limits(config, "UserRateLimits")
+
+        # connections get forgotten along with everything else about them once they close
+        self.connection_buckets: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        # least recently used first
+        self.user_buckets: OrderedDict[str, dict[PacketType, TokenBucket]] = OrderedDict()
+
+        # stats
+        self.checked = 0
+        self.throttled: dict[str, int] = {}
+
+    def __bucket(self, buckets: dict, packet_type: PacketType, limit: tuple[float, float], now: float) -> TokenBucket:
+        bucket = buckets.get(packet_type)
+        if bucket is None:
+            bucket = buckets[packet_type] = TokenBucket(*limit, now)
+        return bucket
+
+    def __user_buckets(self, user_uuid: str) -> dict[PacketType, TokenBucket]:
+        buckets = self.user_buckets.get(user_uuid)
+        if buckets is None:
+            if len(self.user_buckets) >= self.max_users:
+                self.prune()
+            while len(self.user_buckets) >= self.max_users:
+                self.user_buckets.popitem(last=False)
+            buckets = self.user_buckets[user_uuid] = {}
+        else:
+            self.user_buckets.move_to_end(user_uuid)
+        return buckets
+
+    def check(self, packet: Packet, conn) -> float:
+        """Use up a token for the packet, returning 0 if it can be handled or how many seconds the client should wait if it can't."""
+        connection_limit = self.connection_limits.get(packet.packet_type)
+        user_limit = self.user_limits.get(packet.packet_type)
+        if connection_limit is None and user_limit is None:
+            return 0.0
+
+        self.checked += 1
+        now = time.monotonic()
+        buckets = []
+        if connection_limit is not None:
+            connection_buckets = self.connection_buckets.setdefault(conn, {})
+            buckets.append(self.__bucket(connection_buckets, packet.packet_type, connection_limit, now))
+
+        if user_limit is not None and conn.user_uuid:
+            buckets.append(self.__bucket(self.__user_buckets(conn.user_uuid), packet.packet_type, user_limit, now))
+
+        # only take from either bucket if both have room, otherwise being throttled by one would still use up the other
+        wait = max((bucket.wait(now) for bucket in buckets), default=0.0)
+        if wait > 0:
+            name = option_name(packet.packet_type)
+            self.throttled[name] = self.throttled.get(name, 0) + 1
+            conn.throttled += 1
+            return wait
+
+        for bucket in buckets:
+            bucket.take()
+        return 0.0
+
+    def prune(self) -> None:
+        now = time.monotonic()
+        for user_uuid, buckets in list(self.user_buckets.items()):
+            for bucket in buckets.values():
+                bucket.refill(now)
+            if all(bucket.full for bucket in buckets.values()):
+                del self.user_buckets[user_uuid]
+
+    def stats(self) -> dict:
+        return {
+            "checked": self.checked,
+            "throttled": sum(self.throttled.values()),
+            "by_type": dict(sorted(self.throttled.items()))
+        }
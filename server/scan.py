@@ -4,8 +4,10 @@ import ipaddress
 import concurrent.futures
 try:
     from server.packet import Packet, PacketType, to_bytes, to_packet
+    from server.framing import UnframedDecoder, recv_frames
 except ModuleNotFoundError:
     from packet import Packet, PacketType, to_bytes, to_packet
+    from framing import UnframedDecoder, recv_frames
 
 # The port to scan for
 PORT = 5555
@@ -63,15 +65,28 @@ def scan_ip(ip):
         
 
         if result == 0:
-            # get info about the server
-            sock.recv(2048) # throw the "connection received" message out
-            sock.send(to_bytes(Packet(PacketType.GET, {"type": "INFO"})))
-            response = to_packet(sock.recv(2048))[0]
+            # get info about the server. sent unframed like clients from before framing do, so old and new servers both answer
+            decoder = UnframedDecoder(buffer_size=4096)
+            sock.sendall(to_bytes(Packet(PacketType.GET, {"type": "INFO"})))
 
-            sock.send(to_bytes(Packet(PacketType.DISCONNECT,None)))
+            # throw the "connection received" message (and anything else that isn't an answer) out.
+            # any answer means there's a server there, even if it's too busy (WAIT) to tell us about itself
+            response = None
+            while response is None:
+                for body in recv_frames(sock, decoder):
+                    packet = to_packet(body)
+                    if packet.packet_type in (PacketType.DATA, PacketType.WAIT, PacketType.ERROR):
+                        response = packet
+                        break
+
+            sock.sendall(to_bytes(Packet(PacketType.DISCONNECT,None)))
             sock.close()
             
-            data = response.data
+            if response.packet_type == PacketType.DATA:
+                data = response.data
+                data["busy"] = data["data"].get("load") == "shedding"
+            else:
+                data = {"data": {"title": None, "online": None}, "type": "SERVER_INFO", "busy": response.packet_type == PacketType.WAIT}
             data["ip"] = str(ip)
 
             return data
@@ -1,13 +1,14 @@
 from __future__ import annotations
+import asyncio
 import socket
-import threading
 
 import msgpack
-import sys, os
+import sys, os, re
 import traceback
 from _thread import start_new_thread
-from datetime import datetime
-from time import sleep
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import sleep, monotonic
 
 from textual.widgets import RichLog
 from rich.traceback import install
@@ -15,8 +16,16 @@ from rich.console import Console
 
 from server.formats.network_format import NetworkConnection
 from server.formats.network_format_manager import NetworkFormatManager
-from server.packet import Packet, PacketType, to_bytes, to_packet
+from server.packet import Packet, PacketType
+from server.framing import FrameTooLarge
 from server.db import Database
+from server.config import load_config, conf_get
+from server.uploads import UploadManager, UploadError
+from server.capabilities import hello, negotiate
+from server.broker import make_broker
+from server.ratelimit import RateLimiter
+from server.load import LoadShedder
+from server.sessions import connection_ip
 
 from api import command, Channel, Message
 
@@ -32,12 +41,13 @@ class Server:
         self.log_level = log_level
         self.rich_log = rich_log
         self.interactive = interactive
-        self.BLOCKED_IPS = []
+        self.BLOCKED_IPS: set[str] = set()
 
         self.server_info = {
             "title": title,
             "description": description,
-            "online": 0
+            # "shedding" when the server is too busy to handle everything, see LoadShedder
+            "load": "normal"
         }
         self.running = True
 
@@ -48,18 +58,34 @@ class Server:
 
         self.ip = ""
 
-        self.network_format_manager = NetworkFormatManager()
-        self.network_format_manager.network_functions.on_client_open = self.handle_client
-        self.network_format_manager.network_functions.log = self.nf_log
-
         # create needed folders
         NEEDED_FOLDERS = ["portal_server", "portal_server/user_icons"]
         for folder in NEEDED_FOLDERS:
             if not os.path.isdir(folder):
                 os.mkdir(folder)
 
+        self.config = load_config()
+
+        self.uploads = UploadManager("portal_server", {
+            "icon": int(conf_get(self.config, "Uploads", "max-icon-size")),
+            "attachment": int(conf_get(self.config, "Uploads", "max-attachment-size"))
+        })
+
+        self.network_format_manager = NetworkFormatManager()
+        self.network_format_manager.config = self.config
+        self.network_format_manager.network_functions.on_client_open = self.handle_client
+        self.network_format_manager.network_functions.log = self.nf_log
+        self.network_format_manager.broker = make_broker(self.config)
+        self.rate_limiter = RateLimiter(self.config)
+
         self.log("Getting database...")
         self.db = Database(self, "portal_server/db.db")
+        # every database call runs on these threads, so the event loop never waits on sqlite.
+        # each one reads through its own connection, and writes all go through the database's writer thread
+        self.db_executor = ThreadPoolExecutor(max_workers=int(conf_get(self.config, "Database", "read-threads")), thread_name_prefix="portal-db")
+        # decides what order database jobs run in, and turns some away when there's too many
+        self.load = LoadShedder(self.db_executor, self.config)
+        self.load.on_change = self.on_load_change
     
     def __str__(self):
         return f"<{self.server_info['title']}>"
@@ -130,7 +156,9 @@ class Server:
         self.network_format_manager.close()
         #self.sock.close()
         self.log("Disconnecting db...", 1)
+        self.db_executor.shutdown(wait=True)
         self.db.close()
+        self.uploads.close()
 
     def parse_command(self, message: str, channel_id: int, sender_info: dict):
         message = message.removeprefix("/")
@@ -138,7 +166,8 @@ class Server:
         command_name = args.pop(0)
 
         # Construct a command context
-        channel_ctx = Channel({"channel_id": channel_id, "name": self.db.get_channel_name_by_id(channel_id), "server_id": self.db.get_server_from_channel(channel_id)[0]}, self)
+        channel_name, server = self.get_channel(channel_id)
+        channel_ctx = Channel({"channel_id": channel_id, "name": channel_name, "server_id": server[0]}, self)
         message_ctx = Message({"content": message, "channel_id": channel_id, "channel_name": channel_ctx.name, "timestamp": datetime.now(), "server_id": channel_ctx.server_id}, self)
         context = command.CommandContext(
             channel_ctx,
@@ -154,17 +183,18 @@ class Server:
             self.log(f"{sender_info['username']} tried running an invalid command.")
 
     def send_message(self, message: str, channel_id: int, sender_conn: NetworkConnection, sender_info: dict):
-        """Send a message to all users and save the message to the DB."""
+        """Send a message to all users and save the message to the DB.
+        Returns False if it wasn't sent, otherwise the Future of saving it (or True for commands, which aren't saved)."""
         # if sender_info is None, that means that the message is a system msg
         if sender_info:
             sender_name: str = sender_info["username"]
             sender_uuid: str = sender_info["uuid"]
 
             if sender_uuid == "00000000-0000-0000-0000-000000000000":
-                sender_conn.sendall(to_bytes(Packet(
+                sender_conn.send_packet(Packet(
                     PacketType.NOTIFICATION,
                     "Don't try to pretend to be a system user. :P"
-                )))
+                ))
                 return False
         else:
             sender_name = "SYSTEM"
@@ -172,21 +202,16 @@ class Server:
 
         if sender_uuid:
             if sender_name.strip() == "" or len(sender_name) > 25: # invalid username
-                sender_conn.sendall(to_bytes(Packet(
+                sender_conn.send_packet(Packet(
                     PacketType.NOTIFICATION,
                     "You can't send messages because your username is invalid."
-                )))
+                ))
                 return False
 
-            if not self.db.user_exists(sender_uuid):
-                self.log(f"Creating user because doesn't exist: {sender_uuid}")
-                self.db.create_user(sender_name, sender_uuid)
-                self.db.commit()
-
-            current_username = self.db.get_user(sender_uuid)[1] 
-            if current_username != sender_name: # user has changed their username since their last msg
-                self.db.update_username(sender_uuid, sender_name)
-                self.log(f"Updated username for {sender_uuid} from {current_username} to {sender_name}")
+            # only a write if they're new or have changed their name, most of the time the cache already knows them
+            user = self.db.cache.user(sender_uuid)
+            if user is None or user[1] != sender_name:
+                self.db.ensure_user(sender_name, sender_uuid)
 
         # was it a command?
         if sender_uuid and message.startswith("/"):
@@ -196,25 +221,28 @@ class Server:
 
         # send the message to all users in the server
         self.log(f"@{sender_name} said \"{message}\" in channel ID [cyan]{channel_id}[/cyan].")
-        if sender_uuid:
-            self.db.create_message_in_channel(channel_id, sender_uuid, sender_name, message)
-        else:
-            self.db.create_message_in_channel(channel_id, "00000000-0000-0000-0000-000000000000", "SYSTEM", message)
-        self.log("Saving DB...")
-        self.db.commit()
-
+        channel_name, server = self.get_channel(channel_id)
         packet = Packet(
                 PacketType.MESSAGE_RECV,
-                {"message": message, "sender_name": sender_name, "timestamp": datetime.now(), "channel_id": channel_id, "channel_name": self.db.get_channel_name_by_id(channel_id), "server_id": self.db.get_server_from_channel(channel_id)[0], "server_ip": self.ip}
+                {"message": message, "sender_name": sender_name, "timestamp": datetime.now(), "channel_id": channel_id, "channel_name": channel_name, "server_id": server[0], "server_ip": self.ip}
             )
 
-        self.network_format_manager.send_to_all_clients(to_bytes(packet))
+        # the writer saves it along with everyone else's messages (see `server.db_writer`), no need to wait for it here.
+        # the channel's been found above and the user was made before it if they're new, so that's not checked again
+        if sender_uuid:
+            saved = self.db.create_message_in_channel(channel_id, sender_uuid, sender_name, message, checked=True)
+        else:
+            saved = self.db.create_message_in_channel(channel_id, "00000000-0000-0000-0000-000000000000", "SYSTEM", message, checked=True)
+
+        # only people looking at the channel get the message, plus anyone mentioned in it (for notifications)
+        mentions = re.findall(r"@(\S+)", message)
+        self.network_format_manager.send_to_channel(channel_id, packet, mentions)
         #for user in:
             #if user == sender_conn: continue
             #self.log(f"Sending packet to {user}: {packet}", 2)
             #user.send()
 
-        return True
+        return saved
 
     def interactive_terminal(self):
         while True:
@@ -224,9 +252,274 @@ class Server:
                 if user_input == "close":
                     self.stop()
                     break
+                elif user_input == "connections":
+                    for stats in self.network_format_manager.connection_stats():
+                        self.log(f"{stats['format']} {stats['addr']}: {stats['depth']} queued ({stats['bytes']} bytes, peak {stats['peak']}), {stats['sent']} sent, {stats['dropped']} dropped, {stats['throttled']} throttled [dim]({stats['policy']})[/dim]")
+                        self.log(f"    protocol v{stats['protocol']}, {stats['writes']} writes, {stats['packets_per_write']} packets per write")
+                        if stats["compression"]:
+                            self.log(f"    {stats['compression']}: {stats['compression_compressed']}/{stats['compression_packets']} packets compressed, {stats['compression_bytes_in']} -> {stats['compression_bytes_out']} bytes (x{stats['compression_ratio']})")
+                    sessions = self.network_format_manager.sessions.stats()
+                    self.log(f"Sessions: {sessions['online']} online (peak {sessions['peak']}, {sessions['total']} since starting), {sessions['users']} users, {sessions['addresses']} addresses, {sessions['channels']} channels watched")
+                    load = self.load.stats()
+                    self.log(f"Load: {load['state']}, {load['depth']} waiting (peak {load['peak_depth']}, oldest {load['oldest_wait_ms']}ms), latency {load['latency_ms']}ms (critical {load['critical_latency_ms']}ms), {load['shed']} shed")
+                    writes = self.db.writer.stats()
+                    cache = self.db.cache.stats()
+                    self.log(f"Cache: {cache['hit_rate']}% hits ({cache['hits']} hits, {cache['misses']} misses), {cache['channels']} channels and {cache['users']} users cached, {cache['invalidations']} invalidations")
+                    self.log(f"Database: {writes['jobs']} writes in {writes['batches']} commits ({writes['jobs_per_batch']} per commit, biggest {writes['biggest_batch']}), avg commit {writes['avg_commit_ms']}ms, {writes['failed']} failed [dim]({writes['durability']})[/dim]")
+                    limits = self.rate_limiter.stats()
+                    self.log(f"Rate limits: {limits['throttled']}/{limits['checked']} packets throttled" + "".join(f", {name}: {count}" for name, count in limits["by_type"].items()))
+                    broker = self.network_format_manager.broker
+                    if broker is not None:
+                        stats = broker.stats()
+                        self.log(f"{stats['backend']}: {stats['nodes']} servers, {stats['published']} published, {stats['delivered']} delivered (publish to deliver: avg {stats['avg_ms']}ms, p50 {stats['p50_ms']}ms, p99 {stats['p99_ms']}ms, max {stats['max_ms']}ms)")
+                elif user_input.startswith("block "):
+                    ip = user_input.removeprefix("block ").strip()
+                    self.BLOCKED_IPS.add(ip)
+                    connections = self.network_format_manager.sessions.by_ip(ip)
+                    for conn in connections:
+                        self.network_format_manager.run_coroutine(conn.close())
+                    self.log(f"Blocked {ip}, disconnected {len(connections)} clients.")
             except (EOFError, KeyboardInterrupt): break
 
-    def handle_packet(self, packet: Packet, conn: NetworkConnection):
+    def on_load_change(self, shedding: bool):
+        self.server_info["load"] = "shedding" if shedding else "normal"
+        if shedding:
+            stats = self.load.stats()
+            self.log(f"Server is overloaded ({stats['depth']} requests waiting, oldest for {stats['oldest_wait_ms']}ms), turning away non-essential requests.", 3)
+        else:
+            self.log("Server has caught up, handling everything again.")
+
+    def handle_subscription(self, packet: Packet, conn: NetworkConnection):
+        if not isinstance(packet.data, dict) or "channel_id" not in packet.data:
+            return Packet(PacketType.ERROR, "No channel to subscribe to!", tag=packet.tag)
+        # this runs on the event loop so it can't look the channel up, but anything that isn't an id can't be one.
+        # (bool is an int too, but True isn't a channel)
+        if type(packet.data["channel_id"]) is not int:
+            return Packet(PacketType.ERROR, "Invalid channel id!", tag=packet.tag)
+
+        if packet.packet_type == PacketType.SUBSCRIBE:
+            self.network_format_manager.subscribe(conn, packet.data["channel_id"], packet.data.get("username"), packet.data.get("uuid"))
+        else:
+            self.network_format_manager.unsubscribe(conn, packet.data["channel_id"])
+        return None
+
+    def handle_upload(self, packet: Packet, conn: NetworkConnection):
+        """Handle an UPLOAD packet. This writes to disk, so it runs on a worker thread rather than the database threads."""
+        data = packet.data
+        reply = None
+
+        try:
+            if data["type"] == "START":
+                upload = self.uploads.start(data["uuid"], data["upload_id"], data["kind"], data["size"], data["sha256"], data.get("name"))
+                reply = upload.status("done" if upload.done else "ready")
+            elif data["type"] == "CHUNK":
+                upload, accepted = self.uploads.write_chunk(data["uuid"], data["upload_id"], data["offset"], data["data"], data["crc32"])
+
+                if upload.done and accepted:
+                    self.log(f"Received {upload.kind} upload from {upload.owner_uuid} ({upload.size} bytes).")
+                    reply = upload.status("done")
+                elif not accepted and upload.requested_offset != upload.offset:
+                    # chunks after a bad one will all be out of order, only ask for them again once
+                    upload.requested_offset = upload.offset
+                    reply = upload.status("resend")
+            else:
+                return Packet(PacketType.ERROR, "Invalid UPLOAD type!", tag=packet.tag)
+        except UploadError as e:
+            return Packet(PacketType.ERROR, str(e), tag=packet.tag)
+        except (KeyError, TypeError):
+            return Packet(PacketType.ERROR, "Invalid UPLOAD packet!", tag=packet.tag)
+        except OSError:
+            self.log(f"Error while handling upload:\n[bold red]{traceback.format_exc()}[/bold red]", 3)
+            return Packet(PacketType.ERROR, "Internal Server Error", tag=packet.tag)
+
+        if reply:
+            return Packet(PacketType.DATA, reply, tag=packet.tag)
+
+    def handle_connection_options(self, packet: Packet, conn: NetworkConnection):
+        """The client answered our CONNECTION_STARTED with the features it wants to use."""
+        if not isinstance(packet.data, dict):
+            return None
+
+        capabilities = negotiate(packet.data, self.config)
+        conn.use_capabilities(capabilities)
+        self.log(f"{conn.addr} is using protocol version {capabilities.version} with {', '.join(sorted(capabilities.features)) or 'no features'}.", 1)
+        return None
+
+    async def handle_packet(self, packet: Packet, conn: NetworkConnection):
+        if packet.packet_type == PacketType.CONNECTION_STARTED:
+            return self.handle_connection_options(packet, conn)
+        if packet.packet_type == PacketType.PING:
+            return Packet(PacketType.PONG, tag=packet.tag)
+
+        if packet.packet_type == PacketType.MESSAGE_SEND and isinstance(packet.data, dict):
+            # so the client can be found by who's using it (and rate limited as them), not just what channels it's watching
+            self.network_format_manager.sessions.identify(conn, packet.data.get("username"), packet.data.get("uuid"))
+
+        # turn away clients sending too much before doing any work for them
+        retry_after = self.rate_limiter.check(packet, conn)
+        if retry_after > 0:
+            self.log(f"Throttled {packet.packet_type.name} from {conn.addr}, retry in {retry_after:.2f}s.", 1)
+            wait = {"packet_type": packet.packet_type.value, "retry_after": round(retry_after, 3), "reason": "rate-limited"}
+            if packet.packet_type == PacketType.UPLOAD and isinstance(packet.data, dict):
+                # say where to carry on from, if it was the last chunks that got turned away nothing else would
+                offset = self.uploads.offset(packet.data.get("uuid"), packet.data.get("upload_id"))
+                if offset is not None:
+                    wait.update(upload_id=packet.data["upload_id"], offset=offset)
+            return Packet(PacketType.WAIT, wait, tag=packet.tag)
+
+        if packet.packet_type in (PacketType.SUBSCRIBE, PacketType.UNSUBSCRIBE):
+            # subscriptions only live in memory, so there's no need to go through the database threads
+            return self.handle_subscription(packet, conn)
+        if packet.packet_type == PacketType.UPLOAD:
+            return await asyncio.get_running_loop().run_in_executor(None, self.handle_upload, packet, conn)
+
+        # too busy for things that can wait, so the important stuff still gets through quickly
+        if self.load.should_shed(packet):
+            return Packet(PacketType.WAIT, {"packet_type": packet.packet_type.value, "retry_after": self.load.retry_after(), "reason": "overloaded"}, tag=packet.tag)
+
+        if packet.packet_type == PacketType.MESSAGE_SEND:
+            return await self.handle_message_send(packet, conn)
+        return await self.load.run(self.process_packet, packet, conn, critical=self.load.is_critical(packet))
+
+    async def handle_message_send(self, packet: Packet, conn: NetworkConnection):
+        """Handle a MESSAGE_SEND, only answering once the message has been saved."""
+        try:
+            reply, saved = await self.load.run(self.process_message_send, packet, conn, critical=self.load.is_critical(packet))
+        except Exception:
+            self.log(f"Error while handling packet:\n[bold red]{traceback.format_exc()}[/bold red]", 3)
+            return Packet(PacketType.ERROR, "Internal Server Error", tag=packet.tag)
+
+        if saved is not None:
+            # lots of clients waiting here end up sharing one commit
+            try:
+                await asyncio.wrap_future(saved)
+            except Exception as e: # the database was busy, or the commit failed some other way
+                self.log(f"Couldn't save a message from {conn.addr}: {e!r}", 3)
+                return Packet(PacketType.ERROR, "Your message couldn't be saved, try sending it again.", tag=packet.tag)
+
+        reply.tag = packet.tag
+        return reply
+
+    def process_message_send(self, packet: Packet, conn: NetworkConnection) -> tuple[Packet, Future | None]:
+        """Send a message for a client, returning the reply and the Future of saving it (None if nothing's being saved).
+        Like `process_packet`, this should only be called from one of the database threads."""
+        msg = packet.data["message"].strip()
+
+        if msg == "":
+            reply = Packet(PacketType.ERROR, "Can't send an empty message.")
+
+        channel_id = packet.data["channel_id"] # TODO: check if the user has permission to send to that channel
+
+        user_name = packet.data["username"]
+        was_sent = self.send_message(msg, channel_id, conn, {"username": user_name, "uuid": packet.data["uuid"]})
+        reply = Packet(
+                PacketType.MESSAGE_RECV,
+                {"message": msg, "sender_name": f"{user_name}{not was_sent and ' [dim red](NOT SENT)[/] ' or ''}", "timestamp": datetime.now(), "channel_id": channel_id, "channel_name": self.db.cache.channel_name(channel_id), "server_ip": self.ip}
+            )
+        return reply, was_sent if isinstance(was_sent, Future) else None
+
+    async def handle_client(self, conn: NetworkConnection) -> bool:
+        self.log(f"New connection! Address: {conn.addr}")
+
+        if connection_ip(conn) in self.BLOCKED_IPS:
+            self.log(f"Ignored connection from blocked IP: {conn.addr}", 3)
+            await conn.close()
+            return False
+
+        max_per_ip = int(conf_get(self.config, "Network", "max-connections-per-ip"))
+        if max_per_ip > 0 and self.network_format_manager.sessions.count_ip(connection_ip(conn)) >= max_per_ip:
+            self.log(f"Refused connection from {conn.addr}, it already has {max_per_ip} connections open.", 3)
+            await conn.close()
+            return False
+
+        self.network_format_manager.report_online(self.network_format_manager.track(conn))
+
+        # tell the client what we support, older clients just throw this away
+        conn.send_greeting(Packet(PacketType.CONNECTION_STARTED, hello(self.config)))
+
+        try:
+            while self.network_format_manager.running:
+                try:
+                    data = await conn.recv()
+                except EOFError:
+                    self.log("Client closed the connection.", 1)
+                    break
+                except (FrameTooLarge, msgpack.FormatError, msgpack.StackError, ValueError, TypeError):
+                    self.log(
+                        f"CLIENT ATTEMPTED TO SEND NON-PACKET DATA:\n\t- Client: {conn.addr}\n\t- Traceback: [bold red]{traceback.format_exc()}",
+                        3)
+                    break
+                except socket.error:
+                    self.log(
+                        f"A client created a socket error. The connection will be closed.\n\t- Client: {conn.addr}\n\t- Error: [bold red]{traceback.format_exc()}",
+                        3)
+                    break
+
+                conn.last_received = monotonic()
+                self.log(f"Receive: {data}", 1)
+
+                if data.packet_type == PacketType.DISCONNECT:
+                    self.log("Client disconnected via packet.", 1)
+                    break
+
+                reply = await self.handle_packet(data, conn)
+
+                self.log(f"Send   : {reply}", 1)
+
+                if reply != None:
+                    conn.send_packet(reply)
+        finally:
+            self.log(f"Closing connection to {conn.addr}.")
+            await conn.close()
+            self.network_format_manager.report_online(self.network_format_manager.forget(conn))
+
+        return True
+
+    def get_channel(self, channel_id: int) -> tuple[str, tuple]:
+        """A channel's name and the server it's in, from the cache."""
+        channel = self.db.cache.channel(channel_id)
+        if channel is None:
+            raise ValueError(f"Channel ID {channel_id} does not exist.")
+        return channel
+
+    def get_history(self, data: dict) -> Packet:
+        """A page of a channel's history, for clients that load it bit by bit as they scroll instead of all at once.
+        `before`/`after` are message ids from a previous page, `at` jumps to a time and `limit` is the page size.
+        `at` can be a datetime or an ISO 8601 string, ones without a timezone are taken as the server's local time
+        (the same as the times older clients are sent)."""
+        channel_id, at = data.get("channel_id"), data.get("at")
+        before, after, limit = data.get("before"), data.get("after"), data.get("limit")
+
+        # anything left out is fine, but anything that's there has to make sense (and True isn't a message id)
+        if type(channel_id) is not int or any(value is not None and type(value) is not int for value in (before, after, limit)):
+            return Packet(PacketType.ERROR, "Invalid history request")
+        if isinstance(at, str):
+            try:
+                at = datetime.fromisoformat(at)
+            except ValueError:
+                return Packet(PacketType.ERROR, "Invalid history request")
+        elif at is not None and not isinstance(at, datetime):
+            return Packet(PacketType.ERROR, "Invalid history request")
+
+        channel_name = self.db.cache.channel_name(channel_id)
+        if channel_name is None:
+            return Packet(PacketType.ERROR, "Channel doesn't exist!")
+
+        page_size = int(conf_get(self.config, "History", "page-size"))
+        limit = max(1, min(limit if limit is not None else page_size, int(conf_get(self.config, "History", "max-page-size"))))
+
+        if at is not None:
+            # the database keeps times in UTC, astimezone reads naive times as local ones
+            at = at.astimezone(timezone.utc)
+            message_id = self.db.get_message_at(channel_id, at.strftime("%Y-%m-%d %H:%M:%S"))
+            # start the page at the first message since then, or show the latest ones if nothing's been sent since
+            before, after = None, (message_id - 1 if message_id is not None else None)
+
+        messages, older, newer = self.db.get_message_page(channel_id, before, after, limit)
+        return Packet(PacketType.DATA, {"data": {"messages": messages, "channel_name": channel_name, "older": older, "newer": newer}, "type": "SERVER_HISTORY"})
+
+    def process_packet(self, packet: Packet, conn: NetworkConnection):
+        """Work out the reply to a packet. This blocks on the database, so it should only be called from one of the database threads."""
         reply = None
         
         try:
@@ -234,22 +527,27 @@ class Server:
                 reply = None
             elif packet.packet_type == PacketType.GET:
                 if packet.data["type"] == "INFO":
-                    reply = Packet(PacketType.DATA, {"data": self.server_info, "type": "SERVER_INFO"})
+                    info = {**self.server_info, "online": self.network_format_manager.sessions.online}
+                    if self.network_format_manager.broker is not None: # count everyone connected to any of the servers
+                        info["online"] = self.network_format_manager.broker.online
+                    reply = Packet(PacketType.DATA, {"data": info, "type": "SERVER_INFO"})
                 elif packet.data["type"] == "CHANNELS": # TODO: create private channels
                     channels = self.db.get_channels_in_server(self.db.get_server_by_name(self.server_info["title"])[0])
                     reply = Packet(PacketType.DATA, {"data": channels, "type": "SERVER_CHANNELS"})
                 elif packet.data["type"] == "MESSAGES": # TODO: don't let the user see message history of private channels
                     channel_id = packet.data["channel_id"]
                     messages = self.db.get_messages_in_channel(channel_id)
-                    server = self.db.get_server_from_channel(channel_id)
+                    channel = self.db.cache.channel(channel_id)
 
-                    if messages == None and server == None:
+                    if messages == None and channel == None:
                         reply = Packet(PacketType.ERROR, "Channel doesn't exist!")
                     else:
-                        reply = Packet(PacketType.DATA, {"data": {"messages": messages, "channel_name": self.db.get_channel_name_by_id(channel_id)}, "type": "SERVER_MSGS"})
+                        reply = Packet(PacketType.DATA, {"data": {"messages": messages, "channel_name": channel and channel[0]}, "type": "SERVER_MSGS"})
+                elif packet.data["type"] == "HISTORY":
+                    reply = self.get_history(packet.data)
                 elif packet.data["type"] == "MEMBERS":
                     channel_id = packet.data["channel_id"]
-                    server = self.db.get_server_from_channel(channel_id)
+                    server = self.db.cache.channel_server(channel_id)
 
                     if not server:
                         return Packet(PacketType.ERROR, "Channel does not exist!", tag=packet.tag)
@@ -263,19 +561,7 @@ class Server:
                 else:
                     reply = Packet(PacketType.ERROR, "Invalid GET type!")
             elif packet.packet_type == PacketType.MESSAGE_SEND:
-                msg = packet.data["message"].strip()
-
-                if msg == "":
-                    reply = Packet(PacketType.ERROR, "Can't send an empty message.")
-
-                channel_id = packet.data["channel_id"] # TODO: check if the user has permission to send to that channel
-                
-                user_name = packet.data["username"]
-                was_sent = self.send_message(msg, channel_id, conn, {"username": user_name, "uuid": packet.data["uuid"]})
-                reply = Packet(
-                        PacketType.MESSAGE_RECV,
-                        {"message": msg, "sender_name": f"{user_name}{not was_sent and ' [dim red](NOT SENT)[/] ' or ''}", "timestamp": datetime.now(), "channel_id": channel_id, "channel_name": self.db.get_channel_name_by_id(channel_id), "server_ip": self.ip}
-                    )
+                reply, _ = self.process_message_send(packet, conn)
             else:
                 reply = Packet(PacketType.ERROR, "Invalid packet type!")
         except Exception:
@@ -286,62 +572,6 @@ class Server:
             reply.tag = packet.tag
         return reply
 
-    def handle_client(self, conn: NetworkConnection) -> bool:
-        self.log(f"New connection! Address: {conn.addr}")
-
-        if conn.addr[0] in self.BLOCKED_IPS:
-            self.log(f"Ignored connection from blocked IP: {conn.addr}", 3)
-            conn.close()
-            return False
-
-        def client_loop():
-            self.server_info["online"] += 1
-
-            self.log("Started new thread for client.", level=1)
-
-            conn.send(to_bytes(Packet(PacketType.CONNECTION_STARTED, None)))
-
-            while self.network_format_manager.running:
-                try:
-                    try:
-                        recv_data = conn.recv()
-                        data = to_packet(recv_data)[0]
-                    except (msgpack.ExtraData, ValueError):  # idk why it does this, but it still works lmao
-                        pass
-                    except (msgpack.FormatError, msgpack.StackError, msgpack.UnpackValueError) as e:
-                        self.log(
-                            f"CLIENT ATTEMPTED TO SEND NON-PACKET DATA:\n\t- Data: \"{data}\"\n\t- Traceback: [bold red]{traceback.format_exc()}",
-                            3)
-                        conn.close()
-                        break
-
-                    self.log(f"Receive: {data}", 1)
-
-                    if data.packet_type == PacketType.DISCONNECT:
-                        self.log("Client disconnected via packet.", 1)
-                        break
-
-                    reply = self.handle_packet(data, conn)
-
-                    self.log(f"Send   : {reply}", 1)
-
-                    if reply != None:
-                        conn.sendall(to_bytes(reply))
-                except (socket.error, EOFError) as e:
-                    self.log(
-                        f"A client created a socket error. The connection will be closed.\n\t- Client: {conn.getsockname()}\n\t- Error: [bold red]{traceback.format_exc()}",
-                        3)
-                    conn.close()
-                    break
-
-            self.log(f"Closing connection to {conn.getsockname()}.")
-            conn.close()
-            self.server_info["online"] -= 1
-
-        threading.Thread(target=client_loop).start()
-
-        return True
-
     def get_ip(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.connect(("8.8.8.8", 80))
@@ -352,15 +582,6 @@ class Server:
 
         return thing
     
-    def recv_all(self, length: int):
-        data = b''
-        while len(data) < length:
-            more = self.sock.recv(length - len(data))
-            if not more:
-                raise EOFError("Socket closed before we received all data")
-            data += more
-        return data
-
     def log(self, message: str, level: int = 2):
         """
         Show a message to the console.
@@ -0,0 +1,172 @@
+"""Who's connected, so anything that needs to find a client (sending to a channel, a user or everyone, kicking,
+counting connections from an address) can look it up instead of going through every connection.
+
+The registry is shared between the event loop, the database threads and the interactive terminal, so everything
+in it is behind one lock. Lookups hand back copies, so they can be looped over while clients come and go.
+"""
+from __future__ import annotations
+
+import threading
+
+import server.formats.network_format
+
+
+def connection_ip(connection: server.formats.network_format.NetworkConnection) -> str:
+    """The address a client connected from, without the port. Unix socket and loopback clients get "unix" and "loopback"."""
+    addr = connection.addr
+    if isinstance(addr, (tuple, list)) and addr:
+        return str(addr[0])
+    return str(addr)
+
+
+class SessionRegistry:
+    """Every connected client, indexed by user, channel and address."""
+
+    def __init__(self):
+        self.__lock = threading.RLock()
+        self.__connections: set[server.formats.network_format.NetworkConnection] = set()
+        # clients that have never subscribed to a channel, they get every message like older clients always have
+        self.__legacy: set[server.formats.network_format.NetworkConnection] = set()
+        self.__by_channel: dict[int, set[server.formats.network_format.NetworkConnection]] = {}
+        self.__by_uuid: dict[str, set[server.formats.network_format.NetworkConnection]] = {}
+        # lowercase username -> connections, for mentions
+        self.__by_name: dict[str, set[server.formats.network_format.NetworkConnection]] = {}
+        self.__by_ip: dict[str, set[server.formats.network_format.NetworkConnection]] = {}
+
+        # stats
+        self.peak = 0
+        self.total = 0
+
+    @staticmethod
+    def __add_to(index: dict, key, connection) -> None:
+        index.setdefault(key, set()).add(connection)
+
+    @staticmethod
+    def __remove_from(index: dict, key, connection) -> None:
+        connections = index.get(key)
+        if connections is None: return
+
+        connections.discard(connection)
+        if not connections:
+            del index[key]
+
+    def add(self, connection: server.formats.network_format.NetworkConnection) -> int:
+        """Start keeping track of a new client, returning how many are connected now."""
+        with self.__lock:
+            if connection in self.__connections:
+                return len(self.__connections)
+
+            self.__connections.add(connection)
+            self.__legacy.add(connection)
+            self.__add_to(self.__by_ip, connection_ip(connection), connection)
+
+            self.total += 1
+            self.peak = max(self.peak, len(self.__connections))
+            return len(self.__connections)
+
+    def remove(self, connection: server.formats.network_format.NetworkConnection) -> int:
+        """Forget a client that has gone away, returning how many are still connected."""
+        with self.__lock:
+            if connection not in self.__connections:
+                return len(self.__connections)
+
+            self.__connections.discard(connection)
+            self.__legacy.discard(connection)
+            self.__remove_from(self.__by_ip, connection_ip(connection), connection)
+            for channel_id in connection.subscriptions or ():
+                self.__remove_from(self.__by_channel, channel_id, connection)
+            if connection.user_uuid:
+                self.__remove_from(self.__by_uuid, connection.user_uuid, connection)
+            if connection.user_name:
+                self.__remove_from(self.__by_name, connection.user_name.lower(), connection)
+            return len(self.__connections)
+
+    def subscribe(self, connection: server.formats.network_format.NetworkConnection, channel_id: int, user_name: str = None, user_uuid: str = None) -> None:
+        with self.__lock:
+            if connection.subscriptions is None:
+                connection.subscriptions = set()
+                self.__legacy.discard(connection)
+
+            connection.subscriptions.add(channel_id)
+            self.__add_to(self.__by_channel, channel_id, connection)
+            self.identify(connection, user_name, user_uuid)
+
+    def unsubscribe(self, connection: server.formats.network_format.NetworkConnection, channel_id: int) -> None:
+        with self.__lock:
+            if connection.subscriptions is None:
+                connection.subscriptions = set()
+                self.__legacy.discard(connection)
+
+            connection.subscriptions.discard(channel_id)
+            self.__remove_from(self.__by_channel, channel_id, connection)
+
+    def identify(self, connection: server.formats.network_format.NetworkConnection, user_name: str = None, user_uuid: str = None) -> None:
+        """Note down who's using a connection, when the client tells us."""
+        with self.__lock:
+            # only index clients we're still tracking, otherwise one that's already gone would never be removed again
+            tracked = connection in self.__connections
+
+            if isinstance(user_name, str) and user_name and user_name != connection.user_name:
+                if connection.user_name:
+                    self.__remove_from(self.__by_name, connection.user_name.lower(), connection)
+                connection.user_name = user_name
+                if tracked:
+                    self.__add_to(self.__by_name, user_name.lower(), connection)
+
+            # a connection is whoever it first said it was, so it can't get round the per-user rate limits by
+            # saying it's someone new in every packet (or use up someone else's)
+            if isinstance(user_uuid, str) and user_uuid and not connection.user_uuid:
+                connection.user_uuid = user_uuid
+                if tracked:
+                    self.__add_to(self.__by_uuid, user_uuid, connection)
+
+    @property
+    def online(self) -> int:
+        with self.__lock:
+            return len(self.__connections)
+
+    def connections(self) -> list[server.formats.network_format.NetworkConnection]:
+        with self.__lock:
+            return list(self.__connections)
+
+    def channel_receivers(self, channel_id: int, mentions: list[str] = ()) -> set[server.formats.network_format.NetworkConnection]:
+        """Everyone who should get a message sent in a channel: people watching it, older clients that get
+        everything, and anyone mentioned in it (so they can be notified)."""
+        with self.__lock:
+            receivers = set(self.__by_channel.get(channel_id, ()))
+            receivers.update(self.__legacy)
+            for user_name in mentions:
+                receivers.update(self.__by_name.get(user_name.lower(), ()))
+            return receivers
+
+    def by_channel(self, channel_id: int) -> list[server.formats.network_format.NetworkConnection]:
+        with self.__lock:
+            return list(self.__by_channel.get(channel_id, ()))
+
+    def by_uuid(self, user_uuid: str) -> list[server.formats.network_format.NetworkConnection]:
+        with self.__lock:
+            return list(self.__by_uuid.get(user_uuid, ()))
+
+    def by_name(self, user_name: str) -> list[server.formats.network_format.NetworkConnection]:
+        with self.__lock:
+            return list(self.__by_name.get(user_name.lower(), ()))
+
+    def by_ip(self, ip: str) -> list[server.formats.network_format.NetworkConnection]:
+        with self.__lock:
+            return list(self.__by_ip.get(ip, ()))
+
+    def count_ip(self, ip: str) -> int:
+        with self.__lock:
+            return len(self.__by_ip.get(ip, ()))
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "online": len(self.__connections),
+                "peak": self.peak,
+                "total": self.total,
+                "users": len(self.__by_uuid),
+                "channels": len(self.__by_channel),
+                "addresses": len(self.__by_ip),
+                "legacy": len(self.__legacy)
+            }
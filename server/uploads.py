@@ -0,0 +1,200 @@
+import hashlib
+import os
+import re
+import threading
+import uuid
+import zlib
+
+
+# how much data each UPLOAD chunk packet carries
+CHUNK_SIZE = 64 * 1024
+UPLOAD_KINDS = ("icon", "attachment")
+
+
+class UploadError(ValueError):
+    pass
+
+
+def file_sha256(path: str) -> str:
+    """Hash a file a chunk at a time, so big files don't have to fit in memory."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        buffer = bytearray(CHUNK_SIZE)
+        view = memoryview(buffer)
+        while True:
+            nbytes = f.readinto(buffer)
+            if not nbytes:
+                break
+            sha.update(view[:nbytes])
+    return sha.hexdigest()
+
+
+class Upload:
+    def __init__(self, upload_id: str, kind: str, owner_uuid: str, size: int, sha256: str, part_path: str, final_path: str):
+        self.upload_id = upload_id
+        self.kind = kind
+        self.owner_uuid = owner_uuid
+        self.size = size
+        self.sha256 = sha256
+        self.part_path = part_path
+        self.final_path = final_path
+        # how many bytes have been written to disk so far, everything before this is done
+        self.offset = 0
+        self.done = False
+        self.file = None
+        # the offset the client was last asked to resend from, so it only gets asked once
+        self.requested_offset = None
+        # held from checking a chunk's offset until it's written (and the upload's finished), so two connections
+        # sending the same upload can't mix their chunks up in the .part file or finish it twice
+        self.lock = threading.Lock()
+
+    def status(self, status: str) -> dict:
+        return {"type": "UPLOAD_STATUS", "status": status, "upload_id": self.upload_id, "offset": self.offset, "size": self.size}
+
+
+class UploadManager:
+    """Receives files sent in chunks over the packet protocol.
+
+    Chunks are appended straight to a `.part` file, so memory use doesn't depend on the size of the upload.
+    Partial uploads stay on disk, so if a client disconnects it can start the same upload again and carry on from
+    where it got to.
+
+    `lock` only covers the `uploads` dict, each upload has its own lock for everything else. When both are needed
+    the upload's is taken first."""
+
+    def __init__(self, root: str = "portal_server", max_sizes: dict[str, int] = None):
+        self.root = root
+        self.max_sizes = max_sizes or {}
+        self.part_folder = os.path.join(root, "uploads")
+        self.uploads: dict[str, Upload] = {}
+        self.lock = threading.Lock()
+
+        for folder in (self.part_folder, os.path.join(root, "user_icons"), os.path.join(root, "attachments")):
+            if not os.path.isdir(folder):
+                os.mkdir(folder)
+
+    def __final_path(self, kind: str, owner_uuid: str, sha256: str, name: str) -> str:
+        if kind == "icon":
+            return os.path.join(self.root, "user_icons", f"{owner_uuid}.png")
+
+        # attachments are stored by their hash, so the same file is only ever stored once
+        extension = re.sub(r"[^A-Za-z0-9]", "", os.path.splitext(name or "")[1])[:10]
+        return os.path.join(self.root, "attachments", sha256 + (f".{extension}" if extension else ""))
+
+    def start(self, owner_uuid: str, upload_id: str, kind: str, size: int, sha256: str, name: str = None) -> Upload:
+        if kind not in UPLOAD_KINDS:
+            raise UploadError(f"Can't upload a file of type \"{kind}\".")
+        if not isinstance(size, int) or size <= 0 or size > self.max_sizes.get(kind, size):
+            raise UploadError("That file is too big!")
+        if not re.fullmatch(r"[0-9a-f]{64}", str(sha256)) or not re.fullmatch(r"[0-9A-Za-z_-]{1,64}", str(upload_id)):
+            raise UploadError("Invalid upload.")
+        try:
+            owner_uuid = str(uuid.UUID(owner_uuid))
+        except (ValueError, TypeError, AttributeError):
+            raise UploadError("Invalid user UUID.")
+
+        # upload ids come from the client, so keep them separate per user
+        key = f"{owner_uuid}-{upload_id}"
+        final_path = self.__final_path(kind, owner_uuid, sha256, name)
+        part_path = os.path.join(self.part_folder, key + ".part")
+
+        with self.lock:
+            upload = self.uploads.get(key)
+            replaced = None
+            if upload is None or upload.sha256 != sha256 or upload.size != size:
+                replaced = upload
+                upload = Upload(upload_id, kind, owner_uuid, size, sha256, part_path, final_path)
+                self.uploads[key] = upload
+
+        if replaced is not None:
+            with replaced.lock:
+                self.__close_file(replaced)
+
+        with upload.lock:
+            # we already have this exact file, no need to send it again
+            if os.path.isfile(final_path) and os.path.getsize(final_path) == size and file_sha256(final_path) == sha256:
+                upload.offset = size
+                upload.done = True
+                self.__discard(key, upload)
+                return upload
+
+            # pick up where a previous attempt got to
+            self.__close_file(upload)
+            upload.offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+            if upload.offset > size:
+                os.remove(part_path)
+                upload.offset = 0
+            upload.done = False
+
+            if upload.offset == size:
+                self.__finish(key, upload)
+        return upload
+
+    def offset(self, owner_uuid: str, upload_id: str) -> int | None:
+        """Where an upload has got to, None if there's no such upload going."""
+        with self.lock:
+            upload = self.uploads.get(f"{owner_uuid}-{upload_id}")
+        return upload.offset if upload is not None else None
+
+    def write_chunk(self, owner_uuid: str, upload_id: str, offset: int, data: bytes, crc32: int) -> tuple[Upload, bool]:
+        """Write a chunk to disk and return the upload along with whether the chunk was used.
+
+        Chunks have to arrive in order and match their checksum, anything else is thrown away and the client
+        should resend from the upload's current offset."""
+        try:
+            owner_uuid = str(uuid.UUID(owner_uuid))
+        except (ValueError, TypeError, AttributeError):
+            raise UploadError("Invalid user UUID.")
+
+        key = f"{owner_uuid}-{upload_id}"
+        with self.lock:
+            upload = self.uploads.get(key)
+        if upload is None:
+            raise UploadError("That upload was never started.")
+
+        with upload.lock:
+            if upload.done or offset != upload.offset or not isinstance(data, bytes) or zlib.crc32(data) != crc32:
+                return upload, False
+            if upload.offset + len(data) > upload.size:
+                raise UploadError("Upload is bigger than it said it would be.")
+
+            if upload.file is None:
+                upload.file = open(upload.part_path, "ab")
+            upload.file.write(data)
+            upload.offset += len(data)
+            upload.requested_offset = None
+
+            if upload.offset == upload.size:
+                self.__finish(key, upload)
+        return upload, True
+
+    def __finish(self, key: str, upload: Upload) -> None:
+        """Must be called with the upload's lock held."""
+        self.__close_file(upload)
+
+        if file_sha256(upload.part_path) != upload.sha256:
+            # something went wrong along the way, start again from scratch
+            os.remove(upload.part_path)
+            upload.offset = 0
+            raise UploadError("Uploaded file didn't match its checksum.")
+
+        os.replace(upload.part_path, upload.final_path)
+        upload.done = True
+        self.__discard(key, upload)
+
+    def __discard(self, key: str, upload: Upload) -> None:
+        with self.lock:
+            if self.uploads.get(key) is upload:
+                del self.uploads[key]
+
+    def __close_file(self, upload: Upload) -> None:
+        if upload.file is not None:
+            upload.file.close()
+            upload.file = None
+
+    def close(self) -> None:
+        with self.lock:
+            uploads = list(self.uploads.values())
+        for upload in uploads:
+            with upload.lock:
+                self.__close_file(upload)
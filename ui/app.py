@@ -4,22 +4,26 @@ from textual.css.query import NoMatches
 from textual import work
 from queue import Queue
 
+import asyncio
+import functools
+
 import uuid
 import os
 import configparser
 import playsound
 
-from ui.config import DEFAULT_CONFIG, conf_get
+from ui.config import DEFAULT_CONFIG, conf_get, heartbeat_interval
 from ui.widgets.update_screen import UpdateScreen
 from ui.widgets.sidebar import ServerList, ChannelList, MemberList
 from ui.widgets.welcome import Welcome
 from ui.widgets.chat import Chat, Message
 from ui.widgets.message_box import ChatArea
 from ui.widgets.server_overview import ServerOverview
+from ui.widgets.server_view import ServerView
 
 from desktop_notifier import DesktopNotifier, Icon
 
-from server.network import Network
+from server.async_network import AsyncNetwork, AsyncLoopbackNetwork, ServerNotResponding
 from server.packet import Packet, PacketType
 
 
@@ -40,18 +44,18 @@ class Portal(App):
         yield ChatArea()
         yield MemberList()
 
-    def action_quit(self):
+    async def action_quit(self):
         self.is_open = False
-        if self.n:
-            self.n.client.close()
         if self.ping_loop_worker:
             self.ping_loop_worker.cancel()
             self.ping_loop_worker = None
+        if self.n:
+            await self.n.close()
         if self.packet_handler_worker:
             self.packet_handler_worker.cancel()
             self.packet_queue.put(Packet(PacketType.STOP))
             self.packet_handler_worker = None
-        return super().action_quit()
+        await super().action_quit()
 
     def init_settings_file(self):
         for key in DEFAULT_CONFIG:
@@ -82,6 +86,8 @@ class Portal(App):
         self.is_open = True
         self.n = None
         self.channel_id = None
+        # the cursor for the page of history before the oldest message shown, None once we've got to the start
+        self.history_older = None
         self.opened_server = None
         self.query_one(Chat).styles.display = "none"
         self.query_one(ChannelList).styles.display = "none"
@@ -90,6 +96,8 @@ class Portal(App):
         self.ping_loop_worker = None
         self.packet_handler_worker = None
         self.packet_queue: Queue[Packet] = Queue()
+        # upload_id -> offset of uploads waiting to carry on after the server turned some of their chunks away
+        self.upload_retries: dict[str, int] = {}
         self.notify("Portal is [bold]EXTREMELY[/bold] buggy at the moment, watch out! I'm currently migrating it to a queue system, and so your app may freeze when doing certain things, know I am working to fix this!", title="Watch out!", severity="warning", timeout=10)
         self.app.push_screen(UpdateScreen())
 
@@ -101,8 +109,7 @@ class Portal(App):
         if event.node.tree.id != "channels": return
 
         if event.node == event.node.tree.root or event.node.data == None:
-            for p in self.n.send(Packet(PacketType.GET, {"type": "INFO"}, tag="server-overview")):
-                self.packet_queue.put(p)
+            self.get_server_info()
             chat.display = "none"
             chat_area.display = 'none'
         else:
@@ -114,40 +121,112 @@ class Portal(App):
             except:
                 pass
 
-            data = event.node.data
-            self.channel_id = data
+            previous_channel = self.channel_id
+            self.channel_id = event.node.data
+            self.open_channel(previous_channel, self.channel_id)
 
-            # Get messages in the selected channel
-            for p in self.n.send(Packet(PacketType.GET, {"type": "MESSAGES", "channel_id": self.channel_id}, tag="servr-msgs")):
-                self.packet_queue.put(p)
+    @work(exclusive=True, group="server-info")
+    async def get_server_info(self):
+        try:
+            self.packet_queue.put(await self.n.request(Packet(PacketType.GET, {"type": "INFO"})))
+        except (OSError, asyncio.TimeoutError):
+            pass # ping_loop lets the user know if the server's gone
 
-            # Update member list
-            for p in self.n.send(Packet(PacketType.GET, {"type": "MEMBERS", "channel_id": self.channel_id}, tag="servr-members")):
-                self.packet_queue.put(p)
-        
-        
+    @work(exclusive=True, group="open-channel")
+    async def open_channel(self, previous_channel, channel_id):
+        try:
+            # only get sent messages for the channel we're looking at (and mentions), older servers just send everything
+            if self.n.capabilities.supports("subscriptions"):
+                if previous_channel is not None and previous_channel != channel_id:
+                    await self.n.send(Packet(PacketType.UNSUBSCRIBE, {"channel_id": previous_channel}))
+                await self.n.send(Packet(PacketType.SUBSCRIBE, {"channel_id": channel_id, "username": conf_get(self.config, "MyAccount", "username"), "uuid": self.user_id}))
+
+            # just the latest messages if the server can page through history, the rest get loaded when scrolling up
+            if self.n.capabilities.supports("history"):
+                messages = Packet(PacketType.GET, {"type": "HISTORY", "channel_id": channel_id})
+            else:
+                messages = Packet(PacketType.GET, {"type": "MESSAGES", "channel_id": channel_id})
+
+            # get the messages and members at the same time rather than waiting for one before asking for the other
+            replies = await asyncio.gather(
+                self.n.request(messages),
+                self.n.request(Packet(PacketType.GET, {"type": "MEMBERS", "channel_id": channel_id}))
+            )
+        except (OSError, asyncio.TimeoutError):
+            return
+
+        for reply in replies:
+            self.packet_queue.put(reply)
 
     @work
     async def send_message(self, message: str):
-        self.n.send(Packet(PacketType.MESSAGE_SEND, {"message": message, "channel_id": self.channel_id, "username": conf_get(self.config, "MyAccount", "username"), "uuid": self.user_id}))
-        #self.packet_queue.put(response)
+        try:
+            reply = await self.n.request(Packet(PacketType.MESSAGE_SEND, {"message": message, "channel_id": self.channel_id, "username": conf_get(self.config, "MyAccount", "username"), "uuid": self.user_id}))
+        except (OSError, asyncio.TimeoutError):
+            self.notify("Couldn't send your message.", title="Sorry!", severity="warning")
+            return
 
-    @work(exclusive=True,group="mount-messages")
-    async def mount_msgs(self, chat, data, banner: bool = False):
+        # we get our own message back with everyone else's, so only errors need showing
+        if reply.packet_type == PacketType.ERROR:
+            self.notify(str(reply.data), title="Sorry!", severity="warning")
+        elif reply.packet_type == PacketType.WAIT:
+            self.notify(f"You're sending messages too quickly, try again in {reply.data['retry_after']:.1f} seconds.", title="Slow down!", severity="warning")
+
+    def message_widgets(self, data, banner: bool = False) -> list:
+        widgets = []
         if banner:
-            await chat.mount(Label(f"[b][u]Welcome![/u][/b]\n[dim]This is the start of the #{data['channel_name']} channel.[/dim]\n[dim]Portal has only [bold]just started development[/bold], so watch out for bugs![/dim]"))
-            await chat.mount(Rule(classes="start-rule"))
+            widgets.append(Label(f"[b][u]Welcome![/u][/b]\n[dim]This is the start of the #{data['channel_name']} channel.[/dim]\n[dim]Portal has only [bold]just started development[/bold], so watch out for bugs![/dim]"))
+            widgets.append(Rule(classes="start-rule"))
 
         for msg in data["messages"]:
             # the message id is message[0]
             # the message contents is message[1]
             # the timestamp (in string format) is message[2]
             # the sender name is message [3]
-            await chat.mount(Message(
+            widgets.append(Message(
                 msg[1],
                 msg[3],
                 msg[2]
             ))
+        return widgets
+
+    @work(exclusive=True,group="mount-messages")
+    async def mount_msgs(self, chat, data, banner: bool = False):
+        # all in one go, mounting them one at a time lays the chat out again for every message
+        await chat.mount(*self.message_widgets(data, banner))
+
+    @work(exclusive=True,group="mount-messages")
+    async def mount_history(self, chat, data):
+        # the welcome banner only goes above the channel's first message
+        await chat.mount(*self.message_widgets(data, banner=data["older"] is None))
+        chat.call_after_refresh(chat.scroll_end, animate=False)
+        # only now, clearing the old channel's messages scrolls to the top and would load older ones too soon
+        self.history_older = data["older"]
+
+    def on_chat_reached_top(self, event: Chat.ReachedTop):
+        if self.n is None or self.history_older is None: return
+        self.load_older_msgs(self.channel_id, self.history_older)
+
+    @work(exclusive=True, group="load-older")
+    async def load_older_msgs(self, channel_id, before):
+        try:
+            reply = await self.n.request(Packet(PacketType.GET, {"type": "HISTORY", "channel_id": channel_id, "before": before}))
+        except (OSError, asyncio.TimeoutError):
+            return
+
+        # the server was busy (we'll try again next time they scroll up), or they've moved on to another channel
+        if reply.packet_type != PacketType.DATA or channel_id != self.channel_id or before != self.history_older:
+            return
+
+        data = reply.data["data"]
+        self.history_older = data["older"]
+
+        chat = self.query_one(Chat)
+        top = chat.children[0] if chat.children else None
+        await chat.mount(*self.message_widgets(data, banner=data["older"] is None), before=0)
+        # keep the messages they were looking at where they were, rather than jumping up to the oldest ones
+        if top is not None:
+            chat.call_after_refresh(chat.scroll_to_widget, top, animate=False, top=True)
 
     @work
     async def update_welcome(self, server_info):
@@ -225,6 +304,10 @@ class Portal(App):
                     # add new messages
                     self.call_from_thread(self.mount_msgs, chat, data, banner=True)
                     self.app.log("Done redrawing entire message history!")
+                elif packet.data["type"] == "SERVER_HISTORY":
+                    self.history_older = None
+                    chat.remove_children()
+                    self.call_from_thread(self.mount_history, chat, packet.data["data"])
                 elif packet.data["type"] == "SERVER_MEMBERS":
                     member_list.clear()
                     for role in packet.data["data"]:
@@ -239,7 +322,13 @@ class Portal(App):
                             for member in members_with_role:
                                 role_node.add_leaf(member)
                     member_list.root.expand_all()
-                elif packet.tag == "server-overview":
+                elif packet.data["type"] == "UPLOAD_STATUS":
+                    # uploads waiting to retry will carry on by themselves
+                    if packet.data["status"] in ("ready", "resend") and packet.data["upload_id"] not in self.upload_retries:
+                        self.call_from_thread(self.send_upload, packet.data["upload_id"], packet.data["offset"])
+                    elif packet.data["status"] == "done":
+                        self.app.log(f"Upload {packet.data['upload_id']} finished!")
+                elif packet.data["type"] == "SERVER_INFO":
                     self.app.log("Updating welcome...")
                     self.call_from_thread(self.update_welcome, packet.data["data"])
                     self.app.log("Done updating welcome!")
@@ -248,31 +337,77 @@ class Portal(App):
             elif packet.packet_type == PacketType.CONNECTION_STARTED:
                 self.app.log("Ignoring connection packet...")
                 pass # ignore connection started packets
+            elif packet.packet_type == PacketType.WAIT:
+                # upload chunks the server turned away get sent again, so those don't need mentioning
+                if packet.data["packet_type"] == PacketType.UPLOAD.value:
+                    if "upload_id" in packet.data: # older servers don't say which upload it was
+                        self.call_from_thread(self.retry_upload, packet.data["upload_id"], packet.data["offset"], packet.data["retry_after"])
+                else:
+                    self.notify(f"The server is busy, try again in {packet.data['retry_after']:.1f} seconds.", title="Slow down!", severity="warning")
             elif packet.packet_type == PacketType.NOTIFICATION:
                 self.log(packet.data)
                 self.notify(packet.data)
             else:
                 self.notify(f"Unhandled packet: {packet}", title="Warning!", severity="warning", markup=False, timeout=10)
 
-    @work(thread=True)
-    def ping_loop(self):
+    def send_upload(self, upload_id: str, offset: int):
+        # one sender per upload, so a resend stops the one that's still going instead of both sending the rest of the file
+        self.run_worker(functools.partial(self.upload_chunks, upload_id, offset), group=f"upload-{upload_id}", exclusive=True)
+
+    def retry_upload(self, upload_id: str, offset: int, retry_after: float):
+        # the chunks after one that was turned away are thrown away too, so stop sending them until the server's ready
+        self.workers.cancel_group(self, f"upload-{upload_id}")
+        if upload_id not in self.upload_retries:
+            self.set_timer(retry_after, functools.partial(self.resume_upload, upload_id))
+        # the server says where it's got to, so the latest one is always right
+        self.upload_retries[upload_id] = offset
+
+    def resume_upload(self, upload_id: str):
+        self.send_upload(upload_id, self.upload_retries.pop(upload_id))
+
+    async def upload_chunks(self, upload_id: str, offset: int):
+        try:
+            await self.n.send_upload(upload_id, self.user_id, offset)
+        except OSError: # the server went away, the upload will carry on next time we connect
+            pass
+
+    @work
+    async def ping_loop(self):
+        n = self.n
         try:
             while self.is_open:
-                response = self.n.recv()
-                if response != None:
-                    for packet in response:
-                        self.packet_queue.put(packet)
-        except Exception: # server was closed
+                self.packet_queue.put(await n.recv_push())
+        except OSError as e: # server was closed
+            if n.closed: return # we closed it ourselves
+
             server_list = self.query_one(ServerList)
             for button in server_list.query_one("#icons").children:
                 if "server-btn" in button.classes:
-                    if button.info[2] == self.n.client.getpeername()[0]: # if the button refers to the server that just closed, then delete the button
+                    if button.info[2] == n.server: # if the button refers to the server that just closed, then delete the button
                         button.remove()
 
-            self.notify(message="The host of the server shut down the server.", title="Woops!", severity="warning", timeout=10)
+            if isinstance(e, ServerNotResponding):
+                self.notify(message="The server stopped responding.", title="Woops!", severity="warning", timeout=10)
+            else:
+                self.notify(message="The host of the server shut down the server.", title="Woops!", severity="warning", timeout=10)
             self.open_server(None)
 
-    def open_server(self, server_info):
+    async def connect(self, server_ip: str) -> AsyncNetwork:
+        """Connect to a server, skipping the network entirely if it's the one we're hosting ourselves."""
+        n = None
+        for server_view in self.query(ServerView):
+            hosted = server_view.server
+            if hosted.running and hosted.ip == server_ip:
+                n = AsyncLoopbackNetwork(hosted.network_format_manager.connect_loopback(), server_ip)
+        if n is None:
+            n = AsyncNetwork(server_ip)
+
+        n.heartbeat_interval = heartbeat_interval(self.config)
+        await n.connect()
+        return n
+
+    @work(exclusive=True, group="open-server")
+    async def open_server(self, server_info):
         if self.ping_loop_worker:
             self.ping_loop_worker.cancel()
             self.ping_loop_worker = None
@@ -280,8 +415,8 @@ class Portal(App):
             self.packet_handler_worker.cancel()
             self.packet_handler_worker = None
         if self.n:
-            self.n.close()
-            self.n = None
+            n, self.n = self.n, None
+            await n.close()
 
         chat = self.query_one(Chat) # chat history
         chat_area = self.query_one(ChatArea) # message box
@@ -290,6 +425,8 @@ class Portal(App):
         member_list = self.query_one(MemberList)
 
         self.opened_server = server_info
+        self.channel_id = None
+        self.history_older = None
 
         if server_info == None: # go back to welcome screen
             welcome.display = "block"
@@ -307,8 +444,8 @@ class Portal(App):
             return
 
         try:
-            self.n = Network(server_info[2]) # start a connection to the server
-        except ConnectionRefusedError: # the server isn't online
+            self.n = await self.connect(server_info[2]) # start a connection to the server
+        except OSError: # the server isn't online
             self.notify("That server isn't online at the moment.", title="Sorry!", severity="warning")
             return
         
@@ -323,5 +460,12 @@ class Portal(App):
         self.ping_loop_worker = self.ping_loop()
         self.packet_handler_worker = self.packet_handler()
 
-        for p in self.n.send(Packet(PacketType.GET, {"type": "CHANNELS"})):
-            self.packet_queue.put(p)
\ No newline at end of file
+        try:
+            self.packet_queue.put(await self.n.request(Packet(PacketType.GET, {"type": "CHANNELS"})))
+
+            # send our icon to the server, if it already has it then nothing gets sent
+            icon_path = conf_get(self.config, "MyAccount", "icon_path")
+            if self.n.capabilities.supports("uploads") and os.path.isfile(icon_path) and icon_path != DEFAULT_CONFIG["MyAccount"]["icon_path"]:
+                await self.n.start_upload(icon_path, self.user_id, "icon")
+        except (OSError, asyncio.TimeoutError):
+            pass # ping_loop lets the user know
\ No newline at end of file
@@ -13,6 +13,9 @@ DEFAULT_CONFIG = {
     "Notifications": {
         "notification-sound": 1, # 1 for True
         "desktop-notifications": 1 # 1 for True
+    },
+    "Network": {
+        "heartbeat-interval": 15 # seconds of hearing nothing from a server before checking it's still there, 0 turns it off
     }
 }
 
@@ -20,6 +23,13 @@ def conf_get(config: ConfigParser, section: str, option: str):
     try: return config.get(section, option)
     except (NoOptionError, NoSectionError): return DEFAULT_CONFIG[section][option]
 
+def heartbeat_interval(config: ConfigParser) -> int:
+    """The heartbeat interval in seconds, 0 if heartbeats are turned off. Falls back to the default if it isn't a number."""
+    try:
+        return max(0, int(conf_get(config, "Network", "heartbeat-interval")))
+    except ValueError:
+        return DEFAULT_CONFIG["Network"]["heartbeat-interval"]
+
 def conf_set(config: ConfigParser, section: str, option: str, value: str):
     if not config.has_section(section):
         config.add_section(section)
@@ -61,13 +61,18 @@ class AddServer(ModalScreen):
     def find_servers(self, table: DataTable):
         local_ip, netmash = get_subnet()
         for server in scan_network(get_subnet_network(local_ip, netmash)):
-            # we minus 1 from the online count otherwise it includes ourselves
+            # busy servers might not say who they are
+            title = server["data"]["title"] or "Unknown server"
+            if server["busy"]:
+                title += " (busy)"
             try:
-                to_content(server["data"]["title"])
+                to_content(title)
             except MarkupError:
                 pass
 
-            table.add_row(server["data"]["title"], server["data"]["online"]-1, server["ip"])
+            # we minus 1 from the online count otherwise it includes ourselves
+            online = server["data"]["online"]
+            table.add_row(title, online-1 if online is not None else "?", server["ip"])
 
         # remove loading text when done searching for servers
         self.query_one("#loading1").remove()
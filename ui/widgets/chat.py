@@ -1,5 +1,6 @@
 from textual.containers import VerticalScroll, Vertical
 from textual.widgets import Label
+from textual.message import Message as TextualMessage
 
 from textual.markup import MarkupError
 from datetime import datetime
@@ -32,8 +33,10 @@ class Message(Vertical):
         self.user_name = user_name
 
         self.send_time = send_time
-        if isinstance(self.send_time, str): # auto convert string time into datetime
-            self.send_time = datetime.strptime(self.send_time, "%Y-%m-%d %H:%M:%S")
+        if isinstance(self.send_time, str): # auto convert string time into datetime (fromisoformat is a lot quicker than strptime)
+            self.send_time = datetime.fromisoformat(self.send_time)
+        elif self.send_time.tzinfo is not None: # servers that support native timestamps send them in UTC
+            self.send_time = self.send_time.astimezone()
 
         self.sender_icon_path = sender_icon_path
 
@@ -56,5 +59,13 @@ class Chat(VerticalScroll):
     }
     """
     
+    class ReachedTop(TextualMessage):
+        """Sent when the chat is scrolled all the way up, so older messages can be loaded."""
+
     def __init__(self):
-        super().__init__()
\ No newline at end of file
+        super().__init__()
+
+    def watch_scroll_y(self, old_value: float, new_value: float) -> None:
+        super().watch_scroll_y(old_value, new_value)
+        if new_value <= 0 < old_value:
+            self.post_message(self.ReachedTop())
\ No newline at end of file
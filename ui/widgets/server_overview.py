@@ -24,6 +24,8 @@ class ServerOverview(Vertical):
 
     def compose(self):
         final_text = f"[b u]Welcome to {self.info['title']}[/b u]\n[b]Online: [green]{self.info['online']}[/green][/b]\n\n{self.info['description']}"
+        if self.info.get("load") == "shedding": # only newer servers say
+            final_text += "\n\n[yellow]This server is very busy at the moment, so some things may take a while to load.[/yellow]"
         label = Label(final_text)
 
         try: